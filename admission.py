@@ -0,0 +1,212 @@
+import asyncio
+from collections import deque
+from typing import Callable, Optional
+
+from config import (
+    REPLAY_DRAIN_TIMEOUT,
+    REPLAY_MAX_BYTES,
+    SIGN_IN_MAX_CONCURRENT,
+    SIGN_IN_MAX_LOOP_LAG,
+    SIGN_IN_PROGRESS_INTERVAL,
+    SIGN_IN_QUEUE_SIZE,
+)
+from connection import Connection
+from custom_logger import logger
+from metrics import LoopLagMonitor
+from rendering import render
+from messages_templates import (
+    replay_stalled,
+    sign_in_queued,
+    sign_in_queue_full,
+    sign_in_queue_overflow,
+)
+
+
+class FairBudget:
+    """
+    Ограниченный ресурс, который выдаётся строго по очереди.
+
+    Ресурс берётся частями произвольного размера, пока занято не
+    больше capacity. Если в очереди кто-то есть, новый запрос встаёт
+    за ним, даже когда свободного места хватает: большие запросы
+    не голодают из-за потока маленьких. Запрос больше capacity
+    выдаётся, когда ресурс свободен целиком.
+
+    Позиция в очереди считается по номерам билетов за O(1): это
+    разность между билетом запроса и билетом последнего обслуженного.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity: int = capacity
+        self.used: int = 0
+        # (билет, размер, future) в порядке постановки в очередь.
+        self._waiters: deque[tuple[int, int, asyncio.Future]] = deque()
+        self._next_ticket: int = 0
+        # Билет последнего запроса, покинувшего очередь.
+        self._served: int = 0
+
+    @property
+    def queued(self) -> int:
+        """Количество запросов в очереди (включая отменённые)."""
+        return len(self._waiters)
+
+    def _fits(self, amount: int) -> bool:
+        return not self.used or self.used + amount <= self.capacity
+
+    def try_acquire(self, amount: int) -> bool:
+        """Взятие ресурса без ожидания, если очередь пуста и место есть."""
+        if self._waiters or not self._fits(amount):
+            return False
+        self.used += amount
+        return True
+
+    async def acquire(
+            self,
+            amount: int,
+            interval: Optional[float] = None,
+            on_wait: Optional[Callable[[int], bool]] = None
+    ) -> bool:
+        """
+        Взятие ресурса, при необходимости - с ожиданием в очереди.
+
+        Пока запрос ждёт, on_wait раз в interval секунд получает его
+        позицию в очереди; если on_wait вернёт False, запрос покидает
+        очередь. Возвращает True, если ресурс получен.
+        """
+        if self.try_acquire(amount):
+            return True
+        self._next_ticket += 1
+        ticket = self._next_ticket
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((ticket, amount, waiter))
+        try:
+            while True:
+                if on_wait is not None and not on_wait(ticket - self._served):
+                    waiter.cancel()
+                    self._wake()
+                    return False
+                done, _ = await asyncio.wait({waiter}, timeout=interval)
+                if done:
+                    return True
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self.release(amount)
+            else:
+                waiter.cancel()
+                self._wake()
+            raise
+
+    def release(self, amount: int) -> None:
+        """Возврат ресурса и выдача его следующим в очереди."""
+        self.used -= amount
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters:
+            ticket, amount, waiter = self._waiters[0]
+            if not waiter.done() and not self._fits(amount):
+                break
+            self._waiters.popleft()
+            self._served = ticket
+            if not waiter.done():
+                self.used += amount
+                waiter.set_result(None)
+
+
+class AdmissionControl:
+    """
+    Допуск входов в систему при массовом переподключении.
+
+    После перезапуска сервера все клиенты входят разом, и отправка
+    их истории конкурирует в одном цикле событий с рассылками тем,
+    кто уже в сети. Поэтому одновременно выполняется не больше
+    max_sign_ins входов, остальные ждут в очереди по порядку прихода
+    и раз в progress_interval секунд получают свою позицию. Если
+    в очереди queue_size запросов, новый вход сразу отклоняется.
+
+    История отправляется частями, и перед каждой частью вошедший
+    ждёт, пока задержка цикла событий опустится до max_loop_lag
+    (None - не ждать): отправка истории уступает рассылкам. Вся
+    история, которая отправляется одновременно, ограничена
+    max_replay_bytes байтами. Клиент, который drain_timeout секунд
+    не вычитывает часть истории, отключается: иначе перестали
+    читающие или полуоткрытые соединения навсегда заняли бы места
+    входа и лимит байтов.
+    """
+
+    def __init__(
+            self,
+            loop_lag: LoopLagMonitor,
+            max_sign_ins: int = SIGN_IN_MAX_CONCURRENT,
+            queue_size: int = SIGN_IN_QUEUE_SIZE,
+            progress_interval: float = SIGN_IN_PROGRESS_INTERVAL,
+            max_loop_lag: Optional[float] = SIGN_IN_MAX_LOOP_LAG,
+            max_replay_bytes: int = REPLAY_MAX_BYTES,
+            drain_timeout: Optional[float] = REPLAY_DRAIN_TIMEOUT
+    ) -> None:
+        self.loop_lag: LoopLagMonitor = loop_lag
+        self.sign_ins: FairBudget = FairBudget(max_sign_ins)
+        self.replay: FairBudget = FairBudget(max_replay_bytes)
+        self.queue_size: int = queue_size
+        self.progress_interval: float = progress_interval
+        self.max_loop_lag: Optional[float] = max_loop_lag
+        self.drain_timeout: Optional[float] = drain_timeout
+        # Сколько входов отклонено из-за переполненной очереди.
+        self.rejected: int = 0
+        # Сколько соединений закрыто, потому что не вычитывали историю.
+        self.stalled: int = 0
+
+    async def enter(self, writer: Connection) -> bool:
+        """
+        Ожидание очереди на вход.
+
+        Возвращает True, если вход разрешён: тогда после входа нужно
+        вызвать leave(). Клиент, отключившийся в очереди, её покидает.
+        """
+        if self.sign_ins.queued >= self.queue_size:
+            self.rejected += 1
+            logger.warning(sign_in_queue_overflow, writer.peername)
+            writer.write(render(sign_in_queue_full))
+            return False
+
+        def report(position: int) -> bool:
+            if writer.closed:
+                return False
+            writer.write(render(sign_in_queued, position))
+            return True
+
+        if not await self.sign_ins.acquire(
+                1, self.progress_interval, report
+        ):
+            return False
+        if writer.closed:
+            self.leave()
+            return False
+        return True
+
+    def leave(self) -> None:
+        """Освобождение места входа для следующего в очереди."""
+        self.sign_ins.release(1)
+
+    async def send_replay(self, writer: Connection, frame: bytes) -> bool:
+        """
+        Отправка кадра истории в пределах общего лимита байтов.
+
+        Возвращает False, если соединение закрылось, в том числе
+        потому, что кадр не отправлен за drain_timeout секунд.
+        """
+        while (self.max_loop_lag is not None
+               and self.loop_lag.last > self.max_loop_lag
+               and not writer.closed):
+            await asyncio.sleep(self.loop_lag.interval)
+        await self.replay.acquire(len(frame))
+        try:
+            writer.write_frame(frame)
+            await asyncio.wait_for(writer.drain(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            self.stalled += 1
+            logger.warning(replay_stalled, writer.peername, self.drain_timeout)
+            writer.close()
+        finally:
+            self.replay.release(len(frame))
+        return not writer.closed
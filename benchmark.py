@@ -0,0 +1,347 @@
+"""
+Микро-бенчмарки горячих путей сервера.
+
+Запуск:
+    python benchmark.py broadcast [--connections N] [--rounds N]
+    python benchmark.py models [--messages N]
+    python benchmark.py coalesce [--frames N] [--burst N]
+    python benchmark.py loops [--connections N] [--messages N]
+    python benchmark.py wire [--messages N] [--rounds N]
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import Callable, Optional
+
+from config import WRITE_COALESCE_BYTES
+from config import Message
+from connection import Connection
+from eventloop import LOOP_FACTORIES, available_loops, run
+from messages_templates import general_chat_new_message
+from rendering import WIRE_FORMATS, render_general_message
+
+try:
+    from pydantic import BaseModel
+except ImportError:
+    BaseModel = None
+
+
+class NullStreamWriter:
+    """StreamWriter, который ничего не отправляет в сеть."""
+
+    def __init__(self) -> None:
+        # Сколько раз данные передавались в транспорт.
+        self.calls: int = 0
+
+    def get_extra_info(self, name: str) -> tuple[str, int]:
+        return ('127.0.0.1', 0)
+
+    def write(self, data: bytes) -> None:
+        self.calls += 1
+
+    def writelines(self, data: list[bytes]) -> None:
+        self.calls += 1
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def measure(
+        fan_out: Callable[[list[Connection], Message], None],
+        connections: list[Connection],
+        message: Message,
+) -> tuple[float, int]:
+    """Время одной рассылки и объём памяти, выделенной под неё."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    fan_out(connections, message)
+    elapsed = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for connection in connections:
+        connection._queue.clear()
+    return elapsed, allocated
+
+
+def fan_out_per_recipient(
+        connections: list[Connection],
+        message: Message
+) -> None:
+    """Старый путь: форматирование и кодирование для каждого получателя."""
+    for connection in connections:
+        connection.write(
+            general_chat_new_message.format(
+                message.text, message.sender
+            ).encode()
+        )
+
+
+def fan_out_rendered_once(
+        connections: list[Connection],
+        message: Message
+) -> None:
+    """Новый путь: один кадр на сообщение для всех получателей."""
+    payload = render_general_message(message)
+    for connection in connections:
+        connection.write(payload)
+
+
+async def bench_broadcast(args: argparse.Namespace) -> None:
+    connections = [
+        Connection(NullStreamWriter()) for _ in range(args.connections)
+    ]
+    message = Message(sender='benchmark', text='x' * args.message_size)
+    print(f'Рассылка на {args.connections} соединений, '
+          f'{args.rounds} повторов:')
+    for name, fan_out in (
+            ('per-recipient encode', fan_out_per_recipient),
+            ('rendered once', fan_out_rendered_once),
+    ):
+        results = [
+            measure(fan_out, connections, message)
+            for _ in range(args.rounds)
+        ]
+        best_time = min(elapsed for elapsed, _ in results)
+        allocated = min(memory for _, memory in results)
+        print(f'  {name:<22} {best_time * 1000:8.2f} ms '
+              f'{allocated / 1024:10.1f} KiB')
+    for connection in connections:
+        connection.close()
+
+
+async def measure_coalescing(
+        coalesce_bytes: int,
+        frames: int,
+        burst: int,
+        frame: bytes
+) -> tuple[float, int]:
+    """Время отправки кадров пачками по burst и число записей в транспорт."""
+    writer = NullStreamWriter()
+    connection = Connection(
+        writer, max_queue=frames, coalesce_bytes=coalesce_bytes
+    )
+    started = time.perf_counter()
+    for sent in range(0, frames, burst):
+        for _ in range(min(burst, frames - sent)):
+            connection.write(frame)
+        # Даём задаче записи отработать, как между итерациями цикла.
+        await asyncio.sleep(0)
+    await connection.drain()
+    elapsed = time.perf_counter() - started
+    connection.close()
+    return elapsed, writer.calls
+
+
+async def bench_coalesce(args: argparse.Namespace) -> None:
+    frame = b'x' * args.frame_size + b'\n'
+    print(f'Отправка {args.frames} кадров по {args.burst} '
+          f'за итерацию цикла:')
+    for name, coalesce_bytes in (
+            ('frame per write', 1),
+            ('coalesced', WRITE_COALESCE_BYTES),
+    ):
+        elapsed, calls = await measure_coalescing(
+            coalesce_bytes, args.frames, args.burst, frame
+        )
+        print(f'  {name:<22} {elapsed * 1000:8.2f} ms '
+              f'{calls:8} writes {args.frames / calls:8.1f} frames/write')
+
+
+async def loop_workload(args: argparse.Namespace) -> tuple[float, float]:
+    """
+    Скорость приёма соединений и доставки рассылок в текущем цикле.
+
+    Сервер принимает args.connections соединений с localhost, затем
+    рассылает всем им args.messages сообщений через Connection, как
+    в общем чате. Возвращает соединений в секунду и доставок в секунду.
+    """
+    connections: list[Connection] = []
+    accepted = asyncio.Event()
+
+    async def accept(reader: asyncio.StreamReader, writer) -> None:
+        connections.append(Connection(writer, max_queue=args.messages))
+        if len(connections) == args.connections:
+            accepted.set()
+        await reader.read()
+
+    server = await asyncio.start_server(
+        accept, '127.0.0.1', 0, backlog=args.connect_batch
+    )
+    port = server.sockets[0].getsockname()[1]
+
+    started = time.perf_counter()
+    clients = []
+    for _ in range(0, args.connections, args.connect_batch):
+        batch = min(args.connect_batch, args.connections - len(clients))
+        clients.extend(await asyncio.gather(*(
+            asyncio.open_connection('127.0.0.1', port) for _ in range(batch)
+        )))
+    await accepted.wait()
+    accept_rate = args.connections / (time.perf_counter() - started)
+
+    payload = render_general_message(
+        Message(sender='benchmark', text='x' * args.message_size)
+    )
+    expected = len(payload) * args.messages
+    started = time.perf_counter()
+    readers = [
+        asyncio.create_task(reader.readexactly(expected))
+        for reader, _ in clients
+    ]
+    for _ in range(args.messages):
+        for connection in connections:
+            connection.write(payload)
+        await asyncio.sleep(0)
+    await asyncio.gather(*readers)
+    delivery_rate = (
+        args.messages * args.connections / (time.perf_counter() - started)
+    )
+
+    for connection in connections:
+        connection.close()
+    for _, writer in clients:
+        writer.close()
+    server.close()
+    await server.wait_closed()
+    return accept_rate, delivery_rate
+
+
+def bench_loops(args: argparse.Namespace) -> None:
+    available = available_loops()
+    missing = [name for name in LOOP_FACTORIES if name not in available]
+    if missing:
+        print(f'Не установлены: {", ".join(missing)}, сравнение неполное.')
+    print(f'{args.connections} соединений, рассылка {args.messages} '
+          f'сообщений каждому:')
+    for name in available:
+        accept_rate, delivery_rate = run(loop_workload(args), name)
+        print(f'  {name:<22} {accept_rate:10,.0f} conn/s '
+              f'{delivery_rate:12,.0f} deliveries/s')
+
+
+async def bench_wire(args: argparse.Namespace) -> None:
+    messages = [
+        Message(sender=f'user{number % 100}', text='x' * args.message_size)
+        for number in range(args.messages)
+    ]
+    entries = list(enumerate(messages))
+    encoders = [
+        # Прежний ответ на /sign_in: repr списка сообщений в шаблоне.
+        ('list repr', lambda: f'Успешная авторизация.\n{messages}\n'.encode()),
+        *(
+            (name, lambda wire=wire: wire.general(entries))
+            for name, wire in WIRE_FORMATS.items()
+        ),
+    ]
+    print(f'Кодирование {args.messages} сообщений общего чата при входе:')
+    for name, encode in encoders:
+        best_time = float('inf')
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            payload = encode()
+            best_time = min(best_time, time.perf_counter() - started)
+        print(f'  {name:<22} {best_time * 1_000_000 / args.messages:8.3f} '
+              f'us/msg {len(payload) / args.messages:8.1f} B/msg')
+
+
+def pydantic_message_model() -> Optional[type]:
+    """Прежняя модель сообщения на pydantic, если он установлен."""
+    if BaseModel is None:
+        return None
+
+    class PydanticMessage(BaseModel):
+        sender: str
+        text: str
+
+    return PydanticMessage
+
+
+def measure_messages(model: type, count: int) -> tuple[float, float]:
+    """Сообщений в секунду и байт памяти на одно хранимое сообщение."""
+    texts = [f'message {number}' for number in range(count)]
+    tracemalloc.start()
+    started = time.perf_counter()
+    stored = [model(sender='benchmark', text=text) for text in texts]
+    elapsed = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del stored
+    return count / elapsed, allocated / count
+
+
+async def bench_models(args: argparse.Namespace) -> None:
+    models = [('slotted Message', Message)]
+    pydantic_model = pydantic_message_model()
+    if pydantic_model is None:
+        # pydantic убран из requirements.txt вместе с прежними моделями,
+        # поэтому для сравнения его нужно установить отдельно.
+        print('Сравнение с прежней моделью на pydantic пропущено: pydantic '
+              'больше не входит в requirements.txt и не установлен. '
+              'Установите его (pip install pydantic), чтобы повторить '
+              'сравнение.')
+    else:
+        models.insert(0, ('pydantic BaseModel', pydantic_model))
+
+    print(f'Создание и хранение {args.messages} сообщений:')
+    for name, model in models:
+        rate, size = measure_messages(model, args.messages)
+        print(f'  {name:<22} {rate:12,.0f} msg/s {size:8.1f} B/msg')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    broadcast = subparsers.add_parser(
+        'broadcast', help='Стоимость одной рассылки в общий чат.'
+    )
+    broadcast.add_argument('--connections', type=int, default=10_000)
+    broadcast.add_argument('--rounds', type=int, default=5)
+    broadcast.add_argument('--message-size', type=int, default=100)
+    broadcast.set_defaults(handler=bench_broadcast)
+
+    models = subparsers.add_parser(
+        'models', help='Стоимость создания и хранения сообщений.'
+    )
+    models.add_argument('--messages', type=int, default=100_000)
+    models.set_defaults(handler=bench_models)
+
+    coalesce = subparsers.add_parser(
+        'coalesce', help='Склейка мелких кадров в одну запись в сокет.'
+    )
+    coalesce.add_argument('--frames', type=int, default=100_000)
+    coalesce.add_argument('--burst', type=int, default=50)
+    coalesce.add_argument('--frame-size', type=int, default=60)
+    coalesce.set_defaults(handler=bench_coalesce)
+
+    loops = subparsers.add_parser(
+        'loops', help='Сравнение реализаций цикла событий.'
+    )
+    loops.add_argument('--connections', type=int, default=1000)
+    loops.add_argument('--connect-batch', type=int, default=200)
+    loops.add_argument('--messages', type=int, default=100)
+    loops.add_argument('--message-size', type=int, default=100)
+    loops.set_defaults(handler=bench_loops)
+
+    wire = subparsers.add_parser(
+        'wire', help='Кодирование истории общего чата в форматах протокола.'
+    )
+    wire.add_argument('--messages', type=int, default=1000)
+    wire.add_argument('--rounds', type=int, default=20)
+    wire.add_argument('--message-size', type=int, default=20)
+    wire.set_defaults(handler=bench_wire)
+
+    args = parser.parse_args()
+    if asyncio.iscoroutinefunction(args.handler):
+        asyncio.run(args.handler(args))
+    else:
+        # Обработчик сам запускает нужные ему циклы событий.
+        args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
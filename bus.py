@@ -0,0 +1,213 @@
+import asyncio
+import json
+from asyncio.streams import StreamReader, StreamWriter
+from typing import Any, Callable, Optional
+
+from connection import Connection
+from custom_logger import logger
+from config import BUS_SOCKET_PATH, BUS_QUEUE_SIZE, DATA_DIR, MAX_FRAME_SIZE
+from config import SlowConsumerPolicy
+from messages_templates import (
+    bus_event_failed,
+    bus_hub_started,
+    bus_worker_connected,
+    bus_worker_disconnected,
+    bus_connection_lost,
+)
+from protocol import FRAME_DELIMITER, encode_frame, read_frame
+
+# Кадр шины может содержать команду клиента целиком плюс служебные поля.
+BUS_FRAME_SIZE = 2 * MAX_FRAME_SIZE
+# Сообщение, которым хаб сообщает, что все процессы подключились.
+READY_MESSAGE = json.dumps({'ready': True}).encode()
+
+Apply = Callable[[dict, Optional[Connection]], Any]
+# Функция, возвращающая события с состоянием пользователей, для которых
+# переданная ей функция возвращает True (EventHandlers.sync_events).
+Snapshot = Callable[[Callable[[str], bool]], list[dict]]
+
+
+class LocalBus:
+    """
+    Шина одного процесса: событие сразу применяется к состоянию сервера.
+
+    Функцию, применяющую событие (EventHandlers.apply), и функцию,
+    снимающую состояние пользователей, сервер подключает методом attach().
+    """
+
+    # Ведущий процесс выполняет действия, которые должны произойти
+    # ровно один раз на весь сервер (например, пишет на диск).
+    is_leader: bool = True
+    # Слушают ли несколько процессов один и тот же порт.
+    reuse_port: bool = False
+    # Каталог данных бэкенда хранения этого процесса.
+    data_dir: str = DATA_DIR
+
+    def __init__(self) -> None:
+        self.apply: Optional[Apply] = None
+        self.snapshot: Optional[Snapshot] = None
+
+    def attach(
+            self,
+            apply: Apply,
+            snapshot: Optional[Snapshot] = None
+    ) -> None:
+        self.apply = apply
+        self.snapshot = snapshot
+
+    def is_owner(self, username: str) -> bool:
+        """Отвечает ли этот процесс за действия от имени пользователя."""
+        return self.is_leader
+
+    async def start(self) -> None:
+        """Подключение к шине."""
+
+    async def publish(
+            self,
+            event: dict,
+            writer: Optional[Connection] = None
+    ) -> Any:
+        """
+        Публикация события. Возвращает результат его применения
+        в этом процессе.
+        """
+        return self.apply(event, writer)
+
+    async def wait_closed(self) -> None:
+        """Ожидание разрыва связи с шиной."""
+        await asyncio.Future()
+
+    async def close(self) -> None:
+        """Отключение от шины."""
+
+
+class WorkerBus(LocalBus):
+    """
+    Шина рабочего процесса в многопроцессном режиме.
+
+    События отправляются хабу (BusHub) через Unix-сокет, хаб рассылает
+    их всем процессам, включая отправителя, в едином порядке. Процесс
+    применяет к своему состоянию только события, пришедшие от хаба,
+    поэтому состояние всех процессов совпадает, а publish() завершается,
+    когда событие вернулось от хаба и применено локально.
+    """
+
+    reuse_port = True
+
+    def __init__(self, worker_id: int, path: str = BUS_SOCKET_PATH) -> None:
+        super().__init__()
+        self.worker_id: int = worker_id
+        self.is_leader = worker_id == 0
+        self.path: str = path
+        self._next_event_id: int = 0
+        # {id события: (ожидающий future, соединение клиента)}
+        self._pending: dict[int, tuple[asyncio.Future, Optional[Connection]]] = {}
+        self._connection: Optional[Connection] = None
+        self._listen_task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        reader, writer = await asyncio.open_unix_connection(
+            self.path, limit=BUS_FRAME_SIZE
+        )
+        self._connection = Connection(
+            writer, BUS_QUEUE_SIZE, SlowConsumerPolicy.DISCONNECT
+        )
+        self._connection.write(
+            encode_frame(json.dumps({'worker': self.worker_id}))
+        )
+        # Обслуживать клиентов можно только после того, как к хабу
+        # подключились все процессы, иначе часть событий потеряется.
+        while (frame := await read_frame(reader)) != READY_MESSAGE:
+            if frame is None:
+                raise ConnectionError(bus_connection_lost % self.path)
+        self._listen_task = asyncio.create_task(self._listen(reader))
+
+    async def publish(
+            self,
+            event: dict,
+            writer: Optional[Connection] = None
+    ) -> Any:
+        event_id = self._next_event_id
+        self._next_event_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[event_id] = (future, writer)
+        self._connection.write(encode_frame(json.dumps(
+            {'origin': self.worker_id, 'id': event_id, 'event': event}
+        )))
+        return await future
+
+    async def _listen(self, reader: StreamReader) -> None:
+        """Применение событий, пришедших от хаба."""
+        while (frame := await read_frame(reader)) is not None:
+            envelope = json.loads(frame)
+            event = envelope['event']
+            if envelope['origin'] != self.worker_id:
+                try:
+                    self.apply(event, None)
+                except Exception:
+                    logger.exception(bus_event_failed, event)
+                continue
+
+            future, writer = self._pending.pop(envelope['id'])
+            try:
+                future.set_result(self.apply(event, writer))
+            except Exception as error:
+                future.set_exception(error)
+        logger.error(bus_connection_lost, self.path)
+
+    async def wait_closed(self) -> None:
+        await self._listen_task
+
+    async def close(self) -> None:
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        if self._connection is not None:
+            self._connection.close()
+
+
+class BusHub:
+    """
+    Хаб шины, работающий в родительском процессе.
+
+    Принимает подключения рабочих процессов и пересылает каждое
+    полученное событие всем процессам в порядке поступления. Пока
+    не подключатся все workers процессов, события не принимаются.
+    """
+
+    def __init__(self, workers: int, path: str = BUS_SOCKET_PATH) -> None:
+        self.workers: int = workers
+        self.path: str = path
+        self.links: list[Connection] = []
+
+    async def start(self) -> asyncio.AbstractServer:
+        server = await asyncio.start_unix_server(
+            self.handle_worker, self.path, limit=BUS_FRAME_SIZE
+        )
+        logger.info(bus_hub_started, self.path)
+        return server
+
+    async def handle_worker(
+            self,
+            reader: StreamReader,
+            writer: StreamWriter
+    ) -> None:
+        link = Connection(writer, BUS_QUEUE_SIZE, SlowConsumerPolicy.DISCONNECT)
+        hello = await read_frame(reader)
+        if hello is None:
+            link.close()
+            return
+        worker_id = json.loads(hello)['worker']
+        logger.info(bus_worker_connected, worker_id)
+        self.links.append(link)
+        if len(self.links) == self.workers:
+            for ready_link in self.links:
+                ready_link.write(READY_MESSAGE + FRAME_DELIMITER)
+
+        while (frame := await read_frame(reader)) is not None:
+            data = frame + FRAME_DELIMITER
+            for target in self.links:
+                target.write(data)
+
+        logger.error(bus_worker_disconnected, worker_id)
+        self.links.remove(link)
+        link.close()
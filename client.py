@@ -1,47 +1,171 @@
+import argparse
 import asyncio
+import re
 
 from aioconsole import ainput
 
-from messages_templates import help_message
+from config import MAX_RESPONSE_FRAME_SIZE
+from eventloop import run
+from messages_templates import (
+    heartbeat_ping,
+    help_message,
+    sign_in_queued,
+    wire_format_switched,
+)
+from protocol import (
+    BINARY_FORMAT,
+    FRAME_GENERAL,
+    FRAME_HISTORY,
+    FRAME_PRIVATE,
+    FRAME_TEXT,
+    TEXT_FORMAT,
+    FrameTooLarge,
+    decode_entries,
+    encode_command,
+    encode_frame,
+    parse_command,
+    read_binary_frame,
+    read_frame,
+)
+
+# Личное сообщение от сервера (шаблон private_chat_new_message):
+# номер сообщения и отправитель, которые нужны для подтверждения.
+PRIVATE_MESSAGE = re.compile(r'Личное сообщение \[(\d+)\] от (\S+): ')
+# Начало уведомления о позиции в очереди на вход.
+QUEUE_NOTICE = sign_in_queued.split('{}')[0]
+# Подписи кадров с сообщениями двоичного формата.
+FRAME_LABELS = {
+    FRAME_GENERAL: 'общий чат',
+    FRAME_PRIVATE: 'личное сообщение',
+    FRAME_HISTORY: 'история чата',
+}
 
 
 class ChatClient:
-    def __init__(self, host='127.0.0.1', port=8000):
+    def __init__(self, host='127.0.0.1', port=8000, wire_format=TEXT_FORMAT):
         self.host = host
         self.port = port
+        # Формат протокола, который клиент запрашивает при /sign_in.
+        self.wire_format = wire_format
+        # Команды и ответы переходят на двоичный формат, когда сервер
+        # подтвердит его после успешного /sign_in.
+        self.binary = False
+        # Сброшено, пока сервер не ответил на /sign_in со сменой формата:
+        # следующую команду он прочитает уже в новом формате.
+        self.sign_in_reply = None
 
     async def run(self):
+        self.sign_in_reply = asyncio.Event()
+        self.sign_in_reply.set()
         try:
             reader, writer = (
-                await asyncio.open_connection(self.host, self.port)
+                await asyncio.open_connection(
+                    self.host, self.port, limit=MAX_RESPONSE_FRAME_SIZE
+                )
             )
         except ConnectionRefusedError:
             raise SystemExit('Не получилось подключиться к серверу')
 
         print(help_message)
-        await asyncio.gather(self.listen_to_server(reader), self.write_to_server(writer))
-            
+        await asyncio.gather(self.listen_to_server(reader, writer), self.write_to_server(writer))
+
+    def send(self, writer, command):
+        if self.binary:
+            writer.write(encode_command(*parse_command(command.encode())))
+        else:
+            writer.write(encode_frame(command))
+
+    def negotiate(self, command):
+        """
+        Добавление формата протокола к /sign_in. Возвращает команду
+        и то, запрашивает ли она смену формата.
+        """
+        words = command.split()
+        if words[:1] != ['/sign_in']:
+            return command, False
+        if len(words) == 2 and self.wire_format != TEXT_FORMAT:
+            command = f'{command} {self.wire_format}'
+            words.append(self.wire_format)
+        if len(words) > 2 and words[2] in (TEXT_FORMAT, BINARY_FORMAT):
+            return command, (words[2] == BINARY_FORMAT) != self.binary
+        return command, False
+
     async def write_to_server(self, writer):
         while True:
             try:
                 if command := await ainput():
+                    await self.sign_in_reply.wait()
+                    command, switching = self.negotiate(command)
                     print(f'Отправлена команда: {command}')
-                    writer.write(f'{command}\n'.encode())
+                    self.send(writer, command)
+                    if switching:
+                        self.sign_in_reply.clear()
                     await writer.drain()
             except (ConnectionResetError, ConnectionRefusedError):
                 raise SystemExit('Соединение потеряно')
             except KeyboardInterrupt:
                 raise SystemExit('Соединение закрыто')
-    
-    async def listen_to_server(self, reader):
+
+    async def listen_to_server(self, reader, writer):
         while True:
             try:
-                data = await reader.read(4096)
-                message = data.decode().strip()
-                print(f'Получено сообщение: {message}')
-            except asyncio.IncompleteReadError:
+                if self.binary:
+                    data = await read_binary_frame(
+                        reader, MAX_RESPONSE_FRAME_SIZE
+                    )
+                else:
+                    data = await read_frame(reader)
+            except FrameTooLarge:
+                print('Получено слишком длинное сообщение, оно пропущено')
+                continue
+            if data is None:
                 raise SystemExit('Сервер отключился')
+            if not self.binary:
+                self.handle_text(data.decode(errors='replace'), writer)
+            elif data and data[0] == FRAME_TEXT:
+                self.handle_text(
+                    data[1:].decode(errors='replace').rstrip('\n'), writer
+                )
+            elif data:
+                self.handle_messages(data, writer)
+
+    def handle_text(self, message, writer):
+        print(f'Получено сообщение: {message}')
+        if private_message := PRIVATE_MESSAGE.match(message):
+            seq, sender = private_message.groups()
+            self.send(writer, f'/ack {sender} {seq}')
+        elif message + '\n' == heartbeat_ping:
+            self.send(writer, '/pong')
+            return
+        elif message + '\n' == wire_format_switched.format(BINARY_FORMAT):
+            self.binary = True
+        elif message + '\n' == wire_format_switched.format(TEXT_FORMAT):
+            self.binary = False
+        # Первый ответ на /sign_in, кроме позиции в очереди, - либо
+        # смена формата, либо отказ во входе.
+        if not message.startswith(QUEUE_NOTICE):
+            self.sign_in_reply.set()
+
+    def handle_messages(self, frame, writer):
+        label = FRAME_LABELS.get(frame[0], 'неизвестный кадр')
+        acks = {}
+        for seq, sender, text in decode_entries(frame):
+            print(f'Получено сообщение ({label}): [{seq}] {sender}: {text}')
+            acks[sender] = seq
+        # Подтверждение накопительное: достаточно последнего номера.
+        if frame[0] == FRAME_PRIVATE:
+            for sender, seq in acks.items():
+                self.send(writer, f'/ack {sender} {seq}')
+
 
 if __name__ == "__main__":
-    client = ChatClient()
-    asyncio.run(client.run())
+    parser = argparse.ArgumentParser(description='Клиент чата.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument(
+        '--format', choices=[TEXT_FORMAT, BINARY_FORMAT], default=TEXT_FORMAT,
+        help='Формат протокола, запрашиваемый при /sign_in.'
+    )
+    args = parser.parse_args()
+    client = ChatClient(args.host, args.port, args.format)
+    run(client.run())
@@ -0,0 +1,311 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import uuid
+from asyncio.streams import StreamReader, StreamWriter
+from collections import Counter, OrderedDict
+from typing import Any, Iterable, Optional
+
+from bus import BUS_FRAME_SIZE, LocalBus
+from connection import Connection
+from custom_logger import logger
+from config import (
+    BUS_QUEUE_SIZE,
+    CLUSTER_DEDUP_WINDOW,
+    CLUSTER_RECONNECT_DELAY,
+    CLUSTER_RING_REPLICAS,
+    DATA_DIR,
+)
+from config import SlowConsumerPolicy, make_chat_id
+from messages_templates import (
+    bus_event_failed,
+    cluster_node_started,
+    cluster_peer_up,
+    cluster_peer_down,
+)
+from protocol import encode_frame, read_frame
+
+# Ключ кольца, владелец которого упорядочивает сообщения общего чата.
+GENERAL_CHAT_KEY = '#general'
+
+
+class HashRing:
+    """
+    Консистентное хеширование ключей на узлы кластера.
+
+    Каждый узел занимает на кольце replicas виртуальных точек, ключ
+    принадлежит узлу первой точки по часовой стрелке. При добавлении
+    или удалении узла меняют владельца только ключи соседних с ним
+    участков кольца.
+    """
+
+    def __init__(
+            self,
+            nodes: Iterable[str],
+            replicas: int = CLUSTER_RING_REPLICAS
+    ) -> None:
+        self.replicas: int = replicas
+        self.nodes: frozenset[str] = frozenset(nodes)
+        points = sorted(
+            (self._hash(f'{node}#{replica}'), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes: list[int] = [point for point, _ in points]
+        self._owners: list[str] = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def owner(self, key: str) -> str:
+        """Узел, которому принадлежит ключ."""
+        index = bisect.bisect(self._hashes, self._hash(key))
+        return self._owners[index % len(self._owners)]
+
+
+def routing_key(event: dict) -> str:
+    """
+    Ключ кольца, по которому выбирается узел, упорядочивающий событие.
+
+    Сообщения общего чата упорядочивает один узел, личные - владелец
+    чата, жалобы - владелец того, на кого жалуются (жалобы разных
+    пользователей на одного должны применяться в одном порядке),
+    остальные события - владелец пользователя.
+    """
+    if event['type'] == 'general':
+        return GENERAL_CHAT_KEY
+    if event['type'] == 'private':
+        return '\x1f'.join(make_chat_id(event['sender'], event['target']))
+    if event['type'] == 'report':
+        return event['target']
+    return event.get('username') or event['sender']
+
+
+class ClusterBus(LocalBus):
+    """
+    Шина узла в кластере из нескольких серверов.
+
+    Для каждого события по консистентному хешу его ключа выбирается
+    узел-владелец. Владелец применяет событие у себя и рассылает его
+    остальным узлам, поэтому события одного пользователя или чата
+    применяются на всех узлах в одном порядке, а каждый узел держит
+    свою реплику пользователей, хвоста общего чата и личных чатов.
+
+    Опубликованное событие хранится у отправителя, пока оно не
+    вернётся от владельца применённым. Когда меняется состав кластера,
+    все такие события заново отправляются актуальным владельцам,
+    а повторы отбрасываются по (узел, id события).
+
+    Узел входит в кольцо, только когда открыты оба канала - к нему
+    и от него: владелец возвращает применённые события по своему
+    исходящему каналу, и без него отправитель ждал бы ответа до
+    следующей смены состава кластера.
+
+    Узел, подключившийся позже остальных, не видел прошлых событий,
+    поэтому, когда он входит в кольцо, каждый узел передаёт ему
+    пользователей, за которых отвечал до этого (событиями sync).
+    История чатов не передаётся.
+    """
+
+    def __init__(
+            self,
+            node_id: str,
+            address: tuple[str, int],
+            peers: dict[str, tuple[str, int]]
+    ) -> None:
+        super().__init__()
+        self.node_id: str = node_id
+        self.address: tuple[str, int] = address
+        self.peers: dict[str, tuple[str, int]] = peers
+        self.data_dir = os.path.join(DATA_DIR, node_id)
+        # Исходящие каналы к доступным узлам.
+        self.links: dict[str, Connection] = {}
+        # Число открытых входящих каналов от каждого узла.
+        self._inbound: Counter[str] = Counter()
+        self.ring: HashRing = HashRing([node_id])
+        # Перезапущенный узел начинает нумерацию событий заново,
+        # поэтому id события включает случайный номер запуска.
+        self._incarnation: str = uuid.uuid4().hex[:8]
+        self._next_event_id: int = 0
+        # {id события: (ожидающий future, соединение клиента, конверт)}
+        self._pending: dict[
+            str, tuple[asyncio.Future, Optional[Connection], dict]
+        ] = {}
+        self._seen: OrderedDict[tuple[str, str], None] = OrderedDict()
+        self._tasks: list[asyncio.Task] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def is_owner(self, username: str) -> bool:
+        return self.ring.owner(username) == self.node_id
+
+    async def start(self) -> None:
+        host, port = self.address
+        self._server = await asyncio.start_server(
+            self.handle_peer, host, port, limit=BUS_FRAME_SIZE
+        )
+        logger.info(cluster_node_started, self.node_id, host, port)
+        self._tasks = [
+            asyncio.create_task(self._maintain_link(peer))
+            for peer in self.peers
+        ]
+
+    def _update_ring(self) -> None:
+        """
+        Пересчёт кольца, повторная отправка неподтверждённых событий
+        и передача состояния узлам, вошедшим в кольцо.
+        """
+        ring = self.ring
+        self.ring = HashRing([
+            self.node_id,
+            *(peer for peer in self.links if self._inbound[peer])
+        ])
+        if self.ring.nodes == ring.nodes:
+            return
+        for _, _, envelope in list(self._pending.values()):
+            self._route(envelope)
+        for peer in self.ring.nodes - ring.nodes:
+            self._send_state(peer, ring)
+
+    async def _maintain_link(self, peer: str) -> None:
+        """Поддержание исходящего канала к узлу с переподключением."""
+        host, port = self.peers[peer]
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(CLUSTER_RECONNECT_DELAY)
+                continue
+
+            link = Connection(
+                writer, BUS_QUEUE_SIZE, SlowConsumerPolicy.DISCONNECT
+            )
+            link.write(encode_frame(json.dumps({'node': self.node_id})))
+            self.links[peer] = link
+            logger.info(cluster_peer_up, peer)
+            self._update_ring()
+
+            # По исходящему каналу ничего не приходит: чтение лишь
+            # сообщает о его закрытии.
+            await reader.read()
+            del self.links[peer]
+            link.close()
+            logger.warning(cluster_peer_down, peer)
+            self._update_ring()
+            await asyncio.sleep(CLUSTER_RECONNECT_DELAY)
+
+    def _send_state(self, peer: str, ring: HashRing) -> None:
+        """
+        Передача узлу peer пользователей, владельцем которых этот узел
+        был на кольце ring. Пользователей, которых узел уже знает,
+        он пропускает.
+        """
+        if self.snapshot is None:
+            return
+        for event in self.snapshot(
+                lambda username: ring.owner(username) == self.node_id
+        ):
+            event_id = f'{self._incarnation}:{self._next_event_id}'
+            self._next_event_id += 1
+            self._send(peer, 'apply', {
+                'origin': self.node_id, 'id': event_id, 'event': event
+            })
+
+    async def handle_peer(
+            self,
+            reader: StreamReader,
+            writer: StreamWriter
+    ) -> None:
+        """Приём событий от другого узла."""
+        hello = await read_frame(reader)
+        if hello is None:
+            writer.close()
+            return
+        peer = json.loads(hello)['node']
+        self._inbound[peer] += 1
+        self._update_ring()
+        try:
+            while (frame := await read_frame(reader)) is not None:
+                envelope = json.loads(frame)
+                if envelope.pop('kind') == 'route':
+                    self._sequence(envelope)
+                else:
+                    self._apply_envelope(envelope)
+        finally:
+            self._inbound[peer] -= 1
+            if not self._inbound[peer]:
+                del self._inbound[peer]
+            self._update_ring()
+            writer.close()
+
+    async def publish(
+            self,
+            event: dict,
+            writer: Optional[Connection] = None
+    ) -> Any:
+        event_id = f'{self._incarnation}:{self._next_event_id}'
+        self._next_event_id += 1
+        envelope = {'origin': self.node_id, 'id': event_id, 'event': event}
+        future = asyncio.get_running_loop().create_future()
+        self._pending[event_id] = (future, writer, envelope)
+        self._route(envelope)
+        return await future
+
+    def _route(self, envelope: dict) -> None:
+        """Отправка события узлу-владельцу."""
+        owner = self.ring.owner(routing_key(envelope['event']))
+        if owner == self.node_id:
+            self._sequence(envelope)
+        else:
+            self._send(owner, 'route', envelope)
+
+    def _send(self, peer: str, kind: str, envelope: dict) -> None:
+        self.links[peer].write(
+            encode_frame(json.dumps({'kind': kind, **envelope}))
+        )
+
+    def _sequence(self, envelope: dict) -> None:
+        """Применение события владельцем и рассылка остальным узлам."""
+        if not self._apply_envelope(envelope):
+            return
+        for peer in self.links:
+            self._send(peer, 'apply', envelope)
+
+    def _apply_envelope(self, envelope: dict) -> bool:
+        """
+        Применение события к локальному состоянию.
+
+        Возвращает False, если событие уже было применено.
+        """
+        key = (envelope['origin'], envelope['id'])
+        if key in self._seen:
+            return False
+        self._seen[key] = None
+        if len(self._seen) > CLUSTER_DEDUP_WINDOW:
+            self._seen.popitem(last=False)
+
+        pending = None
+        if envelope['origin'] == self.node_id:
+            pending = self._pending.pop(envelope['id'], None)
+        writer = pending[1] if pending else None
+        try:
+            result = self.apply(envelope['event'], writer)
+        except Exception as error:
+            if pending:
+                pending[0].set_exception(error)
+            else:
+                logger.exception(bus_event_failed, envelope['event'])
+            return True
+        if pending:
+            pending[0].set_result(result)
+        return True
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for link in self.links.values():
+            link.close()
+        if self._server is not None:
+            self._server.close()
@@ -1,7 +1,11 @@
-from asyncio import StreamWriter
+import asyncio
+import sys
+import time
 from enum import Enum
+from typing import TYPE_CHECKING, NamedTuple, Optional
 
-from pydantic import BaseModel
+if TYPE_CHECKING:
+    from connection import Connection
 
 # Время бана в секундах.
 BAN_TIME = 4 * 3600
@@ -12,6 +16,159 @@ MAX_REPORTS = 3
 IP_ADDR = '127.0.0.1'
 # Порт, на котором необходимо запустить сервер.
 PORT = 8000
+# Реализация цикла событий: 'auto' - uvloop, если он установлен,
+# иначе стандартный asyncio; 'uvloop' или 'asyncio' - конкретная.
+EVENT_LOOP = 'auto'
+# Сколько последних сообщений общего чата хранится на сервере.
+GENERAL_CHAT_RETENTION = 1000
+# Сколько секунд хранится сообщение общего чата (None - без ограничения).
+GENERAL_CHAT_MAX_AGE: Optional[float] = None
+# Предельный объём сообщений общего чата в памяти в байтах
+# (None - без ограничения).
+GENERAL_CHAT_MAX_BYTES: Optional[int] = None
+# Сколько последних сообщений каждого личного чата хранится в памяти
+# (None - без ограничения). Более старые остаются только в хранилище.
+PRIVATE_CHAT_RETENTION: Optional[int] = 10_000
+# Сколько секунд хранится сообщение личного чата (None - без ограничения).
+PRIVATE_CHAT_MAX_AGE: Optional[float] = None
+# Предельный объём сообщений одного личного чата в памяти в байтах
+# (None - без ограничения).
+PRIVATE_CHAT_MAX_BYTES: Optional[int] = None
+# Через сколько секунд после выхода данные пользователя вытесняются
+# из памяти в хранилище (None - не вытесняются). Работает только
+# с бэкендом хранения 'log'.
+USER_IDLE_TIME: Optional[float] = 30 * 24 * 3600
+# Интервал проверки возраста сообщений и неактивных пользователей
+# в секундах.
+RETENTION_SWEEP_INTERVAL = 60
+# Сколько последних сообщений общего чата получает новый пользователь.
+GENERAL_CHAT_ON_REGISTRATION = 20
+# Максимальное количество кадров в исходящей очереди одного клиента.
+OUTBOUND_QUEUE_SIZE = 1000
+# Сколько байтов исходящей очереди отправляется в сокет одной записью.
+WRITE_COALESCE_BYTES = 64 * 1024
+# Сколько секунд копить кадры перед записью, если их меньше
+# WRITE_COALESCE_BYTES (0 - только кадры одной итерации цикла событий).
+WRITE_COALESCE_DELAY = 0.0
+# Максимальный размер одной команды от клиента в байтах.
+MAX_FRAME_SIZE = 64 * 1024
+# Максимальный размер одной строки ответа сервера, которую примет клиент.
+MAX_RESPONSE_FRAME_SIZE = 16 * 1024 * 1024
+# Бэкенд хранения: 'memory' - только в памяти, 'log' - журнал на диске.
+STORAGE_BACKEND = 'memory'
+# Каталог с данными бэкенда 'log'.
+DATA_DIR = 'data'
+# Размер сегмента журнала в байтах, после которого начинается новый сегмент.
+SEGMENT_SIZE = 64 * 1024 * 1024
+# Интервал группового сброса изменений на диск в секундах.
+GROUP_COMMIT_INTERVAL = 0.05
+# Через сколько новых записей журнала личных чатов на диск сохраняется
+# число сообщений каждого чата: при старте читается только хвост журнала,
+# нужный для хранения в памяти.
+PRIVATE_CHAT_INDEX_INTERVAL = 100_000
+# Через сколько записей журнала изменений пользователей их состояние
+# целиком сохраняется в users.json, а журнал начинается заново.
+USERS_CHECKPOINT_INTERVAL = 100_000
+# Unix-сокет шины, через которую общаются рабочие процессы сервера.
+BUS_SOCKET_PATH = 'chat_bus.sock'
+# Максимальное количество неотправленных кадров в канале шины.
+BUS_QUEUE_SIZE = 100_000
+# Количество виртуальных точек каждого узла на кольце консистентного хеша.
+CLUSTER_RING_REPLICAS = 64
+# Пауза перед повторным подключением к узлу кластера в секундах.
+CLUSTER_RECONNECT_DELAY = 1.0
+# Сколько последних id событий узел помнит, чтобы отбрасывать повторы.
+CLUSTER_DEDUP_WINDOW = 100_000
+# Сколько пользователей передаётся подключившемуся узлу одним событием.
+CLUSTER_SYNC_CHUNK_SIZE = 200
+# Сколько сообщений личного чата /get_chat_with отдаёт по умолчанию.
+CHAT_PAGE_SIZE = 100
+# Максимальное количество сообщений в одной странице /get_chat_with.
+CHAT_PAGE_MAX = 1000
+# Сколько сообщений личного чата отправляется клиенту одной записью.
+CHAT_CHUNK_SIZE = 50
+# Сколько имён пользователей отправляется клиенту одной записью.
+ROSTER_CHUNK_SIZE = 500
+# Границы корзин гистограмм времени выполнения команд в секундах.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# Интервал измерения задержки цикла событий в секундах.
+LOOP_LAG_INTERVAL = 0.5
+# Адрес HTTP-порта с метриками в формате Prometheus.
+METRICS_HOST = '127.0.0.1'
+# Порт с метриками; None - порт не открывается.
+METRICS_PORT: Optional[int] = None
+# Лимиты частоты команд одного клиента:
+# {команда: (токенов в секунду, размер корзины)}, '*' - все команды.
+RATE_LIMITS: dict[str, tuple[float, float]] = {
+    '*': (20, 40),
+    '/sign_in': (1, 5),
+    '/send_all': (2, 10),
+    '/send': (5, 20),
+    '/send_delayed': (1, 10),
+    '/ack': (100, 500),
+    '/pong': (1, 5),
+}
+# Команды, которые списывают токен только из своей корзины в RATE_LIMITS,
+# а не из общей '*': клиент отправляет их сам, и они не должны
+# расходовать лимит команд пользователя.
+RATE_LIMIT_SEPARATE: frozenset[str] = frozenset({'/ack', '/pong'})
+# Через сколько секунд без команд состояние лимитов клиента удаляется.
+RATE_LIMIT_IDLE_TIME = 300
+# Сколько нарушений лимитов за окно приводит к автоматическому бану.
+RATE_LIMIT_MAX_VIOLATIONS = 100
+# Окно подсчёта нарушений лимитов в секундах.
+RATE_LIMIT_VIOLATION_WINDOW = 60
+# Сколько входов в систему (с отправкой истории) выполняется одновременно.
+SIGN_IN_MAX_CONCURRENT = 32
+# Сколько входов может ждать в очереди; остальные сразу отклоняются.
+SIGN_IN_QUEUE_SIZE = 10_000
+# Как часто ожидающему в очереди сообщается его позиция, в секундах.
+SIGN_IN_PROGRESS_INTERVAL = 2.0
+# Задержка цикла событий в секундах, выше которой вошедшие ждут
+# с отправкой истории; None - не ждать.
+SIGN_IN_MAX_LOOP_LAG: Optional[float] = 0.05
+# Сколько байтов истории может одновременно отправляться всем входящим.
+REPLAY_MAX_BYTES = 4 * 1024 * 1024
+# Сколько секунд вошедший может не вычитывать часть истории, прежде чем
+# соединение закроется, а его место входа и байты истории освободятся;
+# None - ждать без ограничения.
+REPLAY_DRAIN_TIMEOUT: Optional[float] = 90.0
+# Через сколько секунд без кадров от клиента сервер проверяет
+# соединение пингом; None - не проверять.
+HEARTBEAT_INTERVAL: Optional[float] = 30.0
+# Через сколько секунд без кадров от клиента соединение закрывается,
+# а пользователь выходит из сети; None - не закрывать.
+IDLE_TIMEOUT: Optional[float] = 90.0
+# Шаг колеса таймеров, по которому проверяются простаивающие
+# соединения, в секундах.
+HEARTBEAT_TICK = 1.0
+# Через сколько секунд тишины ядро начинает проверять TCP-соединение
+# (SO_KEEPALIVE); None - не включать keepalive.
+TCP_KEEPALIVE_IDLE: Optional[int] = 60
+# Интервал между проверками keepalive в секундах.
+TCP_KEEPALIVE_INTERVAL = 10
+# Сколько проверок keepalive без ответа разрывают соединение.
+TCP_KEEPALIVE_COUNT = 5
+# Файл журнала сервера.
+LOG_FILE = 'program.log'
+# Минимальный уровень записей журнала.
+LOG_LEVEL = 'DEBUG'
+# Формат записей: 'text' - строки для человека, 'json' - JSON-строки.
+LOG_FORMAT = 'text'
+# Писать журнал в фоновом потоке, не блокируя цикл событий.
+LOG_ASYNC = True
+# Максимальное количество записей, которые пишутся в файл за один сброс.
+LOG_BATCH_SIZE = 512
+# Размер файла журнала в байтах, после которого он ротируется (0 - без ротации).
+LOG_MAX_BYTES = 0
+# Сколько старых файлов журнала хранить при ротации.
+LOG_BACKUP_COUNT = 5
+# Доля записей горячих путей, попадающих в журнал: {имя шаблона из
+# messages_templates.py: доля от 0 до 1}, например {'get_command': 0.01}.
+LOG_SAMPLING: dict[str, float] = {}
 
 
 class Status(Enum):
@@ -26,48 +183,105 @@ class Status(Enum):
     OFFLINE = 'offline'
 
 
-class ClientAddress(BaseModel):
+class SlowConsumerPolicy(Enum):
+    """
+    Перечисление, определяющее поведение при переполнении
+    исходящей очереди клиента.
+
+    Атрибуты:
+        DROP_OLDEST: Отбросить самый старый кадр в очереди.
+        DISCONNECT: Отключить клиента.
+        COALESCE: Склеить новый кадр с последним кадром в очереди.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+    COALESCE = 'coalesce'
+
+
+# Политика для медленных клиентов, которые не успевают вычитывать сообщения.
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy.DROP_OLDEST
+
+
+class ClientAddress(NamedTuple):
     ip: str
     port: int
 
 
-class Message(BaseModel):
+class Message(NamedTuple):
     sender: str
     text: str
 
 
-class ChatID(BaseModel):
-    # ID включает в себя отсортированный кортеж из
-    # двух username'ов пользователей, между которыми ведётся чат.
-    id: tuple[str, str]
+# ID чата включает в себя отсортированный кортеж из
+# двух username'ов пользователей, между которыми ведётся чат.
+ChatID = tuple[str, str]
+
+
+def make_chat_id(first_username: str, second_username: str) -> ChatID:
+    """
+    ID личного чата двух пользователей.
+
+    Имена интернируются, поэтому ключи всех чатов ссылаются
+    на одни и те же объекты строк, а сравнение при поиске в словаре
+    чаще всего сводится к сравнению указателей.
+    """
+    first_username = sys.intern(first_username)
+    second_username = sys.intern(second_username)
+    if first_username <= second_username:
+        return (first_username, second_username)
+    return (second_username, first_username)
+
+
+def to_wall_time(loop_time: float) -> float:
+    """
+    Момент на часах цикла событий в пересчёте на настенные часы.
+
+    Часы цикла событий монотонны, но у каждого процесса свои, поэтому
+    на диск и другим узлам кластера передаётся настенное время.
+    """
+    return loop_time - asyncio.get_running_loop().time() + time.time()
+
 
+def to_loop_time(wall_time: float) -> float:
+    """Момент по настенным часам на часах текущего цикла событий."""
+    return wall_time - time.time() + asyncio.get_running_loop().time()
 
-class Report(BaseModel):
-    reported_by: list[str] = []
-    end_of_ban: int = 0
 
+class Report:
+    __slots__ = ('reported_by', 'end_of_ban')
 
-class UserInfo(BaseModel):
-    status: Status
-    client_addr: ClientAddress
-    # Непрочитанные сообщения из общего чата.
-    unread_messages: list[Message] = []
-    # Индексы последних прочитанных сообщений для каждого чата.
-    last_read: dict[ChatID, int] = {}
-    reports: Report
-    writer: StreamWriter
+    def __init__(self) -> None:
+        self.reported_by: list[str] = []
+        self.end_of_ban: float = 0
 
-    class Config:
-        # arbitrary_types_allowed=True в конфигурации модели,
-        # разрешает использовать произвольные (нестандартные) типы 
-        # в вашей модели. 
-        # Это означает, что Pydantic не будет пытаться валидировать или 
-        # преобразовывать эти типы, а просто принимать их как есть.
 
-        # Настройка arbitrary_types_allowed = True влияет только на те поля, 
-        # которые используют нестандартные типы, которые Pydantic не может 
-        # обработать автоматически. 
-        # Это не отключает валидацию и преобразование для стандартных полей, 
-        # которые Pydantic может обрабатывать. 
-        arbitrary_types_allowed = True
+class UserInfo:
+    __slots__ = (
+        'status',
+        'client_addr',
+        'general_chat_cursor',
+        'last_read',
+        'reports',
+        'writer',
+        'last_seen',
+    )
 
+    def __init__(
+            self,
+            status: Status,
+            client_addr: ClientAddress,
+            reports: Report,
+            writer: Optional['Connection']
+    ) -> None:
+        self.status: Status = status
+        self.client_addr: ClientAddress = client_addr
+        # seq первого непрочитанного сообщения общего чата.
+        self.general_chat_cursor: int = 0
+        # Индексы последних прочитанных сообщений для каждого чата.
+        self.last_read: dict[ChatID, int] = {}
+        self.reports: Report = reports
+        # Исходящий канал клиента. None у пользователей, восстановленных
+        # из хранилища и ещё не входивших после перезапуска.
+        self.writer: Optional['Connection'] = writer
+        # Время последнего выхода из системы по настенным часам.
+        self.last_seen: float = 0
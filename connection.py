@@ -0,0 +1,204 @@
+import asyncio
+from asyncio import StreamWriter
+from collections import deque
+from typing import Optional
+
+from custom_logger import logger
+from config import (
+    OUTBOUND_QUEUE_SIZE,
+    SLOW_CONSUMER_POLICY,
+    WRITE_COALESCE_BYTES,
+    WRITE_COALESCE_DELAY,
+)
+from config import SlowConsumerPolicy
+from rendering import TEXT_WIRE, TextWire
+from messages_templates import slow_consumer_dropped, slow_consumer_disconnected
+
+
+class OutboundTotals:
+    """
+    Счётчики исходящих очередей группы соединений за всё время работы.
+
+    В отличие от счётчиков самого соединения, они не пропадают, когда
+    соединение закрывается, поэтому подходят для метрик-счётчиков.
+    """
+
+    __slots__ = ('dropped', 'frames_sent', 'writes')
+
+    def __init__(self) -> None:
+        self.dropped: int = 0
+        self.frames_sent: int = 0
+        self.writes: int = 0
+
+
+# Общие счётчики соединений, которые ни с кем не делят свою статистику.
+UNTRACKED = OutboundTotals()
+
+
+class Connection:
+    """
+    Исходящий канал одного клиента.
+
+    Все ответы и рассылки не пишутся в сокет напрямую, а попадают
+    в ограниченную очередь уже закодированных байтов. Отдельная задача
+    вычитывает очередь и ждёт drain(), поэтому медленный клиент
+    не задерживает ни отправителя, ни остальных получателей.
+    Что делать при переполнении очереди, определяет SlowConsumerPolicy.
+
+    Кадры, накопившиеся за итерацию цикла событий (или за
+    coalesce_delay секунд), уходят в сокет одним вызовом writelines
+    пачками до coalesce_bytes байтов: на много мелких ответов
+    приходится один системный вызов.
+
+    wire - формат протокола, выбранный клиентом: write() принимает
+    текстовый ответ и кодирует его в этот формат, а write_frame()
+    принимает кадр, уже закодированный через self.wire.
+
+    Задача отправки создаётся, только когда в очереди появляются
+    кадры, и завершается, когда очередь отправлена: у простаивающего
+    соединения нет ни задачи, ни событий, а атрибуты хранятся
+    в __slots__, поэтому его стоимость в памяти мала и постоянна.
+
+    Счётчики соединения дублируются в totals - общих счётчиках
+    всех соединений сервера.
+    """
+
+    __slots__ = (
+        'writer', 'peername', 'max_queue', 'policy', 'coalesce_bytes',
+        'coalesce_delay', 'dropped', 'frames_sent', 'writes', 'closed',
+        'wire', 'last_activity', 'busy', 'totals', '_queue', '_queued_bytes',
+        '_task',
+    )
+
+    def __init__(
+            self,
+            writer: StreamWriter,
+            max_queue: int = OUTBOUND_QUEUE_SIZE,
+            policy: SlowConsumerPolicy = SLOW_CONSUMER_POLICY,
+            coalesce_bytes: int = WRITE_COALESCE_BYTES,
+            coalesce_delay: float = WRITE_COALESCE_DELAY,
+            totals: OutboundTotals = UNTRACKED
+    ) -> None:
+        self.writer: StreamWriter = writer
+        self.peername = writer.get_extra_info('peername')
+        self.max_queue: int = max_queue
+        self.policy: SlowConsumerPolicy = policy
+        self.coalesce_bytes: int = coalesce_bytes
+        self.coalesce_delay: float = coalesce_delay
+        # Сколько раз очередь переполнялась и данные были отброшены
+        # или склеены.
+        self.dropped: int = 0
+        # Сколько кадров отправлено и сколькими записями в сокет.
+        self.frames_sent: int = 0
+        self.writes: int = 0
+        self.closed: bool = False
+        self.wire: TextWire = TEXT_WIRE
+        # Время последнего кадра от клиента по часам цикла событий
+        # и выполняется ли сейчас его команда (см. heartbeat.py).
+        self.last_activity: float = asyncio.get_running_loop().time()
+        self.busy: bool = False
+        self.totals: OutboundTotals = totals
+        self._queue: deque[bytes] = deque()
+        self._queued_bytes: int = 0
+        # Задача отправки; None - очередь пуста и всё отправлено в сокет.
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Количество кадров, ожидающих отправки."""
+        return len(self._queue)
+
+    def write(self, data: bytes) -> None:
+        """Постановка текстового ответа в очередь на отправку."""
+        self.write_frame(self.wire.text(data))
+
+    def write_frame(self, data: bytes) -> None:
+        """Постановка кадра в очередь на отправку. Не блокирует."""
+        if self.closed:
+            return
+
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            self.totals.dropped += 1
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                logger.warning(slow_consumer_disconnected, self.peername)
+                self.close()
+                return
+            if self.policy == SlowConsumerPolicy.COALESCE:
+                # Склеиваем новый кадр с последним в очереди: число
+                # кадров не растёт, а клиент получит всё одной записью.
+                self._queue[-1] += data
+                self._queued_bytes += len(data)
+                return
+            logger.warning(slow_consumer_dropped, self.peername)
+            self._queued_bytes -= len(self._queue.popleft())
+
+        self._queue.append(data)
+        self._queued_bytes += len(data)
+        if self._task is None:
+            self._task = asyncio.create_task(self._write_loop())
+
+    async def drain(self) -> None:
+        """
+        Ожидание отправки всех кадров из очереди.
+
+        Позволяет отдавать большой ответ частями, не переполняя очередь.
+
+        Пока команда ждёт здесь, соединение не считается занятым:
+        если клиент не вычитывает данные, оно закроется через
+        IDLE_TIMEOUT секунд от начала ожидания (см. heartbeat.py).
+        """
+        if self._task is None:
+            return
+        busy = self.busy
+        if busy:
+            # До этого момента команда выполнялась, а не ждала клиента.
+            self.last_activity = asyncio.get_running_loop().time()
+            self.busy = False
+        try:
+            while self._task is not None:
+                # wait, а не await задачи: отмена drain() не отменяет
+                # отправку.
+                await asyncio.wait({self._task})
+        finally:
+            self.busy = busy
+
+    async def _write_loop(self) -> None:
+        """Отправка кадров из очереди с учётом обратного давления."""
+        try:
+            if (self.coalesce_delay
+                    and self._queued_bytes < self.coalesce_bytes):
+                await asyncio.sleep(self.coalesce_delay)
+            while self._queue:
+                self.writer.writelines(self._take_batch())
+                self.writes += 1
+                self.totals.writes += 1
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            self.closed = True
+        finally:
+            self._task = None
+
+    def _take_batch(self) -> list[bytes]:
+        """Кадры из начала очереди общим размером до coalesce_bytes."""
+        batch = []
+        size = 0
+        while self._queue and size < self.coalesce_bytes:
+            frame = self._queue.popleft()
+            batch.append(frame)
+            size += len(frame)
+        self._queued_bytes -= size
+        self.frames_sent += len(batch)
+        self.totals.frames_sent += len(batch)
+        return batch
+
+    def close(self) -> None:
+        """Закрытие соединения без ожидания неотправленных данных."""
+        self.closed = True
+        self._queue.clear()
+        self._queued_bytes = 0
+        if self._task is not None:
+            # Задача, отменённая до первого шага, не дойдёт до finally.
+            self._task.cancel()
+            self._task = None
+        self.writer.close()
@@ -1,10 +1,206 @@
+import atexit
+import copy
+import json
 import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
 
-# Здесь задана глобальная конфигурация для всех логгеров
-logging.basicConfig(
-    level=logging.DEBUG,
-    filename='program.log',
-    format='%(asctime)s, %(levelname)s, %(message)s'
+import messages_templates
+from config import (
+    LOG_ASYNC,
+    LOG_BACKUP_COUNT,
+    LOG_BATCH_SIZE,
+    LOG_FILE,
+    LOG_FORMAT,
+    LOG_LEVEL,
+    LOG_MAX_BYTES,
+    LOG_SAMPLING,
 )
 
+TEXT_FORMAT = '%(asctime)s, %(levelname)s, %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Компактная JSON-строка на каждую запись журнала."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': round(record.created, 6),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Выборочная запись горячих путей.
+
+    Записи, созданные по шаблону из rates, пропускаются с заданной
+    долей, остальные - всегда. Доля 0 отключает шаблон полностью.
+    """
+
+    def __init__(self, rates: dict[str, float]) -> None:
+        super().__init__()
+        self.rates: dict[str, float] = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.msg)
+        return rate is None or random.random() < rate
+
+
+class PreparedQueueHandler(QueueHandler):
+    """
+    Постановка записи в очередь без форматирования по шаблону
+    обработчика: в фоновый поток передаётся готовый текст сообщения
+    и текст исключения, а формат строки выбирает файловый обработчик.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+class BatchFileHandler(RotatingFileHandler):
+    """
+    Файловый обработчик, который сбрасывает буфер файла не после
+    каждой записи, а по команде flush_batch().
+    """
+
+    def flush(self) -> None:
+        """Сброс откладывается до конца пачки."""
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Фоновый поток, который забирает записи из очереди и пишет их
+    в файл пачками: буфер сбрасывается, когда очередь опустела
+    или в пачке набралось batch_size записей.
+    """
+
+    def __init__(
+            self,
+            log_queue: queue.Queue,
+            handler: BatchFileHandler,
+            batch_size: int
+    ) -> None:
+        super().__init__(log_queue, handler, respect_handler_level=True)
+        self.batch_size: int = batch_size
+        self._batched: int = 0
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        if self._batched >= self.batch_size or (
+                self._batched and self.queue.empty()
+        ):
+            self._flush()
+        self._batched += 1
+        return self.queue.get(block)
+
+    def _flush(self) -> None:
+        for handler in self.handlers:
+            handler.flush_batch()
+        self._batched = 0
+
+    def stop(self) -> None:
+        super().stop()
+        self._flush()
+
+
+def _create_file_handler() -> logging.Handler:
+    handler_class = BatchFileHandler if LOG_ASYNC else RotatingFileHandler
+    # Файл открывается при первой записи: рабочие процессы, которые
+    # передают записи родительскому (forward_to), его не открывают.
+    handler = handler_class(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+        delay=True
+    )
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+# Фоновый поток записи в файл в режиме LOG_ASYNC.
+_listener: Optional[BatchQueueListener] = None
+
+
+def _configure() -> None:
+    """
+    Глобальная конфигурация для всех логгеров.
+
+    В режиме LOG_ASYNC цикл событий только кладёт запись в очередь,
+    а форматирует и пишет её на диск фоновый поток.
+    """
+    global _listener
+    file_handler = _create_file_handler()
+    if LOG_ASYNC:
+        log_queue: queue.Queue = queue.Queue()
+        _listener = BatchQueueListener(log_queue, file_handler, LOG_BATCH_SIZE)
+        _listener.start()
+        atexit.register(_listener.stop)
+        handlers = [PreparedQueueHandler(log_queue)]
+    else:
+        handlers = [file_handler]
+    logging.basicConfig(level=LOG_LEVEL, handlers=handlers)
+
+
+def forward_to(log_queue: queue.Queue) -> None:
+    """
+    Передача записей этого процесса в очередь log_queue
+    (multiprocessing.Queue), которую читает listen_workers()
+    родительского процесса.
+
+    Файл журнала пишет только родительский процесс: если бы каждый
+    рабочий процесс писал его сам, они ротировали бы один файл
+    одновременно и теряли записи друг друга.
+    """
+    global _listener
+    if _listener is not None:
+        atexit.unregister(_listener.stop)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+    logging.basicConfig(
+        level=LOG_LEVEL, handlers=[PreparedQueueHandler(log_queue)],
+        force=True
+    )
+
+
+def listen_workers(log_queue: queue.Queue) -> QueueListener:
+    """
+    Запуск потока, который передаёт записи рабочих процессов
+    (см. forward_to) обработчикам этого процесса.
+    """
+    listener = QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+
+_configure()
+
 logger = logging.getLogger(__name__)
+if LOG_SAMPLING:
+    logger.addFilter(SamplingFilter({
+        getattr(messages_templates, name): rate
+        for name, rate in LOG_SAMPLING.items()
+    }))
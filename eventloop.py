@@ -0,0 +1,60 @@
+import asyncio
+import sys
+from typing import Any, Awaitable, Callable, Optional
+
+from config import EVENT_LOOP
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Выбор самой быстрой из установленных реализаций цикла событий.
+AUTO_LOOP = 'auto'
+LoopFactory = Callable[[], asyncio.AbstractEventLoop]
+
+# Реализации цикла событий: {имя: фабрика циклов, None - не установлена}.
+LOOP_FACTORIES: dict[str, Optional[LoopFactory]] = {
+    'uvloop': uvloop.new_event_loop if uvloop is not None else None,
+    'asyncio': asyncio.new_event_loop,
+}
+
+
+def available_loops() -> list[str]:
+    """Имена установленных реализаций цикла событий, от быстрой к медленной."""
+    return [name for name, factory in LOOP_FACTORIES.items() if factory]
+
+
+def resolve_loop(name: str = EVENT_LOOP) -> str:
+    """
+    Имя реализации цикла событий, которая будет запущена.
+
+    'auto' и не установленная реализация заменяются на самую быструю
+    из установленных, неизвестное имя - ошибка.
+    """
+    if name != AUTO_LOOP and name not in LOOP_FACTORIES:
+        raise ValueError(
+            f'неизвестная реализация цикла событий: {name}, '
+            f'доступны: {AUTO_LOOP}, {", ".join(LOOP_FACTORIES)}'
+        )
+    if LOOP_FACTORIES.get(name) is None:
+        return available_loops()[0]
+    return name
+
+
+def run(main: Awaitable, loop: str = EVENT_LOOP) -> Any:
+    """asyncio.run на выбранной реализации цикла событий."""
+    name = resolve_loop(loop)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=LOOP_FACTORIES[name]) as runner:
+            return runner.run(main)
+    if name != 'uvloop':
+        return asyncio.run(main)
+    # Политика восстанавливается, чтобы следующие вызовы run() с другой
+    # реализацией (например, строки бенчмарка loops) не шли на uvloop.
+    policy = asyncio.get_event_loop_policy()
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        return asyncio.run(main)
+    finally:
+        asyncio.set_event_loop_policy(policy)
@@ -0,0 +1,406 @@
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from connection import Connection
+from custom_logger import logger
+from config import BAN_TIME, MAX_REPORTS, GENERAL_CHAT_ON_REGISTRATION
+from config import CLUSTER_SYNC_CHUNK_SIZE
+from config import Status, ClientAddress, Message, Report, UserInfo
+from config import make_chat_id, to_loop_time
+from rendering import TextWire
+from storage import restore_chat, user_from_state, user_state
+from messages_templates import (
+    message_sended,
+    new_registration,
+    send_private_message,
+)
+
+if TYPE_CHECKING:
+    from server import ChatServer
+
+# Результаты применения события report.
+REPORT_ADDED = 'added'
+REPORT_DUPLICATE = 'duplicate'
+REPORT_BANNED = 'banned'
+REPORT_ALREADY_BANNED = 'already_banned'
+
+
+class EventHandlers:
+    """
+    Применение событий, изменяющих состояние сервера.
+
+    Обработчики команд не меняют состояние напрямую, а публикуют
+    событие в шину (bus.py). Шина применяет события всех процессов
+    в одном и том же порядке, поэтому состояние в каждом процессе
+    одинаковое. Событие - словарь из JSON-совместимых значений,
+    тип задаётся ключом 'type'. Моменты времени в событиях указаны
+    по настенным часам: у каждого процесса свои часы цикла событий.
+
+    Узел кластера, подключившийся позже, узнаёт о пользователях
+    других узлов из событий sync, поэтому события о пользователях,
+    которых процесс ещё не знает, пропускаются.
+
+    writer передаётся только процессу, опубликовавшему событие:
+    это соединение клиента, от имени которого оно создано.
+    """
+
+    def __init__(self, server_instance: 'ChatServer'):
+        self.server = server_instance
+        self.appliers: dict[str, Callable[[dict, Optional[Connection]], Any]] = {
+            'sign_in': self.apply_sign_in,
+            'sign_out': self.apply_sign_out,
+            'general': self.apply_general,
+            'private': self.apply_private,
+            'read': self.apply_read,
+            'general_read': self.apply_general_read,
+            'report': self.apply_report,
+            'ban': self.apply_ban,
+            'evict': self.apply_evict,
+            'restore': self.apply_restore,
+            'restore_chat': self.apply_restore_chat,
+            'schedule': self.apply_schedule,
+            'cancel': self.apply_cancel,
+            'sync': self.apply_sync,
+        }
+
+    def apply(self, event: dict, writer: Optional[Connection]) -> Any:
+        """Применение события к состоянию сервера."""
+        return self.appliers[event['type']](event, writer)
+
+    def apply_sign_in(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> Optional[tuple[bool, int]]:
+        """
+        Вход или регистрация пользователя.
+
+        Возвращает (новый ли пользователь, курсор общего чата) или None,
+        если пользователь уже в сети. Рассылки начнут приходить
+        пользователю, когда обработчик входа дошлёт ему историю с этого
+        курсора и зарегистрирует соединение в server.connections.
+        """
+        username = event['username']
+        client_addr = ClientAddress(*event['client_addr'])
+        general_chat = self.server.general_chat
+        user_info = self.server.users.get(username)
+
+        if user_info is None:
+            logger.info(new_registration, username)
+            user_info = UserInfo(
+                status=Status.ONLINE,
+                client_addr=client_addr,
+                reports=Report(),
+                writer=writer
+            )
+            self.server.users[username] = user_info
+            user_info.general_chat_cursor = max(
+                general_chat.next_seq - GENERAL_CHAT_ON_REGISTRATION, 0
+            )
+            registered = True
+        elif user_info.status == Status.ONLINE:
+            return None
+        else:
+            user_info.status = Status.ONLINE
+            user_info.client_addr = client_addr
+            user_info.writer = writer
+            registered = False
+
+        self.server.online.add(username)
+        self.server.storage.users_changed(username)
+        return registered, user_info.general_chat_cursor
+
+    def apply_sign_out(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Выход пользователя из системы."""
+        user_info = self.server.users.get(event['username'])
+        if user_info is None:
+            return
+        user_info.status = Status.OFFLINE
+        user_info.writer = None
+        user_info.last_seen = event['time']
+        # Курсор - докуда пользователь получил общий чат: если он вышел,
+        # не дождавшись истории, она придёт при следующем входе.
+        user_info.general_chat_cursor = max(
+            user_info.general_chat_cursor, event['cursor']
+        )
+        self.server.online.discard(event['username'])
+        self.server.connections.pop(event['username'], None)
+        self.server.storage.users_changed(event['username'])
+
+    def apply_general_read(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Сдвиг курсора общего чата по мере отправки истории."""
+        user_info = self.server.users.get(event['username'])
+        if user_info is None:
+            return
+        user_info.general_chat_cursor = max(
+            user_info.general_chat_cursor, event['cursor']
+        )
+        self.server.storage.users_changed(event['username'])
+
+    def apply_general(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Новое сообщение в общем чате и рассылка его пользователям."""
+        message = Message(sender=event['sender'], text=event['text'])
+        seq = self.server.general_chat.append(message)
+        self.server.storage.append_general(message)
+        self._broadcast(seq, message)
+
+    def _broadcast(self, seq: int, message: Message) -> None:
+        """
+        Рассылка готового кадра пользователям в режиме ONLINE,
+        подключённым к этому процессу.
+
+        Перебираются только их соединения, поэтому стоимость рассылки
+        не зависит от общего числа зарегистрированных пользователей.
+        Запись только ставит данные в очередь получателя, отправкой
+        в сокет занимается задача его соединения. Кадр рендерится один
+        раз на каждый формат протокола и общий для всех получателей.
+        """
+        # NOTE Пользователи в режиме OFFLINE дочитают общий чат по своему
+        # курсору при следующем входе, поэтому копии сообщения им не нужны.
+        payloads: dict[TextWire, bytes] = {}
+        for connection in self.server.connections.values():
+            payload = payloads.get(connection.wire)
+            if payload is None:
+                payload = payloads[connection.wire] = connection.wire.general(
+                    [(seq, message)]
+                )
+            connection.write_frame(payload)
+
+    def apply_private(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """
+        Новое сообщение в личном чате двух пользователей.
+
+        Если получатель в сети и подключён к этому процессу, сообщение
+        сразу ставится в очередь его соединения, как рассылка общего
+        чата. Прочитанным оно станет, когда клиент подтвердит доставку
+        командой /ack; неподтверждённые сообщения отправляются снова
+        при следующем входе.
+        """
+        sender, target = event['sender'], event['target']
+        chat_id = make_chat_id(sender, target)
+
+        message = Message(sender=sender, text=event['text'])
+        seq = self.server.open_private_chat(chat_id).append(message)
+        self.server.storage.append_private(chat_id, message)
+        logger.info(send_private_message, sender, target)
+
+        # Своё сообщение отправитель уже видел: если до него всё было
+        # прочитано, оно тоже считается прочитанным.
+        sender_info = self.server.users.get(sender)
+        if (sender_info is not None
+                and sender_info.last_read.get(chat_id, -1) == seq - 1):
+            sender_info.last_read[chat_id] = seq
+            self.server.storage.users_changed(sender)
+
+        connection = self.server.connections.get(target)
+        if connection is not None:
+            connection.write_frame(connection.wire.private([(seq, message)]))
+
+        if event.get('scheduled') and sender_info is not None:
+            # Отправителю отложенного сообщения сообщаем о доставке,
+            # если он подключён к этому процессу.
+            sender_writer = sender_info.writer
+            if sender_writer is not None:
+                sender_writer.write(message_sended.format(target).encode())
+
+    def apply_read(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Обновление seq последнего прочитанного сообщения чата."""
+        user_info = self.server.users.get(event['username'])
+        if user_info is None:
+            return
+        chat_id = tuple(event['chat_id'])
+        # Страницы, запрошенные одновременно, могут прийти не по порядку.
+        user_info.last_read[chat_id] = max(
+            user_info.last_read.get(chat_id, -1), event['index']
+        )
+        self.server.storage.users_changed(event['username'])
+
+    def apply_report(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> str:
+        """Жалоба на пользователя. Возвращает результат REPORT_*."""
+        target_info = self.server.users.get(event['target'])
+        if target_info is None:
+            return REPORT_ADDED
+        reports = target_info.reports
+        if event['username'] in reports.reported_by:
+            return REPORT_DUPLICATE
+
+        reports.reported_by.append(event['username'])
+        number_of_reports = len(reports.reported_by)
+        self.server.storage.users_changed(event['target'])
+        if number_of_reports < MAX_REPORTS:
+            return REPORT_ADDED
+        if number_of_reports == MAX_REPORTS:
+            reports.end_of_ban = to_loop_time(event['time']) + BAN_TIME
+            return REPORT_BANNED
+        return REPORT_ALREADY_BANNED
+
+    def apply_ban(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Автоматический бан пользователя, превысившего лимит команд."""
+        user_info = self.server.users.get(event['username'])
+        if user_info is None:
+            return
+        reports = user_info.reports
+        reports.end_of_ban = max(
+            reports.end_of_ban, to_loop_time(event['time']) + BAN_TIME
+        )
+        self.server.storage.users_changed(event['username'])
+
+    def apply_evict(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """
+        Вытеснение неактивного пользователя из памяти в хранилище.
+
+        Вместе с ним вытесняются личные чаты, второй участник которых
+        уже вытеснен: в памяти остаются только чаты, у которых есть
+        хотя бы один участник в памяти.
+        """
+        username = event['username']
+        user_info = self.server.users.get(username)
+        # Пока событие шло по шине, пользователь мог снова войти.
+        if user_info is None or user_info.status == Status.ONLINE:
+            return
+        del self.server.users[username]
+        chats = self.server.user_chats.pop(username, set())
+        state = user_state(user_info)
+        state['chats'] = [list(chat_id) for chat_id in chats]
+        self.server.storage.user_evicted(username, state)
+        for chat_id in chats:
+            if chat_id in self.server.private_chats and not any(
+                    participant in self.server.users
+                    for participant in chat_id
+            ):
+                self.server.evict_private_chat(chat_id)
+
+    def apply_restore(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """
+        Загрузка вытесненного пользователя обратно в память.
+
+        Его чаты, вытесненные вместе с ним, загружаются следующими
+        событиями restore_chat.
+        """
+        username = event['username']
+        if username in self.server.users:
+            return
+        self.server.users[username] = user_from_state(event['state'])
+        self.server.user_chats.setdefault(username, set()).update(
+            make_chat_id(first, second)
+            for first, second in event['state'].get('chats', ())
+        )
+        self.server.storage.user_restored(username)
+
+    def apply_restore_chat(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """Загрузка вытесненного личного чата обратно в память."""
+        chat_id = make_chat_id(*event['chat_id'])
+        # Пока событие шло по шине, чат мог загрузить другой запрос,
+        # а его участника - снова вытеснить.
+        if chat_id in self.server.private_chats or not any(
+                participant in self.server.users for participant in chat_id
+        ):
+            return
+        chat = self.server.open_private_chat(chat_id)
+        if event['state'] is not None:
+            restore_chat(chat, event['state'])
+        self.server.storage.chat_restored(chat_id)
+
+    def apply_sync(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> None:
+        """
+        Пользователи, которых другой узел кластера передал при
+        подключении. Уже известные пользователи не меняются: их
+        состояние поддерживают события.
+        """
+        online = set(event['online'])
+        for username, state in event['users'].items():
+            if username in self.server.users:
+                continue
+            user_info = user_from_state(state)
+            if username in online:
+                user_info.status = Status.ONLINE
+                self.server.online.add(username)
+            self.server.users[username] = user_info
+            self.server.storage.users_changed(username)
+
+    def sync_events(self, selected: Callable[[str], bool]) -> list[dict]:
+        """События sync с состоянием пользователей, отобранных selected."""
+        usernames = [
+            username for username in self.server.users if selected(username)
+        ]
+        events = []
+        for start in range(0, len(usernames), CLUSTER_SYNC_CHUNK_SIZE):
+            chunk = usernames[start:start + CLUSTER_SYNC_CHUNK_SIZE]
+            events.append({
+                'type': 'sync',
+                'users': {
+                    username: user_state(self.server.users[username])
+                    for username in chunk
+                },
+                'online': [
+                    username for username in chunk
+                    if username in self.server.online
+                ],
+            })
+        return events
+
+    def apply_schedule(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> int:
+        """Новое отложенное сообщение. Возвращает его ID у владельца."""
+        return self.server.scheduler.schedule_at(
+            event['sender'],
+            event['target'],
+            Message(sender=event['sender'], text=event['text']),
+            to_loop_time(event['deadline'])
+        )
+
+    def apply_cancel(
+            self,
+            event: dict,
+            writer: Optional[Connection]
+    ) -> bool:
+        """Отмена отложенного сообщения."""
+        return self.server.scheduler.cancel(
+            event['username'], event['message_id']
+        )
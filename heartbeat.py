@@ -0,0 +1,204 @@
+import asyncio
+import math
+import socket
+from typing import Hashable, Optional
+
+from config import (
+    HEARTBEAT_INTERVAL,
+    HEARTBEAT_TICK,
+    IDLE_TIMEOUT,
+    TCP_KEEPALIVE_COUNT,
+    TCP_KEEPALIVE_IDLE,
+    TCP_KEEPALIVE_INTERVAL,
+)
+from config import ClientAddress
+from connection import Connection
+from custom_logger import logger
+from rendering import render
+from messages_templates import heartbeat_ping, idle_connections_closed
+
+# Параметры keepalive: {имя опции модуля socket: значение}. Опций,
+# которых нет на платформе, модуль socket не определяет.
+KEEPALIVE_OPTIONS = {
+    'TCP_KEEPIDLE': TCP_KEEPALIVE_IDLE,
+    'TCP_KEEPINTVL': TCP_KEEPALIVE_INTERVAL,
+    'TCP_KEEPCNT': TCP_KEEPALIVE_COUNT,
+}
+
+
+def enable_keepalive(sock: Optional[socket.socket]) -> None:
+    """
+    Включение TCP keepalive на сокете клиента.
+
+    Ядро само обнаруживает полуоткрытые соединения (клиент пропал
+    без FIN), и чтение из такого сокета завершается ошибкой.
+    """
+    if TCP_KEEPALIVE_IDLE is None or sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in KEEPALIVE_OPTIONS.items():
+        if hasattr(socket, name):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+
+class TimerWheel:
+    """
+    Хешированное колесо таймеров с шагом tick секунд.
+
+    Срок каждого элемента округляется до шага и попадает в ячейку
+    кольца, поэтому постановка, снятие и перенос срока стоят O(1),
+    а за шаг разбирается одна ячейка, сколько бы элементов ни было
+    в остальных. Сроки дальше horizon секунд переносятся на horizon:
+    владелец колеса проверяет, действительно ли срок наступил.
+    """
+
+    def __init__(self, tick: float, horizon: float) -> None:
+        self.tick: float = tick
+        self._slots: list[set[Hashable]] = [
+            set() for _ in range(math.ceil(horizon / tick) + 2)
+        ]
+        # {элемент: номер шага, в ячейке которого он лежит}
+        self._steps: dict[Hashable, int] = {}
+        # Номер первого неразобранного шага; None - колесо не запущено.
+        self._step: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._steps)
+
+    def schedule(self, item: Hashable, deadline: float) -> None:
+        """Постановка элемента на срок deadline (переносит прежний срок)."""
+        self.remove(item)
+        step = math.ceil(deadline / self.tick)
+        if self._step is None:
+            self._step = step
+        step = min(
+            max(step, self._step), self._step + len(self._slots) - 1
+        )
+        self._slots[step % len(self._slots)].add(item)
+        self._steps[item] = step
+
+    def remove(self, item: Hashable) -> None:
+        step = self._steps.pop(item, None)
+        if step is not None:
+            self._slots[step % len(self._slots)].discard(item)
+
+    def expire(self, now: float) -> list[Hashable]:
+        """Снятие с колеса всех элементов, срок которых не позже now."""
+        expired = []
+        if self._step is None:
+            return expired
+        last = math.floor(now / self.tick)
+        while self._step <= last:
+            slot = self._slots[self._step % len(self._slots)]
+            for item in slot:
+                del self._steps[item]
+            expired.extend(slot)
+            slot.clear()
+            self._step += 1
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Проверка простаивающих соединений.
+
+    Соединение, от которого interval секунд не было ни одного кадра,
+    получает пинг: клиент отвечает командой /pong. Соединение,
+    молчащее idle_timeout секунд, закрывается, и пользователь выходит
+    из сети обычным путём - через /sign_out при разрыве. Пока
+    выполняется команда клиента (например, вход в очереди), соединение
+    не считается простаивающим, но ожидание отправки ответа
+    (Connection.drain()) выполнением не считается: клиент, который
+    перестал читать, закрывается так же, как молчащий.
+
+    Соединения лежат на колесе таймеров по сроку следующей проверки.
+    Чтение кадра только обновляет Connection.last_activity, а срок
+    переносится, когда до соединения доходит колесо, поэтому
+    активные клиенты ничего не стоят, а мёртвые соединения
+    закрываются пачкой за один шаг.
+    """
+
+    def __init__(
+            self,
+            interval: Optional[float] = HEARTBEAT_INTERVAL,
+            idle_timeout: Optional[float] = IDLE_TIMEOUT,
+            tick: float = HEARTBEAT_TICK
+    ) -> None:
+        self.interval: Optional[float] = interval
+        self.idle_timeout: Optional[float] = idle_timeout
+        self.wheel: TimerWheel = TimerWheel(
+            tick, max(interval or 0, idle_timeout or 0)
+        )
+        # Сколько отправлено пингов и закрыто простаивающих соединений.
+        self.pings: int = 0
+        self.timed_out: int = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval is not None or self.idle_timeout is not None
+
+    def start(self) -> None:
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            self.sweep(loop.time())
+
+    def watch(self, connection: Connection) -> None:
+        """Постановка нового соединения на проверку."""
+        if self.enabled:
+            self.wheel.schedule(
+                connection, self._next_check(connection, connection.last_activity)
+            )
+
+    def forget(self, connection: Connection) -> None:
+        """Снятие закрытого соединения с проверки."""
+        self.wheel.remove(connection)
+
+    def _next_check(self, connection: Connection, now: float) -> float:
+        """Срок следующей проверки соединения."""
+        last = connection.last_activity
+        if self.interval is not None and last + self.interval > now:
+            return last + self.interval
+        if self.idle_timeout is not None:
+            return last + self.idle_timeout
+        return now + self.interval
+
+    def sweep(self, now: float) -> None:
+        """Проверка соединений, срок которых наступил."""
+        idle = []
+        for connection in self.wheel.expire(now):
+            if connection.closed:
+                continue
+            silence = now - connection.last_activity
+            if connection.busy:
+                connection.last_activity = now
+            elif self.idle_timeout is not None and silence >= self.idle_timeout:
+                idle.append(connection)
+                continue
+            elif self.interval is not None and silence >= self.interval:
+                connection.write(render(heartbeat_ping))
+                self.pings += 1
+            self.wheel.schedule(connection, self._next_check(connection, now))
+        if idle:
+            logger.info(idle_connections_closed, len(idle), self.idle_timeout)
+            self.timed_out += len(idle)
+            for connection in idle:
+                connection.close()
+
+    async def handle_pong(
+            self,
+            args: str,
+            writer: Connection,
+            username: Optional[str],
+            client_addr: ClientAddress
+    ) -> None:
+        """Ответ клиента на пинг: активность уже учтена при чтении кадра."""
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
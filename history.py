@@ -0,0 +1,247 @@
+import sys
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from config import (
+    GENERAL_CHAT_RETENTION,
+    GENERAL_CHAT_MAX_AGE,
+    GENERAL_CHAT_MAX_BYTES,
+    PRIVATE_CHAT_RETENTION,
+    PRIVATE_CHAT_MAX_AGE,
+    PRIVATE_CHAT_MAX_BYTES,
+)
+from config import Message
+
+# Размер записи Message без текста; имена отправителей интернированы
+# и общие для всех сообщений, поэтому не учитываются.
+MESSAGE_OVERHEAD = sys.getsizeof(Message(sender='', text=''))
+# После скольких вытесненных сообщений личный чат сжимает свой список.
+COMPACT_THRESHOLD = 1024
+
+
+def message_size(message: Message) -> int:
+    """Примерный объём памяти, который занимает сообщение."""
+    return MESSAGE_OVERHEAD + sys.getsizeof(message.text)
+
+
+class ChatHistory(ABC):
+    """
+    Журнал сообщений чата с политикой хранения.
+
+    Сообщения нумеруются порядковыми номерами (seq), которые монотонно
+    растут и никогда не переиспользуются. Самые старые сообщения
+    вытесняются, когда их больше retention, когда их общий объём
+    больше max_bytes или когда они старше max_age секунд
+    (None - ограничения нет). Вытесненные сообщения остаются только
+    в хранилище, а seq оставшихся не меняются.
+    """
+
+    def __init__(
+            self,
+            retention: Optional[int],
+            max_age: Optional[float],
+            max_bytes: Optional[int]
+    ) -> None:
+        if retention is not None and retention <= 0:
+            raise ValueError('retention должен быть положительным числом')
+        self.retention: Optional[int] = retention
+        self.max_age: Optional[float] = max_age
+        self.max_bytes: Optional[int] = max_bytes
+        # seq самого старого хранящегося сообщения.
+        self.first_seq: int = 0
+        # seq, который получит следующее добавленное сообщение.
+        self.next_seq: int = 0
+        # Примерный объём памяти хранящихся сообщений в байтах.
+        self.memory: int = 0
+
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+
+    def append(self, message: Message, now: Optional[float] = None) -> int:
+        """Добавление сообщения в журнал. Возвращает seq сообщения."""
+        if now is None:
+            now = time.time()
+        if self.retention is not None and len(self) >= self.retention:
+            self._evict_oldest()
+        seq = self.next_seq
+        self._store(message, now)
+        self.memory += message_size(message)
+        self.next_seq += 1
+        self.trim(now)
+        return seq
+
+    def trim(self, now: Optional[float] = None) -> None:
+        """Вытеснение сообщений, нарушающих ограничения по объёму и возрасту."""
+        if self.max_bytes is not None:
+            while self.memory > self.max_bytes and len(self):
+                self._evict_oldest()
+        if self.max_age is not None:
+            deadline = (time.time() if now is None else now) - self.max_age
+            while len(self) and self._oldest_time() < deadline:
+                self._evict_oldest()
+
+    @abstractmethod
+    def _store(self, message: Message, now: float) -> None:
+        """Запись сообщения с seq self.next_seq."""
+
+    @abstractmethod
+    def _oldest_time(self) -> float:
+        """Время добавления самого старого сообщения."""
+
+    @abstractmethod
+    def _evict_oldest(self) -> None:
+        """Вытеснение самого старого сообщения."""
+
+
+class GeneralChat(ChatHistory):
+    """
+    Общий чат - ограниченный журнал сообщений (кольцевой буфер).
+
+    Пользователи не хранят копии сообщений, а читают журнал через
+    курсор - seq первого непрочитанного сообщения. Когда буфер
+    заполнен, новое сообщение вытесняет самое старое.
+    """
+
+    def __init__(
+            self,
+            retention: int = GENERAL_CHAT_RETENTION,
+            max_age: Optional[float] = GENERAL_CHAT_MAX_AGE,
+            max_bytes: Optional[int] = GENERAL_CHAT_MAX_BYTES
+    ) -> None:
+        super().__init__(retention, max_age, max_bytes)
+        self._buffer: list[Optional[Message]] = [None] * retention
+        self._times: list[float] = [0.0] * retention
+
+    def _store(self, message: Message, now: float) -> None:
+        index = self.next_seq % self.retention
+        self._buffer[index] = message
+        self._times[index] = now
+
+    def _oldest_time(self) -> float:
+        return self._times[self.first_seq % self.retention]
+
+    def _evict_oldest(self) -> None:
+        index = self.first_seq % self.retention
+        self.memory -= message_size(self._buffer[index])
+        self._buffer[index] = None
+        self.first_seq += 1
+
+    def restore(self, messages: list[Message], next_seq: int) -> None:
+        """
+        Восстановление журнала из хранилища.
+
+        messages - последние сохранённые сообщения, next_seq - общее
+        количество сообщений, когда-либо добавленных в общий чат.
+        """
+        messages = messages[-self.retention:]
+        self._buffer = [None] * self.retention
+        self._times = [0.0] * self.retention
+        self.memory = 0
+        self.first_seq = self.next_seq = next_seq - len(messages)
+        for message in messages:
+            self.append(message)
+
+    def since(self, cursor: int) -> list[Message]:
+        """
+        Все сообщения, начиная с курсора.
+
+        Если часть сообщений уже вытеснена из буфера,
+        возвращаются только сохранившиеся.
+        """
+        start = max(cursor, self.first_seq)
+        return [
+            self._buffer[seq % self.retention]
+            for seq in range(start, self.next_seq)
+        ]
+
+    def tail(self, count: int) -> list[Message]:
+        """Последние count сообщений."""
+        return self.since(self.next_seq - count)
+
+    def read(self, start: int, stop: int) -> tuple[int, list[Message]]:
+        """
+        Сообщения с seq от start до stop (не включая).
+
+        Возвращает seq первого из них и сами сообщения: если часть
+        диапазона уже вытеснена, возвращаются только сохранившиеся.
+        """
+        start = max(start, self.first_seq)
+        stop = min(stop, self.next_seq)
+        return start, [
+            self._buffer[seq % self.retention] for seq in range(start, stop)
+        ]
+
+
+class PrivateChat(ChatHistory):
+    """
+    Личный чат двух пользователей.
+
+    Для каждого пользователя хранится только seq последнего
+    прочитанного сообщения, поэтому количество непрочитанных
+    считается за O(1).
+    """
+
+    def __init__(
+            self,
+            retention: Optional[int] = PRIVATE_CHAT_RETENTION,
+            max_age: Optional[float] = PRIVATE_CHAT_MAX_AGE,
+            max_bytes: Optional[int] = PRIVATE_CHAT_MAX_BYTES
+    ) -> None:
+        super().__init__(retention, max_age, max_bytes)
+        self._messages: list[Optional[Message]] = []
+        self._times: list[float] = []
+        # Индекс сообщения с seq first_seq в self._messages: начало
+        # списка освобождается не при каждом вытеснении, а пачкой.
+        self._head: int = 0
+
+    def _store(self, message: Message, now: float) -> None:
+        self._messages.append(message)
+        self._times.append(now)
+
+    def _oldest_time(self) -> float:
+        return self._times[self._head]
+
+    def _evict_oldest(self) -> None:
+        self.memory -= message_size(self._messages[self._head])
+        self._messages[self._head] = None
+        self._head += 1
+        self.first_seq += 1
+        if (self._head >= COMPACT_THRESHOLD
+                and self._head * 2 >= len(self._messages)):
+            del self._messages[:self._head]
+            del self._times[:self._head]
+            self._head = 0
+
+    def restore(self, messages: list[Message], next_seq: int) -> None:
+        """
+        Восстановление чата из хранилища.
+
+        messages - последние сохранённые сообщения, next_seq - общее
+        количество сообщений, когда-либо добавленных в чат.
+        """
+        self._messages = []
+        self._times = []
+        self._head = 0
+        self.memory = 0
+        self.first_seq = self.next_seq = next_seq - len(messages)
+        for message in messages:
+            self.append(message)
+
+    def unread_count(self, last_read: int) -> int:
+        """Количество сообщений после seq последнего прочитанного."""
+        return self.next_seq - max(last_read + 1, self.first_seq)
+
+    def read(self, start: int, stop: int) -> tuple[int, list[Message]]:
+        """
+        Сообщения с seq от start до stop (не включая).
+
+        Возвращает seq первого из них и сами сообщения: если часть
+        диапазона уже не хранится, возвращаются только сохранившиеся.
+        """
+        start = max(start, self.first_seq)
+        stop = min(stop, self.next_seq)
+        if start >= stop:
+            return start, []
+        offset = self._head - self.first_seq
+        return start, self._messages[start + offset:stop + offset]
@@ -0,0 +1,270 @@
+"""
+Генератор нагрузки для сервера чата.
+
+Открывает множество соединений, авторизует их и отправляет команды
+в заданной пропорции, после чего печатает пропускную способность
+и задержку доставки сообщений общего чата (от отправки /send_all
+до получения уведомления каждым подключённым клиентом).
+
+Запуск:
+    python load_test.py --connections 2000 --duration 30 --rate 2000 \
+        --mix send_all=40,send=30,get_chat_with=10,status=10,send_delayed=10 \
+        --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+import uuid
+from asyncio.streams import StreamReader, StreamWriter
+from collections import Counter
+from typing import Optional
+
+from config import IP_ADDR, PORT, EVENT_LOOP, MAX_RESPONSE_FRAME_SIZE
+from eventloop import AUTO_LOOP, LOOP_FACTORIES, resolve_loop, run
+from protocol import FrameTooLarge, encode_frame, read_frame
+
+# Метка в тексте сообщения, по которой получатель находит время отправки.
+LATENCY_MARKER = 'lt:'
+DEFAULT_MIX = 'send_all=40,send=30,get_chat_with=10,status=10,send_delayed=10'
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    """Разбор пропорции команд вида send_all=40,send=30."""
+    mix = {}
+    for item in filter(None, value.split(',')):
+        command, _, weight = item.partition('=')
+        mix[command] = int(weight)
+    return mix
+
+
+def percentile(sorted_values: list[float], fraction: float) -> Optional[float]:
+    """Перцентиль отсортированной выборки."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def git_revision() -> Optional[str]:
+    """Текущий коммит, чтобы результаты можно было сравнивать."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.run_id: str = uuid.uuid4().hex[:6]
+        self.usernames: list[str] = [
+            f'load_{self.run_id}_{number}'
+            for number in range(args.connections)
+        ]
+        commands = parse_mix(args.mix)
+        self.commands: list[str] = list(commands)
+        self.weights: list[int] = list(commands.values())
+        self.sent: Counter = Counter()
+        self.latencies: list[float] = []
+        self.errors: int = 0
+        self.measuring: bool = False
+        # Окно измерения по time.perf_counter_ns(): учитываются доставки
+        # сообщений, отправленных в нём, даже если они пришли позже.
+        self.window_start: Optional[int] = None
+        self.window_end: Optional[int] = None
+
+    def build_command(self, username: str) -> tuple[str, str]:
+        """Случайная команда согласно пропорции."""
+        command = random.choices(self.commands, self.weights)[0]
+        target = random.choice(self.usernames)
+        if command == 'send_all':
+            text = f'{LATENCY_MARKER}{time.perf_counter_ns()}'
+            return command, f'/send_all {text}'
+        if command == 'send':
+            return command, f'/send {target} hello from {username}'
+        if command == 'get_chat_with':
+            return command, f'/get_chat_with {target}'
+        if command == 'status':
+            return command, '/status'
+        if command == 'send_delayed':
+            return command, f'/send_delayed {target} 1 reminder'
+        raise ValueError(f'Неизвестная команда в пропорции: {command}')
+
+    def in_window(self, sent: int) -> bool:
+        """Отправлено ли сообщение в окне измерения."""
+        if self.window_start is None or sent < self.window_start:
+            return False
+        return self.window_end is None or sent <= self.window_end
+
+    async def listen(self, reader: StreamReader) -> None:
+        """
+        Разбор ответов сервера и учёт задержки доставки.
+
+        Слушатель работает, пока его не отменят, поэтому сообщения,
+        пришедшие после окна измерения (за drain_time), тоже учитываются.
+        """
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except FrameTooLarge:
+                continue
+            if frame is None:
+                return
+            received = time.perf_counter_ns()
+            marker = frame.find(LATENCY_MARKER.encode())
+            if marker == -1:
+                continue
+            start = marker + len(LATENCY_MARKER)
+            end = start
+            while end < len(frame) and frame[end:end + 1].isdigit():
+                end += 1
+            if end > start:
+                sent = int(frame[start:end])
+                if self.in_window(sent):
+                    self.latencies.append((received - sent) / 1_000_000)
+
+    async def drive(self, username: str, writer: StreamWriter) -> None:
+        """Отправка команд одним клиентом с заданным темпом."""
+        interval = self.args.connections / self.args.rate
+        # Случайный сдвиг, чтобы клиенты не отправляли команды залпом.
+        await asyncio.sleep(random.uniform(0, interval))
+        while self.measuring:
+            command, line = self.build_command(username)
+            try:
+                writer.write(encode_frame(line))
+                await writer.drain()
+            except ConnectionError:
+                self.errors += 1
+                return
+            self.sent[command] += 1
+            await asyncio.sleep(interval)
+
+    async def connect(
+            self,
+            username: str
+    ) -> tuple[StreamReader, StreamWriter]:
+        reader, writer = await asyncio.open_connection(
+            self.args.host, self.args.port, limit=MAX_RESPONSE_FRAME_SIZE
+        )
+        writer.write(encode_frame(f'/sign_in {username}'))
+        await writer.drain()
+        return reader, writer
+
+    async def run(self) -> dict:
+        connect_started = time.perf_counter()
+        connections = []
+        for offset in range(0, len(self.usernames), self.args.connect_batch):
+            batch = self.usernames[offset:offset + self.args.connect_batch]
+            connections.extend(await asyncio.gather(
+                *(self.connect(username) for username in batch)
+            ))
+        connect_time = time.perf_counter() - connect_started
+
+        listeners = [
+            asyncio.create_task(self.listen(reader))
+            for reader, _ in connections
+        ]
+        # Ждём, пока сервер ответит на все /sign_in.
+        await asyncio.sleep(self.args.warmup)
+
+        self.measuring = True
+        self.window_start = time.perf_counter_ns()
+        started = time.perf_counter()
+        drivers = [
+            asyncio.create_task(self.drive(username, writer))
+            for username, (_, writer) in zip(self.usernames, connections)
+        ]
+        await asyncio.sleep(self.args.duration)
+        self.measuring = False
+        self.window_end = time.perf_counter_ns()
+        elapsed = time.perf_counter() - started
+        await asyncio.gather(*drivers)
+        # Даём доставиться сообщениям, отправленным в последний момент.
+        await asyncio.sleep(self.args.drain_time)
+
+        for listener in listeners:
+            listener.cancel()
+        for _, writer in connections:
+            writer.close()
+
+        return self.report(connect_time, elapsed)
+
+    def report(self, connect_time: float, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        total_sent = sum(self.sent.values())
+        return {
+            'revision': git_revision(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'parameters': {
+                'host': self.args.host,
+                'port': self.args.port,
+                'connections': self.args.connections,
+                'duration': self.args.duration,
+                'rate': self.args.rate,
+                'mix': parse_mix(self.args.mix),
+                'loop': resolve_loop(self.args.loop),
+            },
+            'connect_time_s': round(connect_time, 3),
+            'commands_sent': dict(self.sent),
+            'commands_per_s': round(total_sent / elapsed, 1),
+            'deliveries': len(latencies),
+            'deliveries_per_s': round(len(latencies) / elapsed, 1),
+            'delivery_latency_ms': {
+                'p50': percentile(latencies, 0.50),
+                'p99': percentile(latencies, 0.99),
+                'p999': percentile(latencies, 0.999),
+                'max': latencies[-1] if latencies else None,
+            },
+            'errors': self.errors,
+        }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default=IP_ADDR)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument(
+        '--duration', type=float, default=10,
+        help='Длительность измерения в секундах.'
+    )
+    parser.add_argument(
+        '--rate', type=float, default=1000,
+        help='Суммарное количество команд в секунду от всех клиентов.'
+    )
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument(
+        '--connect-batch', type=int, default=200,
+        help='Сколько соединений открывать одновременно.'
+    )
+    parser.add_argument(
+        '--loop', choices=[AUTO_LOOP, *LOOP_FACTORIES], default=EVENT_LOOP,
+        help='Реализация цикла событий генератора.'
+    )
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--drain-time', type=float, default=1.0)
+    parser.add_argument(
+        '--output', help='Файл, в который сохранить результаты в JSON.'
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    results = run(LoadGenerator(args).run(), args.loop)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,83 @@
-import asyncio
-from config import IP_ADDR, PORT
+import argparse
+from config import IP_ADDR, PORT, METRICS_PORT, EVENT_LOOP
 
+from cluster import ClusterBus
+from eventloop import AUTO_LOOP, LOOP_FACTORIES, resolve_loop, run
 from server import ChatServer
 from custom_logger import logger
-from messages_templates import server_stopped
+from messages_templates import event_loop_fallback, server_stopped
+from workers import run_workers
+
+
+def parse_address(value: str) -> tuple[str, int]:
+    """Разбор адреса вида HOST:PORT."""
+    host, _, port = value.rpartition(':')
+    return host, int(port)
+
+
+def parse_peers(value: str) -> dict[str, tuple[str, int]]:
+    """Разбор списка узлов вида NAME=HOST:PORT,NAME=HOST:PORT."""
+    peers = {}
+    for peer in filter(None, value.split(',')):
+        name, _, address = peer.partition('=')
+        peers[name] = parse_address(address)
+    return peers
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Сервер чата.')
+    parser.add_argument('--host', default=IP_ADDR)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument(
+        '--workers', type=int, default=1,
+        help='Количество рабочих процессов, слушающих один порт.'
+    )
+    parser.add_argument(
+        '--metrics-port', type=int, default=METRICS_PORT,
+        help='Порт с метриками в формате Prometheus. В многопроцессном '
+             'режиме процесс N слушает порт METRICS_PORT + N.'
+    )
+    parser.add_argument(
+        '--loop', choices=[AUTO_LOOP, *LOOP_FACTORIES], default=EVENT_LOOP,
+        help='Реализация цикла событий.'
+    )
+    cluster = parser.add_argument_group('кластер')
+    cluster.add_argument('--node-id', help='Имя узла в кластере.')
+    cluster.add_argument(
+        '--cluster-address', type=parse_address,
+        help='HOST:PORT, на котором узел принимает события других узлов.'
+    )
+    cluster.add_argument(
+        '--peers', type=parse_peers, default={},
+        help='Остальные узлы кластера: NAME=HOST:PORT,NAME=HOST:PORT.'
+    )
+    args = parser.parse_args()
+    if args.node_id and not args.cluster_address:
+        parser.error('для узла кластера нужен --cluster-address')
+    if args.node_id and args.workers > 1:
+        parser.error('--workers нельзя совмещать с режимом кластера')
+    return args
 
 
 if __name__ == "__main__":
+    args = parse_args()
+    loop = resolve_loop(args.loop)
+    if args.loop not in (AUTO_LOOP, loop):
+        logger.warning(event_loop_fallback, args.loop, loop)
     try:
-        server = ChatServer(IP_ADDR, PORT)
-        asyncio.run(server.run())
+        if args.workers > 1:
+            run_workers(
+                args.host, args.port, args.workers, args.metrics_port, loop
+            )
+        elif args.node_id:
+            bus = ClusterBus(args.node_id, args.cluster_address, args.peers)
+            server = ChatServer(args.host, args.port, bus, args.metrics_port)
+            run(server.run(), loop)
+        else:
+            server = ChatServer(
+                args.host, args.port, metrics_port=args.metrics_port
+            )
+            run(server.run(), loop)
     except KeyboardInterrupt:
         logger.info(server_stopped)
         raise SystemExit('Завершено администратором')
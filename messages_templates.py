@@ -4,20 +4,28 @@ sign_in_required = ('Вам необходимо авторизоваться, 
                     'к ресурсу: </sign_in USERNAME>.\n')
 unknown_command = 'Неизвестная команда: {}.\n'
 success_registration = ('Пользователь успешно зарегистрирован и авторизован.\n'
-                        '{}\n')
+                        'Последние сообщения общего чата: {}.\n')
 already_signed_in = 'Пользователь уже авторизован на сервере.\n'
-success_sign_in = 'Успешная авторизация.\n{}\n'
+success_sign_in = ('Успешная авторизация.\n'
+                   'Непрочитанные сообщения общего чата: {}.\n')
+wire_format_switched = 'Формат протокола: {}.\n'
+unknown_wire_format = 'Неизвестный формат протокола {}, доступны: {}.\n'
 no_username = 'Не указано имя пользователя.\n'
 empty_message = 'Сообщение пустое, необходимо ввести сообщение.\n'
 no_username_or_empty_msg = ('Не указано имя пользователя либо ' 
                             'пустое сообщение.\n')
 message_sended = 'Сообщение отправлено пользователю {}.\n'
 user_isnt_registered = 'Пользователь "{}" не зарегистрирован на сервере.\n'
-new_messages = '{}\n'
+chat_page = ('Чат с пользователем {}: сообщений {}, '
+             'непрочитанных осталось {}.\n')
+chat_message = '[{}] {}: {}\n'
+wrong_page_params = 'Размер страницы и seq должны быть целыми числами.\n'
 no_messages_with_target_user = ('У вас ещё нет сообщений '
                                 'с указанным пользователем.\n')
-user_statuses = 'Список пользователей и их статусов: {}.\n'
-private = 'Список приватных чатов: {}.\n'
+user_statuses = 'Пользователей в сети: {}, не в сети: {}.\n'
+private = 'Ваши личные чаты: {}.\n'
+private_chat_entry = '{} (непрочитанных: {})'
+online_users = 'Пользователи в сети ({}):\n'
 successfully_sended = 'Сообщение успешно отправлено в общий чат.\n'
 no_such_user = ('Пользователя, на которого вы хотите пожаловаться '
                 '/ которому хотите  существует.\n')
@@ -27,6 +35,7 @@ user_banned = 'Ваша жалоба забанила пользователя:
 user_already_banned = 'Пользователь "{}" был уже забанен на 4 часа.\n'
 not_all_params_given = ('Необходимо указать имя пользователя, '
                         'время и сообщение.\n')
+rate_limited = 'Слишком много команд {}, повторите попытку позже.\n'
 time_error = 'Неверный формат времени.\n'
 added_scheduled_message = ('Ваше сообщение c id {} запланировано '
                            'на отправку через {} секунд.\n')
@@ -37,6 +46,15 @@ succefully_cancel_delayed_message = ('Отложенное сообщение с
                                      '{} успешно отменено.\n')
 user_already_signed_in = ('Пользователь уже авторизван. '
                           'Необходимо выйти из текущей учётной записи\n')
+frame_too_large = 'Команда длиннее {} байт и была отброшена.\n'
+private_chat_new_message = 'Личное сообщение [{}] от {}: {}\n'
+wrong_ack_params = ('Необходимо указать имя пользователя и номер '
+                    'сообщения: /ack <username> <seq>.\n')
+no_such_private_message = 'Нет сообщения [{}] в чате с пользователем {}.\n'
+sign_in_queued = ('Сервер принимает много подключений, вы в очереди '
+                  'на вход: {}.\n')
+sign_in_queue_full = 'Сервер перегружен, повторите вход позже.\n'
+heartbeat_ping = 'Проверка соединения, ответьте /pong.\n'
 general_chat_new_message = ('В общий чат добавлено новое сообщение {}. '
                             'Отправитель - {}\n')
 
@@ -54,7 +72,38 @@ get_status = '%s запрашивает статус пользователей.
 report_user = '%s пожаловался на пользователя %s.'
 new_connection = 'Новое подключение от %s.'
 server_started = 'Сервер запущен на %s:%s.'
+event_loop_selected = 'Цикл событий: %s.'
+event_loop_fallback = 'Цикл событий %s не установлен, используется %s.'
 server_stopped = 'Сервер остановлен администратором'
+storage_loaded = ('Состояние восстановлено: пользователей - %s, сообщений '
+                  'в общем чате - %s, в личных чатах - %s.')
+storage_truncated = ('Сегмент %s обрезан до %s байт: данные после '
+                     'последней фиксации не были дописаны.')
+storage_orphan_removed = ('Сегмент %s удалён: он отсутствует в индексе '
+                          'и не был зафиксирован.')
+bus_hub_started = 'Хаб шины запущен на %s.'
+bus_worker_connected = 'Рабочий процесс %s подключился к шине.'
+bus_worker_disconnected = 'Рабочий процесс %s отключился от шины.'
+bus_connection_lost = 'Потеряна связь с хабом шины %s.'
+bus_event_failed = 'Не удалось применить событие шины %s.'
+cluster_node_started = 'Узел кластера %s принимает события на %s:%s.'
+cluster_peer_up = 'Узел кластера %s доступен.'
+cluster_peer_down = 'Узел кластера %s недоступен.'
+auto_banned = ('Пользователь %s забанен автоматически за превышение '
+               'лимита команд.')
+metrics_started = 'Метрики Prometheus доступны на http://%s:%s/metrics.'
+worker_started = 'Рабочий процесс %s запущен, pid %s.'
+worker_exited = 'Рабочий процесс %s завершился с кодом %s.'
+slow_consumer_dropped = ('Очередь клиента %s переполнена, самое старое '
+                         'сообщение отброшено.')
+slow_consumer_disconnected = ('Очередь клиента %s переполнена, '
+                              'клиент отключён.')
+sign_in_queue_overflow = ('Очередь на вход переполнена, клиенту %s '
+                          'отказано во входе.')
+replay_stalled = ('Клиент %s не вычитал историю за %s секунд, '
+                  'соединение закрыто.')
+idle_connections_closed = ('Закрыто простаивающих соединений: %s '
+                           '(без кадров дольше %s секунд).')
 create_scheduled_message = ('Пользователь %s создал отложенное сообщение для '
                             'пользователя %s, задержка - %s секунд')
 sending_delayed_message = ('Начинаю отправку отложенного сообщения от '
@@ -66,20 +115,32 @@ cancel_scheduled_message = ('Отменяю отправку отложенно
 help_message = """\
 Список доступных команд для взаимодействия с сервером:
 
-    /sign_in              - Войти или зарегистрироваться на сервере.
+    /sign_in <username> [text|binary]
+                          - Войти или зарегистрироваться на сервере.
                             В ответ вы получите либо последние 20 сообщений 
                             (если ранее не подключались), либо все непрочитанные сообщения.
+                            binary переключает соединение на компактный двоичный
+                            формат протокола.
 
     /send_all             - Отправить сообщение в общий чат.
 
     /send <username>      - Отправить приватное сообщение указанному пользователю.
+                            Пользователь в сети получает его сразу.
 
-    /get_chat_with        - Получить историю сообщений с выбранным пользователем.
-                            Повторно подключившись, вы сможете увидеть все непрочитанные 
-                            сообщения до последнего запроса (включая общий чат и приватные сообщения).
+    /ack <username> <seq> - Подтвердить получение личных сообщений от пользователя
+                            с номером до seq включительно. Клиент отправляет
+                            подтверждения сам, неподтверждённые сообщения
+                            приходят снова при следующем входе.
 
-    /status               - Посмотреть список активных и неактивных пользователей,
-                            а также существующих приватных чатов.
+    /get_chat_with <username> [limit] [before_seq]
+                          - Получить сообщения с выбранным пользователем.
+                            Без before_seq возвращает до limit непрочитанных сообщений
+                            и отмечает их прочитанными, с before_seq - до limit сообщений
+                            с номером меньше before_seq (листание истории).
+
+    /status [online]      - Посмотреть количество пользователей в сети и не в сети,
+                            а также ваши личные чаты с числом непрочитанных сообщений.
+                            /status online выводит список пользователей в сети.
 
     /report               - Пожаловаться на пользователя.
                             По достижении 3 жалоб пользователь будет заблокирован на 4 часа.
@@ -0,0 +1,279 @@
+import asyncio
+import bisect
+from asyncio.streams import StreamReader, StreamWriter
+from typing import TYPE_CHECKING, Optional
+
+from custom_logger import logger
+from config import LATENCY_BUCKETS, LOOP_LAG_INTERVAL, OUTBOUND_QUEUE_SIZE
+from messages_templates import metrics_started
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+if TYPE_CHECKING:
+    from server import ChatServer
+
+# Границы корзин гистограммы глубины исходящих очередей.
+QUEUE_DEPTH_BUCKETS = (0, 1, 10, 100, OUTBOUND_QUEUE_SIZE // 2)
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин.
+
+    Наблюдение стоит один bisect и одно сложение, поэтому её можно
+    обновлять на каждую команду. Перцентили оцениваются сверху:
+    возвращается граница корзины, в которую попал перцентиль.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.bounds: tuple[float, ...] = bounds
+        # Последняя корзина - значения больше самой большой границы.
+        self.counts: list[int] = [0] * (len(bounds) + 1)
+        self.count: int = 0
+        self.total: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, fraction: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает перцентиль."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        if index < len(self.bounds):
+            return self.bounds[index]
+        return float('inf')
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': self.quantile(0.50),
+            'p99': self.quantile(0.99),
+            'p999': self.quantile(0.999),
+            'buckets': dict(zip(self.bounds, self.counts)),
+        }
+
+
+class CommandMetrics:
+    """Количество и гистограмма времени выполнения каждой команды."""
+
+    def __init__(self) -> None:
+        self.histograms: dict[str, Histogram] = {}
+
+    def observe(self, command: str, seconds: float) -> None:
+        histogram = self.histograms.get(command)
+        if histogram is None:
+            histogram = self.histograms[command] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self) -> dict[str, dict]:
+        return {
+            command: histogram.snapshot()
+            for command, histogram in self.histograms.items()
+        }
+
+
+class LoopLagMonitor:
+    """
+    Измерение задержки цикла событий.
+
+    Раз в interval секунд задача засыпает и замечает, насколько позже
+    заданного срока она проснулась: это время, на которое цикл событий
+    был занят другими задачами.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL) -> None:
+        self.interval: float = interval
+        self.histogram: Histogram = Histogram()
+        self.last: float = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - expected)
+            self.histogram.observe(self.last)
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+def _histogram_lines(
+        name: str,
+        histogram: Histogram,
+        labels: str = ''
+) -> list[str]:
+    """Строки гистограммы в формате Prometheus."""
+    separator = ',' if labels else ''
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} '
+                     f'{cumulative}')
+    lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} '
+                 f'{histogram.count}')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f'{name}_sum{suffix} {histogram.total}')
+    lines.append(f'{name}_count{suffix} {histogram.count}')
+    return lines
+
+
+def render_prometheus(server: 'ChatServer') -> str:
+    """
+    Метрики сервера в текстовом формате Prometheus.
+
+    Счётчики и гистограммы обновляются по ходу работы, а при запросе
+    только считываются. Перебираются лишь соединения этого процесса
+    и личные чаты, чтобы сложить их глубины очередей и объём памяти.
+    Счётчики (тип counter, суффикс _total) только растут: закрытие
+    соединения их не уменьшает.
+    """
+    lines = [
+        '# TYPE chat_connections gauge',
+        f'chat_connections {len(server.connections)}',
+        '# TYPE chat_online_users gauge',
+        f'chat_online_users {len(server.online)}',
+        '# TYPE chat_registered_users gauge',
+        'chat_registered_users '
+        f'{len(server.users) + server.storage.stored_users()}',
+        '# TYPE chat_scheduled_messages gauge',
+        f'chat_scheduled_messages {len(server.scheduler)}',
+        '# TYPE chat_event_loop_lag_seconds gauge',
+        f'chat_event_loop_lag_seconds {server.loop_lag.last}',
+        '# TYPE chat_event_loop_lag_histogram_seconds histogram',
+        *_histogram_lines(
+            'chat_event_loop_lag_histogram_seconds', server.loop_lag.histogram
+        ),
+        '# TYPE chat_commands_total counter',
+        *(
+            f'chat_commands_total{{command="{command}"}} {histogram.count}'
+            for command, histogram in server.command_metrics.histograms.items()
+        ),
+        '# TYPE chat_command_duration_seconds histogram',
+    ]
+    for command, histogram in server.command_metrics.histograms.items():
+        lines.extend(_histogram_lines(
+            'chat_command_duration_seconds', histogram,
+            f'command="{command}"'
+        ))
+
+    depths = Histogram(QUEUE_DEPTH_BUCKETS)
+    for connection in server.connections.values():
+        depths.observe(connection.queue_depth)
+    outbound = server.outbound
+    lines.extend([
+        '# TYPE chat_outbound_queue_depth histogram',
+        *_histogram_lines('chat_outbound_queue_depth', depths),
+        '# TYPE chat_outbound_dropped_frames_total counter',
+        f'chat_outbound_dropped_frames_total {outbound.dropped}',
+        '# TYPE chat_outbound_sent_frames_total counter',
+        f'chat_outbound_sent_frames_total {outbound.frames_sent}',
+        '# TYPE chat_outbound_socket_writes_total counter',
+        f'chat_outbound_socket_writes_total {outbound.writes}',
+    ])
+
+    admission = server.admission
+    lines.extend([
+        '# TYPE chat_sign_ins_active gauge',
+        f'chat_sign_ins_active {admission.sign_ins.used}',
+        '# TYPE chat_sign_ins_queued gauge',
+        f'chat_sign_ins_queued {admission.sign_ins.queued}',
+        '# TYPE chat_sign_ins_rejected_total counter',
+        f'chat_sign_ins_rejected_total {admission.rejected}',
+        '# TYPE chat_replay_bytes_in_flight gauge',
+        f'chat_replay_bytes_in_flight {admission.replay.used}',
+        '# TYPE chat_replay_stalled_total counter',
+        f'chat_replay_stalled_total {admission.stalled}',
+        '# TYPE chat_watched_connections gauge',
+        f'chat_watched_connections {len(server.heartbeat.wheel)}',
+        '# TYPE chat_heartbeat_pings_total counter',
+        f'chat_heartbeat_pings_total {server.heartbeat.pings}',
+        '# TYPE chat_idle_disconnects_total counter',
+        f'chat_idle_disconnects_total {server.heartbeat.timed_out}',
+    ])
+
+    private_messages = private_memory = 0
+    for chat in server.private_chats.values():
+        private_messages += len(chat)
+        private_memory += chat.memory
+    lines.extend([
+        '# TYPE chat_messages gauge',
+        f'chat_messages{{chat="general"}} {len(server.general_chat)}',
+        f'chat_messages{{chat="private"}} {private_messages}',
+        '# TYPE chat_memory_bytes gauge',
+        f'chat_memory_bytes{{chat="general"}} {server.general_chat.memory}',
+        f'chat_memory_bytes{{chat="private"}} {private_memory}',
+        '# TYPE chat_private_chats gauge',
+        f'chat_private_chats {len(server.private_chats)}',
+    ])
+    if resource is not None:
+        # ru_maxrss в Linux измеряется в килобайтах.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        lines.append('# TYPE chat_process_max_rss_bytes gauge')
+        lines.append(f'chat_process_max_rss_bytes {max_rss}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsEndpoint:
+    """
+    HTTP-порт, на любой запрос отдающий метрики сервера
+    в формате Prometheus.
+    """
+
+    def __init__(self, server: 'ChatServer', host: str, port: int) -> None:
+        self.server = server
+        self.host: str = host
+        self.port: int = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(
+            self.handle_request, self.host, self.port
+        )
+        logger.info(metrics_started, self.host, self.port)
+
+    async def handle_request(
+            self,
+            reader: StreamReader,
+            writer: StreamWriter
+    ) -> None:
+        try:
+            # Строка запроса и заголовки не важны: читаем их до пустой строки.
+            while (await reader.readline()).strip():
+                pass
+            body = render_prometheus(self.server).encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/plain; version=0.0.4\r\n'
+                b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                b'Connection: close\r\n\r\n' + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
@@ -0,0 +1,185 @@
+import asyncio
+import struct
+from asyncio.streams import StreamReader
+from typing import Iterable, Optional
+
+# Разделитель кадров: каждая команда и каждая строка ответа
+# заканчивается переводом строки.
+FRAME_DELIMITER = b'\n'
+
+# Форматы протокола, которые клиент может выбрать при /sign_in.
+TEXT_FORMAT = 'text'
+BINARY_FORMAT = 'binary'
+
+# Двоичный формат: кадр - длина тела (4 байта, big-endian) и тело,
+# первый байт которого - тип кадра.
+FRAME_LENGTH = struct.Struct('>I')
+FRAME_HEADER = struct.Struct('>IB')
+# Ответ сервера - текст в UTF-8.
+FRAME_TEXT = 0
+# Сообщения общего чата.
+FRAME_GENERAL = 1
+# Новые личные сообщения, получение которых клиент подтверждает /ack.
+FRAME_PRIVATE = 2
+# Страница истории личного чата.
+FRAME_HISTORY = 3
+# Команда клиента: длина имени команды, имя и аргументы.
+FRAME_COMMAND = 4
+COMMAND_HEADER = struct.Struct('>H')
+# Запись сообщения в кадрах с сообщениями: seq, длина имени
+# отправителя и длина текста в байтах, затем имя и текст.
+ENTRY_HEADER = struct.Struct('>QHI')
+# Переводы строк внутри команды заменяются пробелами: иначе текст
+# сообщения из двоичного кадра подделал бы строки в потоках текстовых
+# клиентов и разорвал бы запись журнала (storage.RECORD_DELIMITER).
+LINE_BREAKS = str.maketrans('\r\n', '  ')
+
+
+class FrameTooLarge(Exception):
+    """Кадр превысил допустимый размер и был пропущен целиком."""
+
+
+async def read_frame(reader: StreamReader) -> Optional[bytes]:
+    """
+    Чтение одного кадра из потока без разделителя.
+
+    Максимальный размер кадра задаётся параметром limit у StreamReader
+    (asyncio.start_server / asyncio.open_connection). Слишком длинный
+    кадр пропускается до ближайшего разделителя, после чего выбрасывается
+    FrameTooLarge - следующие кадры читаются как обычно.
+    Возвращает None, когда соединение закрыто.
+    """
+    try:
+        frame = await reader.readuntil(FRAME_DELIMITER)
+    except asyncio.IncompleteReadError as error:
+        # Последний кадр перед закрытием соединения без разделителя.
+        return error.partial or None
+    except ConnectionError:
+        # Соединение сброшено клиентом, например посреди отправки
+        # ему большого ответа.
+        return None
+    except asyncio.LimitOverrunError as error:
+        await _skip_frame(reader, error.consumed)
+        raise FrameTooLarge
+    return frame[:-len(FRAME_DELIMITER)]
+
+
+async def _skip_frame(reader: StreamReader, consumed: int) -> None:
+    """Пропуск остатка слишком длинного кадра вместе с разделителем."""
+    while True:
+        try:
+            await reader.readexactly(consumed)
+            await reader.readuntil(FRAME_DELIMITER)
+            return
+        except asyncio.IncompleteReadError:
+            return
+        except asyncio.LimitOverrunError as error:
+            consumed = error.consumed
+
+
+def parse_command(frame: bytes) -> tuple[str, str]:
+    """
+    Разбор кадра на команду и строку её аргументов.
+
+    Кадр разбирается один раз: аргументы передаются обработчику как
+    есть, чтобы текст сообщения не пересобирался из слов и сохранял
+    исходные пробелы.
+    """
+    command, _, args = (
+        frame.decode(errors='replace').strip().translate(LINE_BREAKS)
+        .partition(' ')
+    )
+    return command, args.lstrip()
+
+
+def encode_frame(text: str) -> bytes:
+    """Кодирование строки в кадр с разделителем на конце."""
+    return text.encode() + FRAME_DELIMITER
+
+
+async def read_binary_frame(
+        reader: StreamReader,
+        max_size: int
+) -> Optional[bytes]:
+    """
+    Чтение одного кадра двоичного формата: тип кадра и тело.
+
+    Кадр длиннее max_size пропускается целиком, после чего
+    выбрасывается FrameTooLarge. Возвращает None, когда соединение
+    закрыто.
+    """
+    try:
+        (length,) = FRAME_LENGTH.unpack(
+            await reader.readexactly(FRAME_LENGTH.size)
+        )
+        if length > max_size:
+            while length:
+                skipped = min(length, max_size)
+                await reader.readexactly(skipped)
+                length -= skipped
+            raise FrameTooLarge
+        return await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def encode_binary_frame(frame_type: int, body: bytes) -> bytes:
+    """Кодирование кадра двоичного формата."""
+    return FRAME_HEADER.pack(len(body) + 1, frame_type) + body
+
+
+def encode_entries(
+        frame_type: int,
+        entries: Iterable[tuple[int, str, str]]
+) -> bytes:
+    """Кадр с сообщениями: (seq, отправитель, текст)."""
+    parts = []
+    for seq, sender, text in entries:
+        sender_bytes = sender.encode()
+        text_bytes = text.encode()
+        parts.append(
+            ENTRY_HEADER.pack(seq, len(sender_bytes), len(text_bytes))
+        )
+        parts.append(sender_bytes)
+        parts.append(text_bytes)
+    return encode_binary_frame(frame_type, b''.join(parts))
+
+
+def decode_entries(frame: bytes) -> list[tuple[int, str, str]]:
+    """Разбор кадра с сообщениями, полученного read_binary_frame."""
+    entries = []
+    offset = 1
+    while offset < len(frame):
+        seq, sender_size, text_size = ENTRY_HEADER.unpack_from(frame, offset)
+        offset += ENTRY_HEADER.size
+        sender = frame[offset:offset + sender_size].decode(errors='replace')
+        offset += sender_size
+        text = frame[offset:offset + text_size].decode(errors='replace')
+        offset += text_size
+        entries.append((seq, sender, text))
+    return entries
+
+
+def encode_command(command: str, args: str) -> bytes:
+    """Кадр двоичного формата с командой клиента."""
+    command_bytes = command.encode()
+    return encode_binary_frame(
+        FRAME_COMMAND,
+        COMMAND_HEADER.pack(len(command_bytes)) + command_bytes + args.encode()
+    )
+
+
+def parse_binary_command(frame: bytes) -> tuple[str, str]:
+    """
+    Разбор кадра двоичного формата на команду и строку её аргументов.
+
+    Кадры других типов и повреждённые кадры дают пустую команду.
+    Переводы строк в команде и аргументах заменяются пробелами.
+    """
+    if len(frame) < 1 + COMMAND_HEADER.size or frame[0] != FRAME_COMMAND:
+        return '', ''
+    (size,) = COMMAND_HEADER.unpack_from(frame, 1)
+    start = 1 + COMMAND_HEADER.size
+    command = frame[start:start + size].decode(errors='replace')
+    args = frame[start + size:].decode(errors='replace')
+    return command.translate(LINE_BREAKS), args.translate(LINE_BREAKS)
@@ -0,0 +1,116 @@
+from typing import Hashable
+
+from config import (
+    RATE_LIMITS,
+    RATE_LIMIT_SEPARATE,
+    RATE_LIMIT_IDLE_TIME,
+    RATE_LIMIT_MAX_VIOLATIONS,
+    RATE_LIMIT_VIOLATION_WINDOW,
+)
+
+# Ключ общего лимита на все команды в RATE_LIMITS.
+ALL_COMMANDS = '*'
+
+# Результаты проверки лимита.
+RATE_OK = 'ok'
+RATE_LIMITED = 'limited'
+RATE_BAN = 'ban'
+
+
+class LimitState:
+    """
+    Корзины токенов одного клиента.
+
+    Токены всех лимитов хранятся одним списком в порядке RATE_LIMITS
+    и пополняются разом по времени последнего обращения.
+    """
+
+    __slots__ = ('tokens', 'updated', 'violations', 'window_start')
+
+    def __init__(self, tokens: list[float], now: float) -> None:
+        self.tokens: list[float] = tokens
+        self.updated: float = now
+        # Нарушения лимитов в текущем окне RATE_LIMIT_VIOLATION_WINDOW.
+        self.violations: int = 0
+        self.window_start: float = now
+
+
+class RateLimiter:
+    """
+    Ограничение частоты команд алгоритмом token bucket.
+
+    У каждого клиента есть общая корзина на все команды и отдельные
+    корзины на команды из limits. Команда проходит, если в каждой её
+    корзине есть токен; команды из separate списывают токен только
+    из своей корзины. Клиент, нарушивший лимиты max_violations раз
+    за window секунд, получает результат RATE_BAN.
+
+    Состояние клиентов, не присылавших команд дольше idle_time
+    секунд, удаляется: их корзины к этому времени всё равно полны.
+    """
+
+    def __init__(
+            self,
+            limits: dict[str, tuple[float, float]] = RATE_LIMITS,
+            separate: frozenset[str] = RATE_LIMIT_SEPARATE,
+            idle_time: float = RATE_LIMIT_IDLE_TIME,
+            max_violations: int = RATE_LIMIT_MAX_VIOLATIONS,
+            window: float = RATE_LIMIT_VIOLATION_WINDOW
+    ) -> None:
+        # {команда: индекс её корзины в LimitState.tokens}
+        self.indices: dict[str, int] = {
+            command: index for index, command in enumerate(limits)
+        }
+        self.rates: list[float] = [rate for rate, _ in limits.values()]
+        self.bursts: list[float] = [burst for _, burst in limits.values()]
+        self.separate: frozenset[str] = separate
+        self.idle_time: float = idle_time
+        self.max_violations: int = max_violations
+        self.window: float = window
+        self.states: dict[Hashable, LimitState] = {}
+        self._last_sweep: float = 0.0
+
+    def check(self, client: Hashable, command: str, now: float) -> str:
+        """Списание токена за команду. Возвращает результат RATE_*."""
+        if now - self._last_sweep > self.idle_time:
+            self._evict_idle(now)
+
+        state = self.states.get(client)
+        if state is None:
+            state = self.states[client] = LimitState(list(self.bursts), now)
+        else:
+            elapsed = now - state.updated
+            tokens = state.tokens
+            for index, rate in enumerate(self.rates):
+                tokens[index] = min(
+                    self.bursts[index], tokens[index] + elapsed * rate
+                )
+            state.updated = now
+
+        shared = None if command in self.separate else ALL_COMMANDS
+        buckets = [
+            index for index in (
+                self.indices.get(shared), self.indices.get(command)
+            )
+            if index is not None
+        ]
+        if all(state.tokens[index] >= 1 for index in buckets):
+            for index in buckets:
+                state.tokens[index] -= 1
+            return RATE_OK
+
+        if now - state.window_start > self.window:
+            state.window_start = now
+            state.violations = 0
+        state.violations += 1
+        if state.violations == self.max_violations:
+            return RATE_BAN
+        return RATE_LIMITED
+
+    def _evict_idle(self, now: float) -> None:
+        """Удаление состояния клиентов, долго не присылавших команд."""
+        self.states = {
+            client: state for client, state in self.states.items()
+            if now - state.updated <= self.idle_time
+        }
+        self._last_sweep = now
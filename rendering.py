@@ -0,0 +1,131 @@
+from asyncio.streams import StreamReader
+from typing import Iterable, Optional
+
+from config import MAX_FRAME_SIZE
+from config import Message
+from protocol import (
+    BINARY_FORMAT,
+    FRAME_GENERAL,
+    FRAME_HISTORY,
+    FRAME_PRIVATE,
+    FRAME_TEXT,
+    TEXT_FORMAT,
+    encode_binary_frame,
+    encode_entries,
+    parse_binary_command,
+    parse_command,
+    read_binary_frame,
+    read_frame,
+)
+from messages_templates import (
+    chat_message,
+    general_chat_new_message,
+    private_chat_new_message,
+)
+
+
+def render(template: str, *args: object) -> bytes:
+    """Подстановка аргументов в шаблон ответа и кодирование в байты."""
+    return template.format(*args).encode()
+
+
+def render_general_message(message: Message) -> bytes:
+    """
+    Кадр уведомления о новом сообщении общего чата.
+
+    Рендерится один раз на сообщение: один и тот же объект bytes
+    ставится в очереди всех получателей рассылки.
+    """
+    return render(general_chat_new_message, message.text, message.sender)
+
+
+def render_private_message(seq: int, message: Message) -> bytes:
+    """
+    Кадр личного сообщения для получателя.
+
+    seq нужен клиенту, чтобы подтвердить доставку командой /ack.
+    """
+    return render(private_chat_new_message, seq, message.sender, message.text)
+
+
+class TextWire:
+    """
+    Текстовый формат протокола: команды и ответы - строки UTF-8,
+    каждая заканчивается переводом строки.
+    """
+
+    name = TEXT_FORMAT
+
+    async def read_frame(self, reader: StreamReader) -> Optional[bytes]:
+        return await read_frame(reader)
+
+    def parse_command(self, frame: bytes) -> tuple[str, str]:
+        return parse_command(frame)
+
+    def text(self, data: bytes) -> bytes:
+        """Кадр с ответом, отрендеренным из шаблона."""
+        return data
+
+    def general(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        """Кадр с сообщениями общего чата."""
+        return b''.join(
+            render_general_message(message) for _, message in entries
+        )
+
+    def private(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        """Кадр с новыми личными сообщениями."""
+        return b''.join(
+            render_private_message(seq, message) for seq, message in entries
+        )
+
+    def history(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        """Кадр со страницей истории личного чата."""
+        return b''.join(
+            render(chat_message, seq, message.sender, message.text)
+            for seq, message in entries
+        )
+
+
+class BinaryWire(TextWire):
+    """
+    Двоичный формат протокола (см. protocol.py): кадры с длиной,
+    сообщения - записи фиксированной структуры без шаблонов, поэтому
+    пачка сообщений кодируется одним кадром и разбирается без
+    парсинга текста.
+    """
+
+    name = BINARY_FORMAT
+
+    async def read_frame(self, reader: StreamReader) -> Optional[bytes]:
+        return await read_binary_frame(reader, MAX_FRAME_SIZE)
+
+    def parse_command(self, frame: bytes) -> tuple[str, str]:
+        return parse_binary_command(frame)
+
+    def text(self, data: bytes) -> bytes:
+        return encode_binary_frame(FRAME_TEXT, data)
+
+    def general(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        return encode_entries(FRAME_GENERAL, _fields(entries))
+
+    def private(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        return encode_entries(FRAME_PRIVATE, _fields(entries))
+
+    def history(self, entries: Iterable[tuple[int, Message]]) -> bytes:
+        return encode_entries(FRAME_HISTORY, _fields(entries))
+
+
+def _fields(
+        entries: Iterable[tuple[int, Message]]
+) -> Iterable[tuple[int, str, str]]:
+    return (
+        (seq, message.sender, message.text) for seq, message in entries
+    )
+
+
+TEXT_WIRE = TextWire()
+# Форматы, которые клиент может выбрать при /sign_in: {имя: формат}.
+WIRE_FORMATS: dict[str, TextWire] = {
+    TEXT_FORMAT: TEXT_WIRE,
+    BINARY_FORMAT: BinaryWire(),
+}
@@ -0,0 +1,79 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING, Optional
+
+from config import (
+    PRIVATE_CHAT_MAX_AGE,
+    RETENTION_SWEEP_INTERVAL,
+    USER_IDLE_TIME,
+)
+from config import Status
+
+if TYPE_CHECKING:
+    from server import ChatServer
+
+
+class RetentionSweeper:
+    """
+    Периодическое освобождение памяти сервера.
+
+    Раз в interval секунд вытесняет из общего и личных чатов сообщения
+    старше их max_age (при добавлении сообщений это происходит само,
+    но в чат, куда никто не пишет, может долго ничего не добавляться)
+    и вытесняет в хранилище пользователей, которые не входили дольше
+    idle_time секунд, вместе с личными чатами, оба участника которых
+    вытеснены.
+    """
+
+    def __init__(
+            self,
+            server: 'ChatServer',
+            interval: float = RETENTION_SWEEP_INTERVAL,
+            idle_time: Optional[float] = USER_IDLE_TIME
+    ) -> None:
+        self.server = server
+        self.interval: float = interval
+        self.idle_time: Optional[float] = idle_time
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+    async def sweep(self) -> None:
+        now = time.time()
+        self.server.general_chat.trim(now)
+        if PRIVATE_CHAT_MAX_AGE is not None:
+            for chat in self.server.private_chats.values():
+                chat.trim(now)
+        if self.idle_time is not None and self.server.storage.evicts_users:
+            await self._evict_idle_users(now)
+
+    async def _evict_idle_users(self, now: float) -> None:
+        """
+        Вытеснение неактивных пользователей.
+
+        Не вытесняются пользователи с ожидающими отложенными
+        сообщениями и забаненные: их состояние нужно в памяти.
+        Событие публикует процесс, отвечающий за пользователя.
+        """
+        server = self.server
+        loop_time = asyncio.get_running_loop().time()
+        idle = [
+            username for username, user_info in server.users.items()
+            if user_info.status == Status.OFFLINE
+            and now - user_info.last_seen > self.idle_time
+            and username not in server.scheduler.scheduled_messages
+            and user_info.reports.end_of_ban <= loop_time
+            and server.bus.is_owner(username)
+        ]
+        for username in idle:
+            await server.bus.publish({'type': 'evict', 'username': username})
+
+    def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import time
+from asyncio import TimerHandle
+from typing import Awaitable, Callable, Optional, Union
+
+from config import Message
+
+
+class ScheduledMessage:
+    """Отложенное личное сообщение в очереди планировщика."""
+
+    __slots__ = ('deadline', 'owner', 'message_id', 'target', 'message',
+                 'cancelled')
+
+    def __init__(
+            self,
+            deadline: float,
+            owner: str,
+            message_id: int,
+            target: str,
+            message: Message
+    ) -> None:
+        # Время отправки по часам цикла событий (loop.time()).
+        self.deadline: float = deadline
+        self.owner: str = owner
+        self.message_id: int = message_id
+        self.target: str = target
+        self.message: Message = message
+        self.cancelled: bool = False
+
+    def __lt__(self, other: 'ScheduledMessage') -> bool:
+        return self.deadline < other.deadline
+
+
+class Scheduler:
+    """
+    Планировщик отложенных сообщений на основе двоичной кучи.
+
+    Вместо отдельной спящей задачи на каждое сообщение планировщик
+    держит компактные записи в куче и один таймер цикла событий,
+    настроенный на ближайший срок. Когда таймер срабатывает, все
+    сообщения с наступившим сроком отправляются одной пачкой.
+
+    Отмена помечает запись и убирает её из индекса за O(1), а сама
+    запись удаляется из кучи лениво, когда оказывается на вершине,
+    или при перестроении кучи, если отменённых записей стало больше
+    половины.
+
+    - Структура данных для self.scheduled_messages:
+    {username: {message_id: ScheduledMessage, ...}...}
+    """
+
+    def __init__(
+            self,
+            dispatch: Callable[[list[ScheduledMessage]], Awaitable[None]],
+            on_change: Callable[[], None] = lambda: None
+    ) -> None:
+        # Корутина, которая отправляет пачку сообщений с наступившим сроком.
+        self.dispatch = dispatch
+        # Вызывается при любом изменении набора запланированных сообщений.
+        self.on_change = on_change
+        self.scheduled_messages: dict[str, dict[int, ScheduledMessage]] = {}
+        self._heap: list[ScheduledMessage] = []
+        self._cancelled: int = 0
+        # Следующий ID сообщения каждого владельца. Не сбрасывается,
+        # когда сообщения владельца отправлены или отменены: иначе
+        # /cancel_delayed со старым ID отменил бы более новое сообщение.
+        self._next_ids: dict[str, int] = {}
+        self._timer: Optional[TimerHandle] = None
+        self._timer_deadline: Optional[float] = None
+        # Ссылки на задачи отправки, чтобы их не собрал сборщик мусора.
+        self._dispatching: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        """Количество ожидающих отправки сообщений."""
+        return len(self._heap) - self._cancelled
+
+    def schedule_at(
+            self,
+            owner: str,
+            target: str,
+            message: Message,
+            deadline: float,
+            message_id: Optional[int] = None
+    ) -> int:
+        """
+        Планирование сообщения на момент deadline по часам цикла событий.
+
+        Возвращает ID сообщения у владельца.
+        """
+        if message_id is None:
+            message_id = self._next_ids.get(owner, 0)
+        self._next_ids[owner] = max(
+            self._next_ids.get(owner, 0), message_id + 1
+        )
+        entry = ScheduledMessage(deadline, owner, message_id, target, message)
+        heapq.heappush(self._heap, entry)
+        self.scheduled_messages.setdefault(owner, {})[message_id] = entry
+        self._arm_timer()
+        self.on_change()
+        return message_id
+
+    def cancel(self, owner: str, message_id: int) -> bool:
+        """Отмена сообщения. Возвращает False, если такого сообщения нет."""
+        entry = self._forget(owner, message_id)
+        if entry is None:
+            return False
+        entry.cancelled = True
+        self._cancelled += 1
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [item for item in self._heap if not item.cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        self.on_change()
+        return True
+
+    def _forget(
+            self,
+            owner: str,
+            message_id: int
+    ) -> Optional[ScheduledMessage]:
+        """Удаление записи из индекса по владельцам."""
+        owner_messages = self.scheduled_messages.get(owner)
+        if not owner_messages or message_id not in owner_messages:
+            return None
+        entry = owner_messages.pop(message_id)
+        if not owner_messages:
+            del self.scheduled_messages[owner]
+        return entry
+
+    def _arm_timer(self) -> None:
+        """Настройка таймера на срок ближайшего сообщения."""
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+        if not self._heap:
+            return
+        deadline = self._heap[0].deadline
+        if self._timer is not None:
+            if self._timer_deadline <= deadline:
+                return
+            self._timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_at(deadline, self._fire)
+        self._timer_deadline = deadline
+
+    def _fire(self) -> None:
+        """Отправка всех сообщений, срок которых наступил."""
+        self._timer = None
+        self._timer_deadline = None
+        now = asyncio.get_running_loop().time()
+        batch = []
+        while self._heap and self._heap[0].deadline <= now:
+            entry = heapq.heappop(self._heap)
+            if entry.cancelled:
+                self._cancelled -= 1
+                continue
+            self._forget(entry.owner, entry.message_id)
+            batch.append(entry)
+        self._arm_timer()
+        if batch:
+            self.on_change()
+            task = asyncio.create_task(self.dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    def snapshot(self) -> dict:
+        """
+        Ожидающие сообщения со сроками по настенным часам
+        и следующие ID сообщений владельцев.
+        """
+        offset = time.time() - asyncio.get_running_loop().time()
+        return {
+            'messages': [
+                [entry.deadline + offset, entry.owner, entry.message_id,
+                 entry.target, entry.message.sender, entry.message.text]
+                for entry in self._heap
+                if not entry.cancelled
+            ],
+            'next_ids': dict(self._next_ids),
+        }
+
+    def restore(self, snapshot: Union[dict, list]) -> None:
+        """Восстановление сообщений из снимка snapshot()."""
+        if isinstance(snapshot, list):
+            # Снимок старой версии: только ожидающие сообщения.
+            snapshot = {'messages': snapshot, 'next_ids': {}}
+        for owner, next_id in snapshot['next_ids'].items():
+            self._next_ids[owner] = max(self._next_ids.get(owner, 0), next_id)
+        offset = time.time() - asyncio.get_running_loop().time()
+        for entry in snapshot['messages']:
+            wall_deadline, owner, message_id, target, sender, text = entry
+            self.schedule_at(
+                owner,
+                target,
+                Message(sender=sender, text=text),
+                wall_deadline - offset,
+                message_id
+            )
+
+    def close(self) -> None:
+        """Остановка таймера. Записи остаются в куче."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
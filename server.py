@@ -1,127 +1,379 @@
 import asyncio
-from asyncio import Task
+import time
 from asyncio.streams import StreamReader, StreamWriter
-from typing import Optional
+from typing import Awaitable, Callable, NamedTuple, Optional
 
+from admission import AdmissionControl
+from bus import LocalBus
+from connection import Connection, OutboundTotals
 from custom_logger import logger
-from config import ClientAddress, Message, ChatID, UserInfo
+from config import MAX_FRAME_SIZE, METRICS_HOST, METRICS_PORT
+from config import ClientAddress, ChatID, UserInfo
+from events import EventHandlers
+from heartbeat import HeartbeatMonitor, enable_keepalive
+from history import GeneralChat, PrivateChat
+from metrics import CommandMetrics, LoopLagMonitor, MetricsEndpoint
+from retention import RetentionSweeper
+from ratelimit import RATE_BAN, RATE_OK, RateLimiter
+from protocol import FrameTooLarge
+from scheduler import Scheduler
 from services import AuthHandlers, MessageHandlers
+from storage import Storage, chat_state, create_storage
 from messages_templates import (
     unknown_command,
     server_initialized,
     get_command,
     new_connection,
+    event_loop_selected,
     server_started,
     sign_in_required,
+    frame_too_large,
+    rate_limited,
+    auto_banned,
 )
 
+# Команда, под которой учитываются неизвестные серверу команды.
+UNKNOWN_COMMAND = '<unknown>'
+# Команда, под которой учитываются команды, отклонённые лимитом.
+RATE_LIMITED_COMMAND = '<rate_limited>'
+
+
+class Command(NamedTuple):
+    """Запись таблицы команд сервера."""
+    handler: Callable[..., Awaitable[Optional[str]]]
+    # Доступна ли команда без входа в систему. Такие обработчики
+    # получают соединение и адрес клиента и могут вернуть новое имя
+    # пользователя.
+    public: bool = False
+    # Учитывается ли команда в лимитах частоты команд.
+    rate_limited: bool = True
+
 
 class ChatServer:
     """
     Класс ChatServer предназначен для управления
     серверной частью чат-приложения.
-
-    - Структура данных для self.scheduled_messages:
-    {username: {task_id: asyncio.Task, task_id: asyncio.Task}...}
     """
 
-    def __init__(self, host: str = '127.0.0.1', port: int = 8000) -> None:
-        """Инициализация сервера."""
+    def __init__(
+            self,
+            host: str = '127.0.0.1',
+            port: int = 8000,
+            bus: Optional[LocalBus] = None,
+            metrics_port: Optional[int] = METRICS_PORT
+    ) -> None:
+        """
+        Инициализация сервера.
+
+        bus - шина, через которую применяются изменения состояния.
+        По умолчанию сервер работает в одном процессе (LocalBus).
+        metrics_port - порт с метриками в формате Prometheus
+        (None - порт не открывается).
+        """
         self.host: str = host
         self.port: int = port
         self.users: dict[str, UserInfo] = {}
-        self.general_chat: list[Message] = []
-        self.private_chats: dict[ChatID, list[Message]] = {}
-        self.scheduled_messages: dict[str, dict[int, Task]] = {}
+        self.general_chat: GeneralChat = GeneralChat()
+        self.private_chats: dict[ChatID, PrivateChat] = {}
+        # Индекс личных чатов каждого пользователя.
+        self.user_chats: dict[str, set[ChatID]] = {}
+        # Пользователи в режиме ONLINE.
+        self.online: set[str] = set()
+        # Соединения пользователей в режиме ONLINE, подключённых
+        # к этому процессу: по ним идёт рассылка общего чата.
+        self.connections: dict[str, Connection] = {}
+        self.event_handler = EventHandlers(self)
+        self.bus: LocalBus = bus or LocalBus()
+        self.bus.attach(
+            self.event_handler.apply, self.event_handler.sync_events
+        )
+        # На диск пишет только ведущий процесс, остальные лишь
+        # восстанавливают из хранилища состояние при старте.
+        self.storage: Storage = create_storage(
+            read_only=not self.bus.is_leader, directory=self.bus.data_dir
+        )
         self.auth_handler = AuthHandlers(self)
         self.message_handler = MessageHandlers(self)
-        self.auth_handlers = {
-            '/sign_in': self.auth_handler.handle_sign_in,
-            '/sign_out': self.auth_handler.handle_sign_out,
-        }
-        self.command_handlers = {
-            '/send_all': self.message_handler.handle_send_all,
-            '/send': self.message_handler.handle_send,
-            '/get_chat_with': self.message_handler.handle_get_chat_with,
-            '/status': self.message_handler.handle_status,
-            '/report': self.message_handler.handle_report,
-            '/send_delayed': self.message_handler.handle_send_delayed,
+        self.scheduler = Scheduler(
+            self.message_handler.send_scheduled_messages,
+            self.storage.scheduled_changed
+        )
+        self.heartbeat = HeartbeatMonitor()
+        # Счётчики исходящих очередей всех клиентов за время работы.
+        self.outbound = OutboundTotals()
+        self.commands: dict[str, Command] = {
+            '/sign_in': Command(self.auth_handler.handle_sign_in, True),
+            # /sign_out выполняется и при разрыве соединения,
+            # поэтому не ограничивается.
+            '/sign_out': Command(
+                self.auth_handler.handle_sign_out, True, False
+            ),
+            '/send_all': Command(self.message_handler.handle_send_all),
+            '/send': Command(self.message_handler.handle_send),
+            '/get_chat_with': Command(
+                self.message_handler.handle_get_chat_with
+            ),
+            '/status': Command(self.message_handler.handle_status),
+            '/report': Command(self.message_handler.handle_report),
+            '/send_delayed': Command(
+                self.message_handler.handle_send_delayed
+            ),
+            '/cancel_delayed': Command(
+                self.message_handler.handle_cancel_scheduled
+            ),
+            # Подтверждение приходит на каждое полученное личное
+            # сообщение, поэтому расходует только свой лимит.
+            '/ack': Command(self.message_handler.handle_ack),
+            # Ответ на пинг простаивающего соединения. Пинг приходит
+            # и до входа, поэтому команда доступна всем, но ограничена.
+            '/pong': Command(self.heartbeat.handle_pong, True),
         }
+        self.command_metrics = CommandMetrics()
+        self.rate_limiter = RateLimiter()
+        self.loop_lag = LoopLagMonitor()
+        self.admission = AdmissionControl(self.loop_lag)
+        self.retention = RetentionSweeper(self)
+        self.metrics_endpoint: Optional[MetricsEndpoint] = None
+        if metrics_port is not None:
+            self.metrics_endpoint = MetricsEndpoint(
+                self, METRICS_HOST, metrics_port
+            )
         logger.info(server_initialized, host, port)
 
-    def _require_sign_in(self, writer: StreamWriter) -> None:
+    def open_private_chat(self, chat_id: ChatID) -> PrivateChat:
+        """
+        Личный чат по его ID. Новый чат создаётся и добавляется
+        в индекс чатов обоих участников.
+        """
+        chat = self.private_chats.get(chat_id)
+        if chat is None:
+            chat = self.private_chats[chat_id] = PrivateChat()
+            for participant in chat_id:
+                self.user_chats.setdefault(participant, set()).add(chat_id)
+        return chat
+
+    def evict_private_chat(self, chat_id: ChatID) -> None:
+        """
+        Вытеснение личного чата в хранилище, когда вытеснены оба
+        его участника.
+        """
+        chat = self.private_chats.pop(chat_id)
+        for participant in chat_id:
+            chats = self.user_chats.get(participant)
+            if chats is not None:
+                chats.discard(chat_id)
+                if not chats:
+                    del self.user_chats[participant]
+        self.storage.chat_evicted(chat_id, chat_state(chat))
+
+    def is_registered(self, username: str) -> bool:
+        """Зарегистрирован ли пользователь, в памяти или в хранилище."""
+        return username in self.users or self.storage.is_stored(username)
+
+    async def ensure_user_loaded(self, username: str) -> bool:
+        """
+        Загрузка пользователя в память, если он был вытеснен в хранилище,
+        вместе с личными чатами, вытесненными вместе с ним.
+
+        Возвращает False, если такой пользователь не зарегистрирован.
+        """
+        if username in self.users:
+            return True
+        state = await self.storage.load_user(username)
+        # Пока состояние читалось, пользователя мог загрузить другой запрос.
+        if username in self.users:
+            return True
+        if state is None:
+            return False
+        if 'chats' not in state:
+            # Пользователь вытеснен старой версией без списка чатов.
+            state['chats'] = [
+                list(chat_id)
+                for chat_id in self.storage.stored_chats(username)
+            ]
+        await self.bus.publish(
+            {'type': 'restore', 'username': username, 'state': state}
+        )
+        for chat_id in list(self.user_chats.get(username, ())):
+            if chat_id not in self.private_chats:
+                await self.bus.publish({
+                    'type': 'restore_chat', 'chat_id': list(chat_id),
+                    'state': await self.storage.load_chat(chat_id),
+                })
+        return True
+
+    def outbound_stats(self) -> dict[str, dict[str, int]]:
+        """Глубина исходящих очередей, отброшенные и отправленные кадры."""
+        return {
+            username: {
+                'queue_depth': connection.queue_depth,
+                'dropped': connection.dropped,
+                'frames_sent': connection.frames_sent,
+                'writes': connection.writes,
+            }
+            for username, connection in self.connections.items()
+        }
+
+    def command_stats(self) -> dict[str, dict]:
+        """Количество и время выполнения команд каждого типа."""
+        return self.command_metrics.snapshot()
+
+    async def _check_rate(
+            self,
+            command: str,
+            writer: Connection,
+            username: Optional[str],
+            client_addr: ClientAddress
+    ) -> bool:
+        """
+        Проверка лимита частоты команд клиента.
+
+        Клиент определяется именем пользователя, а до входа в систему -
+        адресом. Пользователь, который продолжает превышать лимит,
+        банится так же, как по жалобам.
+        """
+        now = asyncio.get_running_loop().time()
+        result = self.rate_limiter.check(username or client_addr, command, now)
+        if result == RATE_OK:
+            return True
+        writer.write(rate_limited.format(command).encode())
+        if result == RATE_BAN and username:
+            logger.warning(auto_banned, username)
+            await self.bus.publish(
+                {'type': 'ban', 'username': username, 'time': time.time()}
+            )
+        return False
+
+    def _require_sign_in(self, writer: Connection) -> None:
         """Требование входа в систему, если пользователь не авторизован."""
         writer.write(sign_in_required.encode())
 
     async def handle_command(
             self,
             command: str,
-            command_args: list[str],
-            writer: StreamWriter,
+            args: str,
+            writer: Connection,
             username: Optional[str],
             client_addr: ClientAddress
     ) -> Optional[str]:
-        """Обработчик команд от клиентов."""
+        """
+        Обработчик команд от клиентов.
+
+        Обработчик находится по таблице self.commands и запускается,
+        только если клиент не превысил лимит частоты команд. Время
+        выполнения учитывается в self.command_metrics.
+        """
         logger.info(get_command, command, username)
-        if command in self.auth_handlers:
-            return await self.auth_handlers[command](
-                command_args, writer, username, client_addr
-            )
-        elif command in self.command_handlers:
-            # Команды из command_handlers могут выполнять только
+        started = time.perf_counter()
+        entry = self.commands.get(command)
+        limited = entry is None or entry.rate_limited
+        try:
+            if limited and not await self._check_rate(
+                    command, writer, username, client_addr
+            ):
+                command = RATE_LIMITED_COMMAND
+            elif entry is None:
+                writer.write(unknown_command.format(command).encode())
+                command = UNKNOWN_COMMAND
+            elif entry.public:
+                return await entry.handler(
+                    args, writer, username, client_addr
+                )
+            # Остальные команды могут выполнять только
             # авторизованные пользователи.
-            if not username:
+            elif not username:
                 self._require_sign_in(writer)
-                return
-            await self.command_handlers[command](
-                command_args, username
+            else:
+                await entry.handler(args, username)
+        finally:
+            self.command_metrics.observe(
+                command, time.perf_counter() - started
             )
-        else:
-            writer.write(unknown_command.format(command).encode())
 
     async def handle_client(
             self,
             reader: StreamReader,
-            writer: StreamWriter
+            stream_writer: StreamWriter
     ) -> None:
-        ip, port = writer.get_extra_info('peername')
+        ip, port = stream_writer.get_extra_info('peername')
         client_addr = ClientAddress(ip=ip, port=port)
         logger.info(new_connection, client_addr)
+        enable_keepalive(stream_writer.get_extra_info('socket'))
         username = None
+        # Все ответы клиенту идут через его исходящую очередь.
+        writer = Connection(stream_writer, totals=self.outbound)
+        self.heartbeat.watch(writer)
+        loop = asyncio.get_running_loop()
 
         while True:
-            data = await reader.read(4096)
+            try:
+                # Формат протокола может смениться командой /sign_in,
+                # поэтому кадр читается в текущем формате соединения.
+                data = await writer.wire.read_frame(reader)
+            except FrameTooLarge:
+                writer.last_activity = loop.time()
+                writer.write(frame_too_large.format(MAX_FRAME_SIZE).encode())
+                continue
 
-            if not data:
+            if data is None:
                 await self.handle_command(
-                    '/sign_out', [], writer, username, client_addr
+                    '/sign_out', '', writer, username, client_addr
                 )
                 break
 
-            message = data.decode().strip()
-            command, *command_args = message.split()
+            writer.last_activity = loop.time()
+            command, args = writer.wire.parse_command(data)
+            if not command:
+                continue
 
-            new_username = await self.handle_command(
-                command, command_args, writer, username, client_addr
-            )
+            writer.busy = True
+            try:
+                new_username = await self.handle_command(
+                    command, args, writer, username, client_addr
+                )
+            finally:
+                writer.busy = False
 
             if new_username:
                 username = new_username
 
-            await writer.drain()
-
+        self.heartbeat.forget(writer)
         writer.close()
 
     async def run(self) -> None:
+        self.storage.load(self)
+        await self.storage.start()
+        await self.bus.start()
+        self.loop_lag.start()
+        self.retention.start()
+        self.heartbeat.start()
+        if self.metrics_endpoint is not None:
+            await self.metrics_endpoint.start()
         server = await asyncio.start_server(
-            self.handle_client, self.host, self.port
+            self.handle_client, self.host, self.port, limit=MAX_FRAME_SIZE,
+            # В многопроцессном режиме все процессы слушают один порт,
+            # а ядро распределяет между ними новые подключения.
+            reuse_port=self.bus.reuse_port
         )
         logger.info(server_started, self.host, self.port)
-        await server.serve_forever()
-        # Функция asyncio.run() создает новый цикл событий,
-        # запускает переданную сопрограмму coro и в конце закрывает
-        # цикл событий. Если в программе используются асинхронные
-        # генераторы или пул потоков, то функция завершит их работу.
-        # Поэтому даже не обязательно:
-        # pending_tasks = asyncio.all_tasks()
-        # await asyncio.gather(*pending_tasks, return_exceptions=True)
+        logger.info(
+            event_loop_selected,
+            type(asyncio.get_running_loop()).__module__.partition('.')[0]
+        )
+        serving = asyncio.ensure_future(server.serve_forever())
+        bus_closed = asyncio.ensure_future(self.bus.wait_closed())
+        try:
+            await asyncio.wait(
+                {serving, bus_closed}, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            serving.cancel()
+            bus_closed.cancel()
+            await self.bus.close()
+            self.loop_lag.close()
+            self.retention.close()
+            self.heartbeat.close()
+            if self.metrics_endpoint is not None:
+                self.metrics_endpoint.close()
+            self.scheduler.close()
+            await self.storage.close()
@@ -1,29 +1,44 @@
 import asyncio
-from asyncio.streams import StreamWriter
+import time
 from typing import Optional
 
+from connection import Connection
 from custom_logger import logger
-from config import BAN_TIME, MAX_REPORTS
-from config import Status, ClientAddress, Message, ChatID, Report, UserInfo
+from config import CHAT_CHUNK_SIZE, CHAT_PAGE_MAX, CHAT_PAGE_SIZE
+from config import ROSTER_CHUNK_SIZE
+from config import Status, ChatID, ClientAddress, Message, Report
+from config import make_chat_id
+from events import (
+    REPORT_ADDED,
+    REPORT_DUPLICATE,
+    REPORT_BANNED,
+)
+from rendering import WIRE_FORMATS, TextWire, render
+from scheduler import ScheduledMessage
 from messages_templates import (
     ban,
     success_registration,
     already_signed_in,
     success_sign_in,
+    wire_format_switched,
+    unknown_wire_format,
     no_username,
     empty_message,
     no_username_or_empty_msg,
     message_sended,
     user_isnt_registered,
-    new_messages,
+    chat_page,
+    wrong_page_params,
+    wrong_ack_params,
+    no_such_private_message,
     no_messages_with_target_user,
     user_statuses,
+    private_chat_entry,
+    online_users,
     not_all_params_given,
     banned_user_message,
-    new_registration,
     signed_in,
     send_message,
-    send_private_message,
     get_private_chat,
     get_status,
     report_user,
@@ -45,7 +60,6 @@ from messages_templates import (
     cancel_scheduled_message,
     user_disconnected,
     user_already_signed_in,
-    general_chat_new_message,
 )
 
 
@@ -56,60 +70,239 @@ class AuthHandlers:
 
     async def handle_sign_in(
             self,
-            command_args: list[str],
-            writer: StreamWriter,
+            args: str,
+            writer: Connection,
             username: Optional[str],
             client_addr: ClientAddress
     ) -> Optional[str]:
         """Обработчик команды входа пользователя."""
+        command_args = args.split()
         if not command_args:
             writer.write(no_username.encode())
             return
 
+        wire = None
+        if len(command_args) > 1:
+            wire = WIRE_FORMATS.get(command_args[1])
+            if wire is None:
+                writer.write(render(
+                    unknown_wire_format, command_args[1],
+                    ', '.join(WIRE_FORMATS)
+                ))
+                return
+
         if username:
             writer.write(user_already_signed_in.encode())
             return
 
-        username = command_args[0]
-        if username not in self.server.users:
-            logger.info(new_registration, username)
-            user_info = UserInfo(
-                status=Status.ONLINE,
-                client_addr=client_addr,
-                reports=Report(),
-                writer=writer
+        # При массовом переподключении входы ждут своей очереди,
+        # чтобы отправка истории не задерживала рассылки.
+        admission = self.server.admission
+        if not await admission.enter(writer):
+            return
+        try:
+            return await self._sign_in(
+                command_args[0], writer, client_addr, wire
             )
-            self.server.users[username] = user_info
-            chat_log = self.server.general_chat[-20:]
-            writer.write(success_registration.format(chat_log).encode())
-            return username
+        finally:
+            admission.leave()
 
-        user_info = self.server.users[username]
-        if user_info.status == Status.ONLINE:
+    async def _sign_in(
+            self,
+            username: str,
+            writer: Connection,
+            client_addr: ClientAddress,
+            wire: Optional[TextWire] = None
+    ) -> Optional[str]:
+        """
+        Вход пользователя, получившего место в очереди на вход.
+
+        wire - запрошенный формат протокола. Соединение переходит на него
+        только после успешного входа: подтверждение уходит в прежнем
+        формате, всё после него - в новом, включая ответ на эту команду.
+        """
+        await self.server.ensure_user_loaded(username)
+        user_info = self.server.users.get(username)
+        if user_info is not None and user_info.status == Status.ONLINE:
+            writer.write(already_signed_in.encode())
+            return
+
+        result = await self.server.bus.publish(
+            {'type': 'sign_in', 'username': username,
+             'client_addr': list(client_addr)},
+            writer
+        )
+        # Пользователь мог успеть войти через другой процесс.
+        if result is None:
             writer.write(already_signed_in.encode())
             return
 
-        logger.info(signed_in, username)
-        user_info.status = Status.ONLINE
-        user_info.client_addr = client_addr
-        user_info.writer = writer
-        chat_log = user_info.unread_messages
-        writer.write(success_sign_in.format(chat_log).encode())
-        user_info.unread_messages.clear()
+        if wire is not None:
+            writer.write(render(wire_format_switched, wire.name))
+            writer.wire = wire
+
+        registered, cursor = result
+        general_chat = self.server.general_chat
+        backlog = general_chat.next_seq - max(cursor, general_chat.first_seq)
+        if registered:
+            writer.write(render(success_registration, backlog))
+        else:
+            logger.info(signed_in, username)
+            writer.write(render(success_sign_in, backlog))
+        await self._replay_backlog(username, writer, cursor)
         return username
-    
+
+    async def _replay_backlog(
+            self,
+            username: str,
+            writer: Connection,
+            cursor: int
+    ) -> None:
+        """
+        Отправка истории после входа: непрочитанных сообщений общего
+        чата и неподтверждённых личных сообщений.
+
+        История уходит частями по CHAT_CHUNK_SIZE сообщений: следующая
+        часть рендерится, только когда предыдущая отправлена в сокет,
+        поэтому на одного входящего пользователя в памяти не больше
+        одной части, сколько бы он ни пропустил, а все входящие вместе
+        отправляют не больше REPLAY_MAX_BYTES байтов. Курсор общего чата
+        сдвигается событием после отправки каждой части.
+
+        Пока история отправляется, рассылки пользователю не идут.
+        Когда она отправлена, то, что пришло за последнее ожидание,
+        ставится в очередь без ожидания, и тут же соединение
+        регистрируется для рассылок: сообщения не теряются и не
+        приходят дважды.
+        """
+        cursor = await self._stream_general(username, writer, cursor)
+        if cursor is None:
+            return
+        positions = await self._stream_private(username, writer)
+        if positions is None:
+            return
+        self._catch_up(username, writer, cursor, positions)
+        self.server.connections[username] = writer
+
+    async def _stream_general(
+            self,
+            username: str,
+            writer: Connection,
+            cursor: int
+    ) -> Optional[int]:
+        """
+        Отправка общего чата с курсора частями.
+
+        Возвращает новый курсор или None, если соединение закрылось.
+        """
+        general_chat = self.server.general_chat
+        while True:
+            start, messages = general_chat.read(
+                cursor, cursor + CHAT_CHUNK_SIZE
+            )
+            if not messages:
+                return cursor
+            if not await self.server.admission.send_replay(
+                    writer, writer.wire.general(enumerate(messages, start))
+            ):
+                return None
+            cursor = start + len(messages)
+            await self.server.bus.publish(
+                {'type': 'general_read', 'username': username,
+                 'cursor': cursor}
+            )
+
+    async def _stream_private(
+            self,
+            username: str,
+            writer: Connection
+    ) -> Optional[dict[ChatID, int]]:
+        """
+        Отправка неподтверждённых личных сообщений частями.
+
+        Возвращает {чат: seq следующего неотправленного сообщения}
+        или None, если соединение закрылось.
+        """
+        user_info = self.server.users[username]
+        positions = {}
+        for chat_id in list(self.server.user_chats.get(username, ())):
+            position = user_info.last_read.get(chat_id, -1) + 1
+            while True:
+                start, messages = self.server.private_chats[chat_id].read(
+                    position, position + CHAT_CHUNK_SIZE
+                )
+                if not messages:
+                    break
+                position = start + len(messages)
+                entries = _unacked(username, start, messages)
+                if entries and not await self.server.admission.send_replay(
+                        writer, writer.wire.private(entries)
+                ):
+                    return None
+            positions[chat_id] = position
+        return positions
+
+    def _catch_up(
+            self,
+            username: str,
+            writer: Connection,
+            cursor: int,
+            positions: dict[ChatID, int]
+    ) -> None:
+        """Постановка в очередь сообщений, пришедших за время отправки."""
+        general_chat = self.server.general_chat
+        start, messages = general_chat.read(cursor, general_chat.next_seq)
+        for offset in range(0, len(messages), CHAT_CHUNK_SIZE):
+            writer.write_frame(writer.wire.general(enumerate(
+                messages[offset:offset + CHAT_CHUNK_SIZE], start + offset
+            )))
+
+        last_read = self.server.users[username].last_read
+        for chat_id in self.server.user_chats.get(username, ()):
+            chat = self.server.private_chats[chat_id]
+            position = positions.get(chat_id, last_read.get(chat_id, -1) + 1)
+            entries = _unacked(username, *chat.read(position, chat.next_seq))
+            for offset in range(0, len(entries), CHAT_CHUNK_SIZE):
+                writer.write_frame(writer.wire.private(
+                    entries[offset:offset + CHAT_CHUNK_SIZE]
+                ))
+
     async def handle_sign_out(
             self,
-            command_args: list[str],
-            writer: StreamWriter,
+            args: str,
+            writer: Connection,
             username: Optional[str],
             client_addr: ClientAddress
     ) -> None:
         """Обработка выхода пользователя из системы."""
         logger.info(user_disconnected, username, client_addr)
         if username:
-            user_info = self.server.users[username]
-            user_info.status = Status.OFFLINE
+            # Пользователь, которому ещё не дослана история, получил
+            # общий чат только до своего курсора.
+            if username in self.server.connections:
+                cursor = self.server.general_chat.next_seq
+            else:
+                cursor = self.server.users[username].general_chat_cursor
+            await self.server.bus.publish(
+                {'type': 'sign_out', 'username': username,
+                 'time': time.time(), 'cursor': cursor}
+            )
+
+
+def _unacked(
+        username: str,
+        start: int,
+        messages: list[Message]
+) -> list[tuple[int, Message]]:
+    """
+    Личные сообщения для повторной отправки пользователю с их seq.
+
+    Свои сообщения пользователь видел при отправке.
+    """
+    return [
+        (seq, message) for seq, message in enumerate(messages, start)
+        if message.sender != username
+    ]
 
 
 class MessageHandlers:
@@ -140,7 +333,7 @@ class MessageHandlers:
 
     async def handle_send_all(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды отправки сообщения всем пользователям."""
@@ -148,42 +341,20 @@ class MessageHandlers:
             return
 
         writer = self.server.users[username].writer
-        if not command_args:
+        if not args.strip():
             writer.write(empty_message.encode())
             return
 
         logger.info(send_message, username)
-        message = ' '.join(command_args)
-        self.server.general_chat.append(
-            Message(sender=username, text=message)
-        )
         writer.write(successfully_sended.encode())
-        for user in self.server.users:
-            user_info = self.server.users[user]
-            user_info.unread_messages.append(
-                Message(sender=username, text=message)
-            )
-
-            # NOTE Реализация отправки новых сообщений
-            # всем пользователям в режиме ONLINE сразу же после добавления
-            # нового сообщения в общий чат.
-            if user_info.status == Status.ONLINE:
-                user_writer = user_info.writer
-                # Попробуем отправить сообщение, но будем готовы к ошибкам.
-                # Например, если пользователь внезапно отключится.
-                try:
-                    user_writer.write(
-                        general_chat_new_message.format(message, username).encode()
-                    )
-                    await user_writer.drain()
-                # NOTE Это нужно, так как во время отправки какой-то из 
-                # пользователей self.server.user может выйти из приложения.
-                except ConnectionResetError:
-                    pass
+        await self.server.bus.publish(
+            {'type': 'general', 'sender': username,
+             'text': args}
+        )
 
     async def handle_send(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды отправки личного сообщения."""
@@ -191,134 +362,212 @@ class MessageHandlers:
             return
 
         writer = self.server.users[username].writer
-        if len(command_args) < 2:
+        target_username, _, text = args.partition(' ')
+        if not text.strip():
             writer.write(no_username_or_empty_msg.encode())
             return
 
-        target_username = command_args[0]
-        if target_username in self.server.users:
-            chat_id = ChatID(id=tuple(sorted([username, target_username])))
-
-            if chat_id not in self.server.private_chats:
-                self.server.private_chats[chat_id] = []
-
-            self.server.private_chats[chat_id].append(
-                Message(sender=username, text=' '.join(command_args[1:]))
+        # Вытесненный получатель загружается вместе с чатом, чтобы
+        # сообщение получило следующий seq этого чата.
+        if await self.server.ensure_user_loaded(target_username):
+            await self.server.bus.publish(
+                {'type': 'private', 'sender': username,
+                 'target': target_username, 'text': text}
             )
-            logger.info(send_private_message, username, target_username)
             writer.write(message_sended.format(target_username).encode())
         else:
             writer.write(user_isnt_registered.format(target_username).encode())
 
     async def handle_get_chat_with(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды получения личного чата с пользователем."""
         writer = self.server.users[username].writer
 
+        command_args = args.split()
         if not command_args:
             writer.write(no_username.encode())
             return
 
-        target_username = command_args[0]
-
-        chat_id = ChatID(id=tuple(sorted([username, target_username])))
+        target_username, *page_args = command_args
+        try:
+            limit = int(page_args[0]) if page_args else CHAT_PAGE_SIZE
+            before_seq = int(page_args[1]) if len(page_args) > 1 else None
+        except ValueError:
+            writer.write(wrong_page_params.encode())
+            return
+        limit = max(1, min(limit, CHAT_PAGE_MAX))
 
-        if chat_id in self.server.private_chats:
-            logger.info(get_private_chat, username, target_username)
-            # Получаем индекс последнего прочитанного сообщения для этого чата.
-            user_info = self.server.users[username]
-            last_read_index = user_info.last_read.get(chat_id, -1)
+        chat_id = make_chat_id(username, target_username)
+        chat = self.server.private_chats.get(chat_id)
+        if chat is None:
+            writer.write(no_messages_with_target_user.encode())
+            return
 
-            # Отправляем все сообщения начиная с последнего прочитанного.
-            unread_messages = (
-                self.server.private_chats[chat_id][last_read_index + 1:]
+        logger.info(get_private_chat, username, target_username)
+        # seq последнего прочитанного сообщения в этом чате.
+        last_read = self.server.users[username].last_read.get(chat_id, -1)
+        if before_seq is None:
+            # Следующая страница непрочитанных сообщений.
+            start, messages = chat.read(last_read + 1, last_read + 1 + limit)
+            if messages:
+                last_read = start + len(messages) - 1
+        else:
+            # Страница истории перед before_seq, курсор не меняется.
+            # seq за концом чата означает последние limit сообщений.
+            before_seq = min(before_seq, chat.next_seq)
+            start, messages = chat.read(before_seq - limit, before_seq)
+
+        writer.write(render(
+            chat_page, target_username, len(messages),
+            chat.unread_count(last_read)
+        ))
+        # Страница уходит частями: следующая часть рендерится,
+        # только когда предыдущая отправлена в сокет.
+        for offset in range(0, len(messages), CHAT_CHUNK_SIZE):
+            writer.write_frame(writer.wire.history(enumerate(
+                messages[offset:offset + CHAT_CHUNK_SIZE], start + offset
+            )))
+            await writer.drain()
+
+        if before_seq is None and messages:
+            await self.server.bus.publish(
+                {'type': 'read', 'username': username,
+                 'chat_id': list(chat_id), 'index': last_read}
             )
-            writer.write(new_messages.format(unread_messages).encode())
 
-            # Обновляем индекс последнего прочитанного сообщения.
-            user_info.last_read[chat_id] = (
-                len(self.server.private_chats[chat_id]) - 1
-            )
+    async def handle_ack(
+            self,
+            args: str,
+            username: Optional[str]
+    ) -> None:
+        """
+        Обработчик подтверждения доставки личного сообщения.
 
-        else:
-            writer.write(no_messages_with_target_user.encode())
+        Подтверждение накопительное: /ack <username> <seq> отмечает
+        прочитанными все сообщения чата с номером до seq включительно.
+        Успешное подтверждение остаётся без ответа.
+        """
+        user_info = self.server.users[username]
+        writer = user_info.writer
+
+        command_args = args.split()
+        try:
+            target_username, seq = command_args
+            seq = int(seq)
+        except ValueError:
+            writer.write(wrong_ack_params.encode())
+            return
+
+        chat_id = make_chat_id(username, target_username)
+        chat = self.server.private_chats.get(chat_id)
+        if chat is None or not 0 <= seq < chat.next_seq:
+            writer.write(render(no_such_private_message, seq, target_username))
+            return
+
+        # Повторные и запоздавшие подтверждения не порождают событий.
+        if seq > user_info.last_read.get(chat_id, -1):
+            await self.server.bus.publish(
+                {'type': 'read', 'username': username,
+                 'chat_id': list(chat_id), 'index': seq}
+            )
 
     async def handle_status(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды проверки статуса пользователя."""
-        writer = self.server.users[username].writer
+        user_info = self.server.users[username]
+        writer = user_info.writer
 
         logger.info(get_status, username)
-        users_info = (
-            [(username, user_info.status)
-             for username, user_info in self.server.users.items()]
-        )
-        writer.write(user_statuses.format(users_info).encode())
-        writer.write(
-            private.format(list(self.server.private_chats.keys())).encode()
-        )
+        online = self.server.online
+        if args.split() == ['online']:
+            await self._stream_online_users(writer, online)
+            return
+
+        # Вытесненные пользователи тоже не в сети.
+        offline = (len(self.server.users) - len(online)
+                   + self.server.storage.stored_users())
+        writer.write(render(user_statuses, len(online), offline))
+        chats = []
+        for chat_id in self.server.user_chats.get(username, ()):
+            companion = chat_id[1] if chat_id[0] == username else chat_id[0]
+            unread = self.server.private_chats[chat_id].unread_count(
+                user_info.last_read.get(chat_id, -1)
+            )
+            chats.append(private_chat_entry.format(companion, unread))
+        writer.write(render(private, ', '.join(chats) or '-'))
+
+    async def _stream_online_users(
+            self,
+            writer: Connection,
+            online: set[str]
+    ) -> None:
+        """Отправка списка пользователей в сети частями."""
+        # Снимок: пока список отправляется, пользователи входят и выходят.
+        usernames = list(online)
+        writer.write(render(online_users, len(usernames)))
+        for offset in range(0, len(usernames), ROSTER_CHUNK_SIZE):
+            chunk = usernames[offset:offset + ROSTER_CHUNK_SIZE]
+            writer.write(('\n'.join(chunk) + '\n').encode())
+            await writer.drain()
 
     async def handle_report(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды отправки жалобы на пользователя."""
         writer = self.server.users[username].writer
 
+        command_args = args.split()
         if not command_args:
             writer.write(no_username.encode())
             return
 
         target_username = command_args[0]
 
-        if target_username not in self.users:
+        if not await self.server.ensure_user_loaded(target_username):
             writer.write(no_such_user.encode())
             return
 
-        target_user_info = self.server.users[target_username]
-        users_who_reported_target_user = target_user_info.reports.reported_by
-        if username in users_who_reported_target_user:
+        result = await self.server.bus.publish(
+            {'type': 'report', 'username': username,
+             'target': target_username, 'time': time.time()}
+        )
+        if result == REPORT_DUPLICATE:
             writer.write(already_reported.format(target_username).encode())
             return
 
         logger.warning(report_user, username, target_username)
-        users_who_reported_target_user.append(username)
-        number_of_reports = (
-            len(target_user_info.reports.reported_by)
-        )
-
-        if number_of_reports < MAX_REPORTS:
+        if result == REPORT_ADDED:
             writer.write(report.format(target_username).encode())
-        elif number_of_reports == MAX_REPORTS:
-            time_now = asyncio.get_running_loop().time()
-            target_user_info.reports.end_of_ban = (time_now + BAN_TIME)
+        elif result == REPORT_BANNED:
             writer.write(user_banned.format(target_username).encode())
         else:
             writer.write(user_already_banned.format(target_username).encode())
 
     async def handle_send_delayed(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды отправки отложенного сообщения."""
         writer = self.server.users[username].writer
 
+        command_args = args.split(maxsplit=2)
         if len(command_args) < 3:
             writer.write(not_all_params_given.encode())
             return
 
-        target_username, delay, *message_text = command_args
+        target_username, delay, message_text = command_args
 
-        if target_username not in self.server.users:
-            writer.write(user_isnt_registered.encode())
+        if not self.server.is_registered(target_username):
+            writer.write(user_isnt_registered.format(target_username).encode())
             return
 
         try:
@@ -328,49 +577,50 @@ class MessageHandlers:
             return
 
         logger.info(create_scheduled_message, username, target_username, delay)
-        # Создание отложенной задачи
-        message = Message(sender=username, text=' '.join(message_text))
-        task = asyncio.create_task(
-            self.send_scheduled_message(
-                message,
-                target_username,
-                delay
-            )
+        message_id = await self.server.bus.publish(
+            {'type': 'schedule', 'sender': username,
+             'target': target_username, 'text': message_text,
+             'deadline': time.time() + delay}
         )
 
-        if username not in self.server.scheduled_messages:
-            self.server.scheduled_messages[username] = {}
-
-        message_id = len(self.server.scheduled_messages[username])
-
-        self.server.scheduled_messages[username][message_id] = task
-
         writer.write(
             added_scheduled_message.format(message_id, delay).encode()
         )
 
-    async def send_scheduled_message(
+    async def send_scheduled_messages(
             self,
-            message: Message,
-            target_username: str,
-            delay: int
+            batch: list[ScheduledMessage]
     ) -> None:
-        """Отправка отложенного сообщения."""
-        await asyncio.sleep(delay)
-        logger.info(sending_delayed_message, message.sender, target_username)
-        await self.handle_send(
-            [target_username, message.text],
-            message.sender
-        )
+        """
+        Отправка пачки отложенных сообщений, срок которых наступил.
+
+        Отложенные сообщения есть в планировщике каждого процесса,
+        но отправляет их только процесс, отвечающий за отправителя.
+        """
+        for entry in batch:
+            if not self.server.bus.is_owner(entry.message.sender):
+                continue
+            # Получатель мог быть вытеснен, пока сообщение ждало.
+            if not await self.server.ensure_user_loaded(entry.target):
+                continue
+            logger.info(
+                sending_delayed_message, entry.message.sender, entry.target
+            )
+            await self.server.bus.publish(
+                {'type': 'private', 'sender': entry.message.sender,
+                 'target': entry.target, 'text': entry.message.text,
+                 'scheduled': True}
+            )
 
     async def handle_cancel_scheduled(
             self,
-            command_args: list[str],
+            args: str,
             username: Optional[str]
     ) -> None:
         """Обработчик команды для отмены отложенного сообщения."""
         writer = self.server.users[username].writer
 
+        command_args = args.split()
         if len(command_args) != 1:
             writer.write(no_id_given.encode())
             return
@@ -381,12 +631,12 @@ class MessageHandlers:
             writer.write(wrong_id_format.encode())
             return
 
-        if (username in self.server.scheduled_messages
-                and message_id in self.server.scheduled_messages[username]):
-
+        cancelled = await self.server.bus.publish(
+            {'type': 'cancel', 'username': username,
+             'message_id': message_id}
+        )
+        if cancelled:
             logger.info(cancel_scheduled_message, username)
-            self.server.scheduled_messages[username][message_id].cancel()
-            del self.server.scheduled_messages[username][message_id]
             writer.write(
                 succefully_cancel_delayed_message.format(message_id).encode()
             )
@@ -0,0 +1,895 @@
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import time
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from custom_logger import logger
+from config import (
+    STORAGE_BACKEND,
+    DATA_DIR,
+    SEGMENT_SIZE,
+    GROUP_COMMIT_INTERVAL,
+    PRIVATE_CHAT_INDEX_INTERVAL,
+    USERS_CHECKPOINT_INTERVAL,
+)
+from config import Status, ClientAddress, Message, ChatID, Report, UserInfo
+from config import make_chat_id, to_loop_time, to_wall_time
+from history import PrivateChat
+from messages_templates import (
+    storage_loaded,
+    storage_orphan_removed,
+    storage_truncated,
+)
+
+if TYPE_CHECKING:
+    from server import ChatServer
+
+# Разделитель записей в сегменте. Перевод строки не может встретиться
+# внутри сообщения, так как служит разделителем кадров протокола.
+RECORD_DELIMITER = b'\n'
+# Разделитель полей записи. Это пробельный символ для str.split(),
+# поэтому он не может встретиться в имени пользователя.
+FIELD_DELIMITER = b'\x1f'
+
+
+class SegmentedLog:
+    """
+    Журнал записей только на добавление, разбитый на сегменты.
+
+    Записи копятся в памяти и сбрасываются на диск пачкой (group commit)
+    методом commit(), который выполняется вне цикла событий. Файл индекса
+    хранит число записей и размер каждого сегмента и переписывается
+    атомарно после fsync данных, поэтому служит точкой фиксации: всё,
+    что лежит в сегменте за пределами размера из индекса, при старте
+    считается недописанным и отрезается.
+
+    Структура каталога:
+        index.json
+        00000000.log
+        00000001.log
+        ...
+    """
+
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE):
+        self.directory: str = directory
+        self.segment_size: int = segment_size
+        self.index_path: str = os.path.join(directory, 'index.json')
+        # [{'name': str, 'count': int, 'size': int}, ...]
+        self.segments: list[dict] = []
+        self._pending: list[bytes] = []
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @property
+    def record_count(self) -> int:
+        """Количество зафиксированных на диске записей."""
+        return sum(segment['count'] for segment in self.segments)
+
+    def _load_index(self) -> None:
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.segments = json.load(index_file)['segments']
+        if not self.segments:
+            self.segments = [{'name': self._segment_name(0),
+                              'count': 0, 'size': 0}]
+
+        # Отрезаем всё, что было записано после последней фиксации.
+        last_segment = self.segments[-1]
+        path = self._segment_path(last_segment)
+        if os.path.exists(path) and (
+                os.path.getsize(path) > last_segment['size']):
+            logger.warning(storage_truncated, path, last_segment['size'])
+            with open(path, 'r+b') as segment_file:
+                segment_file.truncate(last_segment['size'])
+
+        # Сегмент, созданный при последней фиксации, мог попасть на диск
+        # раньше индекса: такие файлы не зафиксированы и удаляются.
+        known = {segment['name'] for segment in self.segments}
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.log') and name not in known:
+                logger.warning(storage_orphan_removed, name)
+                os.unlink(os.path.join(self.directory, name))
+
+    def _segment_name(self, number: int) -> str:
+        return f'{number:08d}.log'
+
+    def _segment_path(self, segment: dict) -> str:
+        return os.path.join(self.directory, segment['name'])
+
+    def append(self, record: bytes) -> None:
+        """Добавление записи в очередь на запись. Не блокирует."""
+        self._pending.append(record)
+
+    def take_pending(self) -> list[bytes]:
+        """Забрать накопленные записи для очередной фиксации."""
+        batch, self._pending = self._pending, []
+        return batch
+
+    def commit(self, batch: list[bytes]) -> None:
+        """
+        Запись пачки на диск с fsync и обновлением индекса.
+
+        Блокирующий метод: вызывается из пула потоков.
+        """
+        if not batch:
+            return
+        segment = self.segments[-1]
+        if segment['size'] >= self.segment_size:
+            segment = {'name': self._segment_name(len(self.segments)),
+                       'count': 0, 'size': 0}
+            self.segments.append(segment)
+
+        data = RECORD_DELIMITER.join(batch) + RECORD_DELIMITER
+        # Пустой по индексу сегмент пишется с начала файла: всё, что
+        # в нём лежит, осталось от незафиксированной пачки.
+        mode = 'ab' if segment['size'] else 'wb'
+        with open(self._segment_path(segment), mode) as segment_file:
+            segment_file.write(data)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        segment['count'] += len(batch)
+        segment['size'] += len(data)
+        self._write_index()
+
+    def _write_index(self) -> None:
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump({'segments': self.segments}, index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, self.index_path)
+
+    def _map_segment(self, segment: dict) -> Optional[mmap.mmap]:
+        if not segment['size']:
+            return None
+        with open(self._segment_path(segment), 'rb') as segment_file:
+            return mmap.mmap(
+                segment_file.fileno(), segment['size'],
+                access=mmap.ACCESS_READ
+            )
+
+    def read_all(self) -> list[bytes]:
+        """Все зафиксированные записи по порядку."""
+        records = []
+        for segment in self.segments:
+            mapped = self._map_segment(segment)
+            if mapped is None:
+                continue
+            with mapped:
+                records.extend(mapped[:-1].split(RECORD_DELIMITER))
+        return records
+
+    def read_tail(self, count: int) -> list[bytes]:
+        """
+        Последние count зафиксированных записей.
+
+        Благодаря индексу читаются только нужные сегменты, а внутри
+        сегмента записи ищутся с конца, без разбора всего файла.
+        """
+        records: list[bytes] = []
+        for segment in reversed(self.segments):
+            if len(records) >= count:
+                break
+            mapped = self._map_segment(segment)
+            if mapped is None:
+                continue
+            with mapped:
+                needed = min(count - len(records), segment['count'])
+                end = segment['size'] - 1
+                start = end
+                for _ in range(needed):
+                    start = mapped.rfind(RECORD_DELIMITER, 0, start)
+                records[:0] = mapped[start + 1:end].split(RECORD_DELIMITER)
+        return records
+
+    def read_reverse(self) -> Iterator[bytes]:
+        """
+        Зафиксированные записи от последней к первой.
+
+        Сегменты читаются по одному, поэтому, если остановить перебор,
+        начало журнала не читается вовсе.
+        """
+        for segment in reversed(self.segments):
+            mapped = self._map_segment(segment)
+            if mapped is None:
+                continue
+            with mapped:
+                records = mapped[:-1].split(RECORD_DELIMITER)
+            yield from reversed(records)
+
+
+def user_state(user_info: UserInfo) -> dict:
+    """Сохраняемое состояние пользователя в JSON-совместимом виде."""
+    return {
+        'general_chat_cursor': user_info.general_chat_cursor,
+        'last_read': [
+            [first, second, index]
+            for (first, second), index in user_info.last_read.items()
+        ],
+        'last_seen': user_info.last_seen,
+        'reported_by': list(user_info.reports.reported_by),
+        # Срок бана хранится по настенным часам: часы цикла событий
+        # начинаются заново при каждом запуске процесса.
+        'end_of_ban': (
+            to_wall_time(user_info.reports.end_of_ban)
+            if user_info.reports.end_of_ban else 0
+        ),
+    }
+
+
+def user_from_state(state: dict) -> UserInfo:
+    """Пользователь в режиме OFFLINE, восстановленный из user_state()."""
+    user_info = UserInfo(
+        status=Status.OFFLINE,
+        client_addr=ClientAddress(ip='', port=0),
+        reports=Report(),
+        writer=None
+    )
+    user_info.general_chat_cursor = state['general_chat_cursor']
+    user_info.last_read = {
+        make_chat_id(first, second): index
+        for first, second, index in state['last_read']
+    }
+    # Снимки старых версий не содержат времени выхода.
+    user_info.last_seen = state.get('last_seen', time.time())
+    user_info.reports.reported_by = list(state.get('reported_by', ()))
+    end_of_ban = state.get('end_of_ban', 0)
+    if end_of_ban:
+        user_info.reports.end_of_ban = to_loop_time(end_of_ban)
+    return user_info
+
+
+def chat_state(chat: PrivateChat) -> dict:
+    """Сохраняемое состояние личного чата: сообщения в памяти и их число."""
+    messages = chat.read(chat.first_seq, chat.next_seq)[1]
+    return {
+        'next_seq': chat.next_seq,
+        'messages': [[message.sender, message.text] for message in messages],
+    }
+
+
+def restore_chat(chat: PrivateChat, state: dict) -> None:
+    """Восстановление личного чата из chat_state()."""
+    chat.restore(
+        [Message(sender=sender, text=text)
+         for sender, text in state['messages']],
+        state['next_seq']
+    )
+
+
+class Storage:
+    """
+    Бэкенд хранения по умолчанию: состояние живёт только в памяти
+    и теряется при перезапуске сервера.
+
+    Сервер сообщает бэкенду о каждом изменении, а бэкенд сам решает,
+    что и когда сохранить.
+    """
+
+    def load(self, server: 'ChatServer') -> None:
+        """Восстановление состояния сервера при старте."""
+
+    def append_general(self, message: Message) -> None:
+        """Новое сообщение в общем чате."""
+
+    def append_private(self, chat_id: ChatID, message: Message) -> None:
+        """Новое сообщение в личном чате."""
+
+    def users_changed(self, username: str) -> None:
+        """Изменилось состояние пользователя username."""
+
+    def scheduled_changed(self) -> None:
+        """Изменился набор отложенных сообщений."""
+
+    # Может ли бэкенд хранить пользователей, вытесненных из памяти.
+    evicts_users: bool = False
+
+    def user_evicted(self, username: str, state: dict) -> None:
+        """Пользователь вытеснен из памяти, его состояние - state."""
+
+    def user_restored(self, username: str) -> None:
+        """Вытесненный пользователь снова загружен в память."""
+
+    def is_stored(self, username: str) -> bool:
+        """Есть ли в хранилище вытесненный пользователь. Не читает диск."""
+        return False
+
+    def stored_users(self) -> int:
+        """Количество вытесненных пользователей."""
+        return 0
+
+    async def load_user(self, username: str) -> Optional[dict]:
+        """Состояние вытесненного пользователя или None."""
+        return None
+
+    def chat_evicted(self, chat_id: ChatID, state: dict) -> None:
+        """Личный чат вытеснен из памяти вместе с участниками."""
+
+    def chat_restored(self, chat_id: ChatID) -> None:
+        """Вытесненный личный чат снова загружен в память."""
+
+    def stored_chats(self, username: str) -> list[ChatID]:
+        """Вытесненные личные чаты пользователя. Не читает диск."""
+        return []
+
+    async def load_chat(self, chat_id: ChatID) -> Optional[dict]:
+        """Состояние вытесненного личного чата или None."""
+        return None
+
+    async def start(self) -> None:
+        """Запуск фоновых задач бэкенда."""
+
+    async def close(self) -> None:
+        """Сохранение всех накопленных изменений."""
+
+
+class LogStorage(Storage):
+    """
+    Хранение на локальном диске.
+
+    Сообщения общего и личных чатов пишутся в отдельные журналы
+    SegmentedLog, отложенные сообщения - снимком в scheduled.json.
+    Состояние изменившегося пользователя дописывается записью в журнал
+    изменений users_log/<поколение>, а раз в USERS_CHECKPOINT_INTERVAL
+    записей все пользователи сохраняются снимком в users.json
+    и журнал начинается заново, поэтому вход или сдвиг курсора стоит
+    одной короткой записи, а не перезаписи всех пользователей.
+    Пользователи, вытесненные из памяти, хранятся по одному файлу
+    в каталоге cold_users и в users.json не попадают; их имена
+    держатся в памяти, чтобы проверять существование пользователя
+    без чтения диска. Личный чат, оба участника которого вытеснены,
+    так же хранится файлом в cold_chats и при старте в память
+    не читается. В chats.json раз в PRIVATE_CHAT_INDEX_INTERVAL
+    записей сохраняется число сообщений каждого личного чата, чтобы при
+    старте читать только хвост журнала личных чатов.
+    Раз в GROUP_COMMIT_INTERVAL секунд всё накопленное фиксируется
+    одной пачкой в пуле потоков, поэтому обработчики команд никогда
+    не ждут диска.
+    """
+
+    def __init__(
+            self,
+            directory: str = DATA_DIR,
+            commit_interval: float = GROUP_COMMIT_INTERVAL
+    ) -> None:
+        self.directory: str = directory
+        self.commit_interval: float = commit_interval
+        self.general_log = SegmentedLog(os.path.join(directory, 'general'))
+        self.private_log = SegmentedLog(os.path.join(directory, 'private'))
+        self.users_path: str = os.path.join(directory, 'users.json')
+        self.scheduled_path: str = os.path.join(directory, 'scheduled.json')
+        self.chats_path: str = os.path.join(directory, 'chats.json')
+        self.users_log_dir: str = os.path.join(directory, 'users_log')
+        self.cold_dir: str = os.path.join(directory, 'cold_users')
+        self.cold_chats_dir: str = os.path.join(directory, 'cold_chats')
+        os.makedirs(self.users_log_dir, exist_ok=True)
+        os.makedirs(self.cold_dir, exist_ok=True)
+        os.makedirs(self.cold_chats_dir, exist_ok=True)
+        # Вытесненные и восстановленные пользователи, ещё не записанные
+        # на диск.
+        self._evicted: dict[str, dict] = {}
+        self._restored: set[str] = set()
+        # Вытесненные пользователи из фиксации, которая сейчас выполняется.
+        self._inflight_evicted: dict[str, dict] = {}
+        # Имена пользователей, вытесненных в cold_users.
+        self._cold_names: set[str] = set()
+        # То же для личных чатов; у вытесненных чатов хранится число
+        # сообщений для chats.json.
+        self._evicted_chats: dict[ChatID, dict] = {}
+        self._restored_chats: set[ChatID] = set()
+        self._inflight_evicted_chats: dict[ChatID, dict] = {}
+        self._cold_chats: dict[ChatID, int] = {}
+        self.server: Optional['ChatServer'] = None
+        # Состояние всех пользователей из снимка users.json и журнала
+        # изменений, номер поколения снимка и журнал изменений после
+        # него. Меняются только в пуле потоков: в цикле событий
+        # собирается лишь состояние изменившихся пользователей.
+        self._users: dict[str, dict] = {}
+        self._users_generation: int = 0
+        self.users_log: Optional[SegmentedLog] = None
+        self._dirty_users: set[str] = set()
+        # Сколько записей журнала личных чатов учтено в chats.json.
+        self._chats_indexed: int = 0
+        self._scheduled_dirty: bool = False
+        self._commit_task: Optional[asyncio.Task] = None
+        # Фиксация, которая сейчас выполняется в пуле потоков.
+        self._inflight: Optional[asyncio.Future] = None
+
+    def load(self, server: 'ChatServer') -> None:
+        self.server = server
+
+        general_chat = server.general_chat
+        general_chat.restore(
+            [self._decode_message(record) for record
+             in self.general_log.read_tail(general_chat.retention)],
+            self.general_log.record_count
+        )
+
+        self._load_users(server)
+        self._cold_names = {
+            bytes.fromhex(name[:-len('.json')]).decode()
+            for name in os.listdir(self.cold_dir) if name.endswith('.json')
+        }
+        self._load_private_chats(server)
+
+        if os.path.exists(self.scheduled_path):
+            with open(self.scheduled_path) as scheduled_file:
+                server.scheduler.restore(json.load(scheduled_file))
+            # restore() отметил изменения, но снимок на диске актуален.
+            self._scheduled_dirty = False
+
+        logger.info(
+            storage_loaded,
+            len(server.users),
+            self.general_log.record_count,
+            self.private_log.record_count
+        )
+
+    def _load_private_chats(self, server: 'ChatServer') -> None:
+        """
+        Восстановление личных чатов.
+
+        Число сообщений каждого чата берётся из chats.json и дополняется
+        записями, добавленными после его сохранения. Затем журнал
+        читается с конца, пока каждый чат не получит столько последних
+        сообщений, сколько хранит в памяти. Чаты, оба участника которых
+        вытеснены, остаются в cold_chats; если такого файла ещё нет
+        (участники вытеснены старой версией), чат читается из журнала
+        и сразу вытесняется.
+        """
+        counts = self._private_chat_counts()
+        cold_files = self._list_cold_chats()
+        needed: dict[ChatID, int] = {}
+        for chat_id, count in counts.items():
+            warm = any(participant in server.users for participant in chat_id)
+            if chat_id in cold_files:
+                if not warm:
+                    self._cold_chats[chat_id] = count
+                    continue
+                # Участник был загружен, но файл не успели удалить.
+                self._restored_chats.add(chat_id)
+            retention = server.open_private_chat(chat_id).retention
+            needed[chat_id] = (
+                count if retention is None else min(count, retention)
+            )
+        remaining = sum(needed.values())
+        messages: dict[ChatID, list[Message]] = {
+            chat_id: [] for chat_id in needed
+        }
+        for record in self.private_log.read_reverse():
+            if not remaining:
+                break
+            chat_id, message = self._decode_private(record)
+            chat_messages = messages.get(chat_id)
+            if (chat_messages is not None
+                    and len(chat_messages) < needed[chat_id]):
+                chat_messages.append(message)
+                remaining -= 1
+        for chat_id, chat_messages in messages.items():
+            chat_messages.reverse()
+            server.private_chats[chat_id].restore(
+                chat_messages, counts[chat_id]
+            )
+            if not any(participant in server.users
+                       for participant in chat_id):
+                server.evict_private_chat(chat_id)
+
+    def _private_chat_counts(self) -> dict[ChatID, int]:
+        """Число сообщений каждого личного чата по chats.json и журналу."""
+        counts: dict[ChatID, int] = {}
+        if os.path.exists(self.chats_path):
+            with open(self.chats_path) as chats_file:
+                index = json.load(chats_file)
+            if index['records'] <= self.private_log.record_count:
+                self._chats_indexed = index['records']
+                counts = {
+                    make_chat_id(first, second): count
+                    for first, second, count in index['chats']
+                }
+        for record in self.private_log.read_tail(
+                self.private_log.record_count - self._chats_indexed
+        ):
+            chat_id = self._decode_private(record)[0]
+            counts[chat_id] = counts.get(chat_id, 0) + 1
+        return counts
+
+    def _list_cold_chats(self) -> set[ChatID]:
+        """ID чатов, лежащих в cold_chats."""
+        chats = set()
+        for name in os.listdir(self.cold_chats_dir):
+            if name.endswith('.json'):
+                first, second = name[:-len('.json')].split('-')
+                chats.add(make_chat_id(bytes.fromhex(first).decode(),
+                                       bytes.fromhex(second).decode()))
+        return chats
+
+    def _load_users(self, server: 'ChatServer') -> None:
+        """
+        Восстановление пользователей: снимок users.json, поверх которого
+        применяются записи журнала изменений его поколения.
+        """
+        if os.path.exists(self.users_path):
+            with open(self.users_path) as users_file:
+                snapshot = json.load(users_file)
+            if isinstance(snapshot.get('generation'), int):
+                self._users_generation = snapshot['generation']
+                self._users = snapshot['users']
+            else:
+                # Снимок старой версии: только пользователи, без журнала.
+                self._users = snapshot
+        self.users_log = self._open_users_log(self._users_generation)
+        for record in self.users_log.read_all():
+            username, state = json.loads(record)
+            if state is None:
+                self._users.pop(username, None)
+            else:
+                self._users[username] = state
+        self._remove_stale_users_logs()
+        for username, state in self._users.items():
+            server.users[username] = user_from_state(state)
+
+    def _open_users_log(self, generation: int) -> SegmentedLog:
+        return SegmentedLog(
+            os.path.join(self.users_log_dir, f'{generation:08d}')
+        )
+
+    def _remove_stale_users_logs(self) -> None:
+        """
+        Удаление журналов изменений других поколений: они остаются,
+        если сбой произошёл во время сохранения снимка users.json.
+        """
+        current = os.path.basename(self.users_log.directory)
+        for name in os.listdir(self.users_log_dir):
+            if name != current:
+                shutil.rmtree(os.path.join(self.users_log_dir, name))
+
+    @staticmethod
+    def _decode_message(record: bytes) -> Message:
+        sender, text = record.decode().split(FIELD_DELIMITER.decode(), 1)
+        return Message(sender=sender, text=text)
+
+    @staticmethod
+    def _decode_private(record: bytes) -> tuple[ChatID, Message]:
+        first, second, sender, text = (
+            record.decode().split(FIELD_DELIMITER.decode(), 3)
+        )
+        return make_chat_id(first, second), Message(sender=sender, text=text)
+
+    def append_general(self, message: Message) -> None:
+        self.general_log.append(
+            FIELD_DELIMITER.join((message.sender.encode(),
+                                  message.text.encode()))
+        )
+
+    def append_private(self, chat_id: ChatID, message: Message) -> None:
+        self.private_log.append(
+            FIELD_DELIMITER.join((chat_id[0].encode(), chat_id[1].encode(),
+                                  message.sender.encode(),
+                                  message.text.encode()))
+        )
+
+    def users_changed(self, username: str) -> None:
+        self._dirty_users.add(username)
+
+    def scheduled_changed(self) -> None:
+        self._scheduled_dirty = True
+
+    evicts_users = True
+
+    def user_evicted(self, username: str, state: dict) -> None:
+        self._cold_names.add(username)
+        self._evicted[username] = state
+        self._restored.discard(username)
+        self._dirty_users.add(username)
+
+    def user_restored(self, username: str) -> None:
+        self._cold_names.discard(username)
+        self._evicted.pop(username, None)
+        self._restored.add(username)
+        self._dirty_users.add(username)
+
+    def stored_users(self) -> int:
+        return len(self._cold_names)
+
+    def chat_evicted(self, chat_id: ChatID, state: dict) -> None:
+        self._cold_chats[chat_id] = state['next_seq']
+        self._evicted_chats[chat_id] = state
+        self._restored_chats.discard(chat_id)
+
+    def chat_restored(self, chat_id: ChatID) -> None:
+        self._cold_chats.pop(chat_id, None)
+        self._evicted_chats.pop(chat_id, None)
+        self._restored_chats.add(chat_id)
+
+    def stored_chats(self, username: str) -> list[ChatID]:
+        return [chat_id for chat_id in self._cold_chats if username in chat_id]
+
+    def _cold_chat_path(self, chat_id: ChatID) -> str:
+        return os.path.join(
+            self.cold_chats_dir,
+            f'{chat_id[0].encode().hex()}-{chat_id[1].encode().hex()}.json'
+        )
+
+    async def load_chat(self, chat_id: ChatID) -> Optional[dict]:
+        state = self._evicted_chats.get(chat_id) or (
+            self._inflight_evicted_chats.get(chat_id)
+        )
+        if state is not None:
+            return state
+        if chat_id not in self._cold_chats:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read_json, self._cold_chat_path(chat_id)
+        )
+
+    def _cold_path(self, username: str) -> str:
+        # Имя пользователя может содержать любые символы, поэтому
+        # в имени файла оно записано в шестнадцатеричном виде.
+        return os.path.join(self.cold_dir, username.encode().hex() + '.json')
+
+    def is_stored(self, username: str) -> bool:
+        return username in self._cold_names
+
+    async def load_user(self, username: str) -> Optional[dict]:
+        state = self._evicted.get(username) or self._inflight_evicted.get(
+            username
+        )
+        if state is not None:
+            return state
+        if username not in self._cold_names:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read_json, self._cold_path(username)
+        )
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[dict]:
+        """Чтение вытесненного состояния. Выполняется в пуле потоков."""
+        try:
+            with open(path) as cold_file:
+                return json.load(cold_file)
+        except FileNotFoundError:
+            return None
+
+    def _users_changes(self) -> dict[str, Optional[dict]]:
+        """
+        Состояние изменившихся пользователей; None - пользователь
+        вытеснен из памяти и из users.json удаляется.
+        """
+        changes = {}
+        for username in self._dirty_users:
+            user_info = self.server.users.get(username)
+            changes[username] = (
+                None if user_info is None else user_state(user_info)
+            )
+        self._dirty_users = set()
+        return changes
+
+    def _chats_index(self, records: int) -> dict:
+        """Число сообщений каждого личного чата для chats.json."""
+        return {
+            'records': records,
+            'chats': [
+                [first, second, chat.next_seq]
+                for (first, second), chat in self.server.private_chats.items()
+            ] + [
+                [first, second, count]
+                for (first, second), count in self._cold_chats.items()
+            ],
+        }
+
+    @staticmethod
+    def _write_snapshot(path: str, snapshot: object) -> None:
+        """Атомарная запись снимка в JSON-файл."""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, path)
+
+    def _commit(
+            self,
+            general_batch: list[bytes],
+            private_batch: list[bytes],
+            users_changes: dict[str, Optional[dict]],
+            scheduled_snapshot: Optional[list],
+            chats_index: Optional[dict],
+            evicted: dict[str, dict],
+            restored: set[str],
+            evicted_chats: dict[ChatID, dict],
+            restored_chats: set[ChatID]
+    ) -> None:
+        """Фиксация одной пачки изменений. Выполняется в пуле потоков."""
+        self.general_log.commit(general_batch)
+        self.private_log.commit(private_batch)
+        if chats_index is not None:
+            self._write_snapshot(self.chats_path, chats_index)
+        # Вытесненный пользователь сначала появляется в cold_users
+        # (а его чаты - в cold_chats) и только потом исчезает из журнала
+        # пользователей, а восстановленный - наоборот, поэтому после
+        # сбоя он найдётся хотя бы в одном месте.
+        cold = [(self._cold_path(username), state)
+                for username, state in evicted.items()]
+        cold += [(self._cold_chat_path(chat_id), state)
+                 for chat_id, state in evicted_chats.items()]
+        for path, state in cold:
+            self._write_snapshot(path, state)
+        if users_changes:
+            self._commit_users(users_changes)
+        stale = [self._cold_path(username) for username in restored]
+        stale += [self._cold_chat_path(chat_id) for chat_id in restored_chats]
+        for path in stale:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        if scheduled_snapshot is not None:
+            self._write_snapshot(self.scheduled_path, scheduled_snapshot)
+
+    def _commit_users(
+            self,
+            users_changes: dict[str, Optional[dict]]
+    ) -> None:
+        """Запись изменений пользователей в журнал (в пуле потоков)."""
+        self.users_log.commit([
+            json.dumps([username, state]).encode()
+            for username, state in users_changes.items()
+        ])
+        for username, state in users_changes.items():
+            if state is None:
+                self._users.pop(username, None)
+            else:
+                self._users[username] = state
+        if self.users_log.record_count >= USERS_CHECKPOINT_INTERVAL:
+            self._checkpoint_users()
+
+    def _checkpoint_users(self) -> None:
+        """
+        Снимок всех пользователей в users.json с новым, пустым журналом
+        изменений. Снимок указывает на поколение своего журнала, поэтому
+        до его замены действует прежняя пара снимок и журнал, а после -
+        новая. Выполняется в пуле потоков.
+        """
+        generation = self._users_generation + 1
+        users_log = self._open_users_log(generation)
+        self._write_snapshot(
+            self.users_path, {'generation': generation, 'users': self._users}
+        )
+        stale_directory = self.users_log.directory
+        self.users_log, self._users_generation = users_log, generation
+        shutil.rmtree(stale_directory)
+
+    async def commit(self, final: bool = False) -> None:
+        """
+        Фиксация всего накопленного к этому моменту.
+
+        final - последняя фиксация перед остановкой: chats.json
+        сохраняется, даже если интервал ещё не набран.
+        """
+        if self.server is None:
+            return
+        # Состояние сервера читается в цикле событий, чтобы не обращаться
+        # к нему из другого потока.
+        users_changes = self._users_changes()
+        scheduled_snapshot = None
+        if self._scheduled_dirty:
+            scheduled_snapshot = self.server.scheduler.snapshot()
+            self._scheduled_dirty = False
+        general_batch = self.general_log.take_pending()
+        private_batch = self.private_log.take_pending()
+        records = self.private_log.record_count + len(private_batch)
+        chats_index = None
+        if records > self._chats_indexed and (
+                final or records - self._chats_indexed
+                >= PRIVATE_CHAT_INDEX_INTERVAL):
+            chats_index = self._chats_index(records)
+            self._chats_indexed = records
+        evicted, self._evicted = self._evicted, {}
+        restored, self._restored = self._restored, set()
+        evicted_chats, self._evicted_chats = self._evicted_chats, {}
+        restored_chats, self._restored_chats = self._restored_chats, set()
+        if not (general_batch or private_batch or users_changes
+                or scheduled_snapshot is not None
+                or chats_index is not None
+                or evicted_chats or restored_chats):
+            return
+        loop = asyncio.get_running_loop()
+        self._inflight_evicted = evicted
+        self._inflight_evicted_chats = evicted_chats
+        self._inflight = loop.run_in_executor(
+            None, self._commit, general_batch, private_batch,
+            users_changes, scheduled_snapshot, chats_index, evicted, restored,
+            evicted_chats, restored_chats
+        )
+        self._inflight.add_done_callback(self._forget_inflight)
+        # shield: отмена ожидающей задачи не должна оставить
+        # недописанную пачку без присмотра, её дождётся close().
+        await asyncio.shield(self._inflight)
+
+    def _forget_inflight(self, future: asyncio.Future) -> None:
+        """Вытесненные пользователи из завершённой фиксации уже на диске."""
+        self._inflight_evicted = {}
+        self._inflight_evicted_chats = {}
+
+    async def _commit_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.commit_interval)
+            await self.commit()
+
+    async def start(self) -> None:
+        self._commit_task = asyncio.create_task(self._commit_loop())
+
+    async def close(self) -> None:
+        if self._commit_task is not None:
+            self._commit_task.cancel()
+            try:
+                await self._commit_task
+            except asyncio.CancelledError:
+                pass
+        if self._inflight is not None:
+            await self._inflight
+        await self.commit(final=True)
+
+
+class ReadOnlyLogStorage(LogStorage):
+    """
+    Хранение на локальном диске без записи.
+
+    Используется ведомыми рабочими процессами: они восстанавливают
+    состояние из того же каталога при старте, а все изменения
+    записывает на диск ведущий процесс.
+    """
+
+    def append_general(self, message: Message) -> None:
+        pass
+
+    def append_private(self, chat_id: ChatID, message: Message) -> None:
+        pass
+
+    def users_changed(self, username: str) -> None:
+        pass
+
+    def scheduled_changed(self) -> None:
+        pass
+
+    def user_evicted(self, username: str, state: dict) -> None:
+        self._cold_names.add(username)
+
+    def user_restored(self, username: str) -> None:
+        self._cold_names.discard(username)
+
+    def chat_evicted(self, chat_id: ChatID, state: dict) -> None:
+        self._cold_chats[chat_id] = state['next_seq']
+
+    def chat_restored(self, chat_id: ChatID) -> None:
+        self._cold_chats.pop(chat_id, None)
+
+    def _remove_stale_users_logs(self) -> None:
+        # Журналы удаляет ведущий процесс: новое поколение, которое он
+        # сейчас создаёт, для ведомого выглядело бы устаревшим.
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+def create_storage(
+        backend: str = STORAGE_BACKEND,
+        read_only: bool = False,
+        directory: str = DATA_DIR
+) -> Storage:
+    """Создание бэкенда хранения по его имени из конфигурации."""
+    if backend == 'memory':
+        return Storage()
+    if backend == 'log':
+        if read_only:
+            return ReadOnlyLogStorage(directory)
+        return LogStorage(directory)
+    raise ValueError(f'Неизвестный бэкенд хранения: {backend}')
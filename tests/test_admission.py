@@ -0,0 +1,143 @@
+import asyncio
+
+from admission import AdmissionControl, FairBudget
+from benchmark import NullStreamWriter
+from config import ClientAddress
+from connection import Connection
+from messages_templates import sign_in_queue_full, sign_in_queued
+from metrics import LoopLagMonitor
+from server import ChatServer
+from test_connection import RecordingStreamWriter
+
+ADDRESS = ClientAddress('127.0.0.1', 1)
+
+
+class StalledStreamWriter(NullStreamWriter):
+    """StreamWriter клиента, который не читает: drain() не завершается."""
+
+    async def drain(self) -> None:
+        await asyncio.get_running_loop().create_future()
+
+
+def test_stalled_replay_releases_slot_and_budget():
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        server.admission = AdmissionControl(
+            server.loop_lag, max_sign_ins=1, max_loop_lag=None,
+            drain_timeout=0.05
+        )
+        for index in range(5):
+            await server.bus.publish(
+                {'type': 'general', 'sender': 'writer', 'text': f'm{index}'}
+            )
+        stalled = Connection(StalledStreamWriter())
+        await server.auth_handler.handle_sign_in(
+            'stalled', stalled, None, ADDRESS
+        )
+        admission = server.admission
+        released = (admission.sign_ins.used, admission.replay.used)
+
+        writer = Connection(NullStreamWriter())
+        signed_in = await asyncio.wait_for(
+            server.auth_handler.handle_sign_in('alice', writer, None, ADDRESS),
+            1
+        )
+        return stalled.closed, admission.stalled, released, signed_in
+
+    closed, stalled, released, signed_in = asyncio.run(scenario())
+    assert closed
+    assert stalled == 1
+    assert released == (0, 0)
+    assert signed_in == 'alice'
+
+
+def test_fair_budget_serves_in_order_with_positions():
+    async def scenario():
+        budget = FairBudget(10)
+        assert budget.try_acquire(8)
+        positions = {'large': [], 'small': []}
+        granted = []
+
+        async def request(name, amount):
+            def on_wait(position):
+                positions[name].append(position)
+                return True
+
+            await budget.acquire(amount, 0.01, on_wait)
+            granted.append(name)
+
+        large = asyncio.create_task(request('large', 5))
+        await asyncio.sleep(0)
+        # Места хватает, но в очереди уже есть запрос.
+        assert not budget.try_acquire(1)
+        small = asyncio.create_task(request('small', 1))
+        await asyncio.sleep(0.03)
+        waiting = budget.queued, list(granted)
+        budget.release(8)
+        await asyncio.gather(large, small)
+        return waiting, granted, budget.used, positions
+
+    waiting, granted, used, positions = asyncio.run(scenario())
+    assert waiting == (2, [])
+    assert granted == ['large', 'small']
+    assert used == 6
+    assert set(positions['large']) == {1}
+    assert set(positions['small']) == {2}
+
+
+def test_fair_budget_oversize_request_waits_for_empty_budget():
+    async def scenario():
+        budget = FairBudget(10)
+        assert budget.try_acquire(3)
+        oversize = asyncio.create_task(budget.acquire(25))
+        await asyncio.sleep(0)
+        waiting = not oversize.done()
+        budget.release(3)
+        await oversize
+        return waiting, budget.used
+
+    assert asyncio.run(scenario()) == (True, 25)
+
+
+def test_fair_budget_waiter_leaving_queue_wakes_next():
+    async def scenario():
+        budget = FairBudget(1)
+        assert budget.try_acquire(1)
+        leaving = asyncio.create_task(
+            budget.acquire(1, 0.01, lambda position: False)
+        )
+        staying = asyncio.create_task(budget.acquire(1))
+        left = await leaving
+        budget.release(1)
+        await asyncio.wait_for(staying, 1)
+        return left, budget.queued, budget.used
+
+    assert asyncio.run(scenario()) == (False, 0, 1)
+
+
+def test_sign_in_queue_reports_position_and_rejects_when_full():
+    async def scenario():
+        loop_lag = LoopLagMonitor()
+        admission = AdmissionControl(
+            loop_lag, max_sign_ins=1, queue_size=1, progress_interval=0.01
+        )
+        first, queued, rejected = (
+            Connection(RecordingStreamWriter(), coalesce_delay=0)
+            for _ in range(3)
+        )
+        assert await admission.enter(first)
+        waiting = asyncio.create_task(admission.enter(queued))
+        await asyncio.sleep(0.02)
+        full = await admission.enter(rejected)
+        admission.leave()
+        entered = await asyncio.wait_for(waiting, 1)
+        for writer in (queued, rejected):
+            await writer.drain()
+        return (entered, full, admission.rejected,
+                queued.writer.batches, rejected.writer.batches)
+
+    entered, full, rejected_count, queued, rejected = asyncio.run(scenario())
+    assert entered and not full
+    assert rejected_count == 1
+    assert queued[0] == [sign_in_queued.format(1).encode()]
+    assert rejected == [[sign_in_queue_full.encode()]]
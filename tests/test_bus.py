@@ -0,0 +1,36 @@
+import asyncio
+
+from bus import BusHub, WorkerBus
+
+
+def test_workers_apply_events_in_one_order(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'bus.sock')
+        hub = BusHub(2, path)
+        server = await hub.start()
+        workers = [WorkerBus(worker_id, path) for worker_id in range(2)]
+        applied = {worker.worker_id: [] for worker in workers}
+        for worker in workers:
+            worker.attach(
+                lambda event, writer, log=applied[worker.worker_id]:
+                log.append(event['text']) or len(log)
+            )
+        await asyncio.gather(*(worker.start() for worker in workers))
+        results = await asyncio.gather(*(
+            worker.publish({'type': 'general', 'text': f'{worker.worker_id}'
+                            f':{index}\nline'})
+            for index in range(20) for worker in workers
+        ))
+        await asyncio.sleep(0.1)
+        for worker in workers:
+            await worker.close()
+        server.close()
+        return applied, results
+
+    applied, results = asyncio.run(scenario())
+    assert len(applied[0]) == 40
+    assert applied[0] == applied[1]
+    # Перевод строки внутри события не разрывает кадр шины.
+    assert all(text.endswith('\nline') for text in applied[0])
+    # publish() возвращает результат применения у отправителя.
+    assert sorted(results) == list(range(1, 41))
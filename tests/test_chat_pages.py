@@ -0,0 +1,78 @@
+import asyncio
+
+from connection import Connection
+from messages_templates import chat_page, wrong_page_params
+from server import ChatServer
+from test_connection import RecordingStreamWriter
+
+TOTAL = 5
+
+
+def get_chat_with(pages):
+    """Ответы на /get_chat_with с аргументами из pages по очереди."""
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        writer = RecordingStreamWriter()
+        for username in ('alice', 'bob'):
+            await server.bus.publish({
+                'type': 'sign_in', 'username': username,
+                'client_addr': ['127.0.0.1', 1],
+            }, Connection(writer, coalesce_delay=0))
+        for index in range(TOTAL):
+            await server.bus.publish({
+                'type': 'private', 'sender': 'bob', 'target': 'alice',
+                'text': f'm{index}',
+            })
+        replies = []
+        for args in pages:
+            writer.batches.clear()
+            await server.message_handler.handle_get_chat_with(args, 'alice')
+            await server.users['alice'].writer.drain()
+            data = b''.join(b''.join(batch) for batch in writer.batches)
+            replies.append(data.decode().splitlines())
+        return replies, server.users['alice'].last_read[('alice', 'bob')]
+    return asyncio.run(scenario())
+
+
+def header(count, unread):
+    return chat_page.format('bob', count, unread).rstrip('\n')
+
+
+def entries(*seqs):
+    return [f'[{seq}] bob: m{seq}' for seq in seqs]
+
+
+def test_unread_pages_advance_cursor():
+    replies, last_read = get_chat_with(['bob 2', 'bob 10', 'bob'])
+    assert replies == [
+        [header(2, 3), *entries(0, 1)],
+        [header(3, 0), *entries(2, 3, 4)],
+        [header(0, 0)],
+    ]
+    assert last_read == TOTAL - 1
+
+
+def test_history_pages_before_seq_keep_cursor():
+    replies, last_read = get_chat_with(
+        ['bob 1', 'bob 2 3', 'bob 10 2', 'bob 2 0', f'bob 2 {TOTAL + 3}']
+    )
+    assert replies == [
+        [header(1, 4), *entries(0)],
+        # Курсор остаётся на seq 0: непрочитанных по-прежнему 4.
+        [header(2, 4), *entries(1, 2)],
+        [header(2, 4), *entries(0, 1)],
+        [header(0, 4)],
+        [header(2, 4), *entries(3, 4)],
+    ]
+    assert last_read == 0
+
+
+def test_page_limit_clamped_and_validated():
+    replies, last_read = get_chat_with(['bob 0', 'bob -5', 'bob x', 'bob 1 y'])
+    assert replies == [
+        [header(1, 4), *entries(0)],
+        [header(1, 3), *entries(1)],
+        [wrong_page_params.rstrip('\n')],
+        [wrong_page_params.rstrip('\n')],
+    ]
+    assert last_read == 1
@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+from cluster import GENERAL_CHAT_KEY, ClusterBus, HashRing, routing_key
+from config import BAN_TIME
+from server import ChatServer
+from test_protocol import free_port
+
+
+def test_report_routed_by_target():
+    event = {'type': 'report', 'username': 'alice', 'target': 'spammer',
+             'time': 0.0}
+    assert routing_key(event) == 'spammer'
+
+
+def test_routing_keys():
+    assert routing_key({'type': 'general', 'sender': 'a'}) == GENERAL_CHAT_KEY
+    assert routing_key(
+        {'type': 'private', 'sender': 'b', 'target': 'a'}
+    ) == 'a\x1fb'
+    assert routing_key({'type': 'sign_in', 'username': 'a'}) == 'a'
+
+
+def test_late_node_receives_users():
+    async def scenario():
+        first_port, second_port = free_port(), free_port()
+        first = ChatServer(metrics_port=None, bus=ClusterBus(
+            'a', ('127.0.0.1', first_port),
+            {'b': ('127.0.0.1', second_port)}
+        ))
+        await first.bus.start()
+        for username in ('alice', 'bob', 'carol'):
+            await first.bus.publish({
+                'type': 'sign_in', 'username': username,
+                'client_addr': ['127.0.0.1', 1],
+            })
+        await first.bus.publish({
+            'type': 'sign_out', 'username': 'bob', 'time': time.time(),
+            'cursor': 0,
+        })
+        await first.bus.publish({
+            'type': 'ban', 'username': 'carol', 'time': time.time(),
+        })
+
+        second = ChatServer(metrics_port=None, bus=ClusterBus(
+            'b', ('127.0.0.1', second_port),
+            {'a': ('127.0.0.1', first_port)}
+        ))
+        await second.bus.start()
+        for _ in range(100):
+            if len(second.users) == 3:
+                break
+            await asyncio.sleep(0.05)
+        # События о пользователях из передачи применяются без ошибок.
+        await second.bus.publish({
+            'type': 'read', 'username': 'alice', 'chat_id': ['alice', 'bob'],
+            'index': 0,
+        })
+        remaining = (second.users['carol'].reports.end_of_ban
+                     - asyncio.get_running_loop().time())
+        result = (sorted(second.users), sorted(second.online),
+                  second.users['alice'].last_read,
+                  BAN_TIME - 5 < remaining <= BAN_TIME)
+        await first.bus.close()
+        await second.bus.close()
+        return result
+
+    assert asyncio.run(scenario()) == (
+        ['alice', 'bob', 'carol'], ['alice', 'carol'],
+        {('alice', 'bob'): 0}, True,
+    )
+
+
+def test_events_for_unknown_users_skipped():
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        for event in (
+            {'type': 'read', 'username': 'ghost', 'chat_id': ['a', 'ghost'],
+             'index': 3},
+            {'type': 'general_read', 'username': 'ghost', 'cursor': 3},
+            {'type': 'sign_out', 'username': 'ghost', 'time': time.time(),
+             'cursor': 0},
+            {'type': 'ban', 'username': 'ghost', 'time': time.time()},
+            {'type': 'report', 'username': 'a', 'target': 'ghost',
+             'time': time.time()},
+        ):
+            await server.bus.publish(event)
+        return server.users
+
+    assert asyncio.run(scenario()) == {}
+
+
+def test_peer_without_return_link_not_in_ring():
+    async def scenario():
+        first_port, second_port = free_port(), free_port()
+        first = ClusterBus(
+            'a', ('127.0.0.1', first_port), {'b': ('127.0.0.1', second_port)}
+        )
+        # Второй узел не знает о первом и не открывает канал к нему.
+        second = ClusterBus('b', ('127.0.0.1', second_port), {})
+        first.attach(lambda event, writer: event['username'])
+        second.attach(lambda event, writer: event['username'])
+        await second.start()
+        await first.start()
+        for _ in range(100):
+            if 'b' in first.links:
+                break
+            await asyncio.sleep(0.05)
+        ring = HashRing(['a', 'b'])
+        username = next(
+            name for name in (f'user{index}' for index in range(100))
+            if ring.owner(name) == 'b'
+        )
+        result = await asyncio.wait_for(
+            first.publish({'type': 'sign_in', 'username': username}), 1
+        )
+        nodes = first.ring.nodes
+        await first.close()
+        await second.close()
+        return result == username, nodes
+
+    assert asyncio.run(scenario()) == (True, frozenset({'a'}))
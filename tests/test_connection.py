@@ -0,0 +1,89 @@
+import asyncio
+
+from benchmark import NullStreamWriter
+from config import SlowConsumerPolicy
+from connection import Connection, OutboundTotals
+
+
+class RecordingStreamWriter(NullStreamWriter):
+    """StreamWriter, который запоминает пачки, переданные в writelines."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.batches: list[list[bytes]] = []
+        self.closed: bool = False
+
+    def writelines(self, data: list[bytes]) -> None:
+        super().writelines(data)
+        self.batches.append(list(data))
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def overflow(policy):
+    """Три кадра в очередь на два до того, как задача отправки начнёт."""
+    async def scenario():
+        writer = RecordingStreamWriter()
+        connection = Connection(
+            writer, max_queue=2, policy=policy, coalesce_delay=0
+        )
+        for frame in (b'a\n', b'b\n', b'c\n'):
+            connection.write_frame(frame)
+        await connection.drain()
+        return writer, connection
+    return asyncio.run(scenario())
+
+
+def test_drop_oldest_discards_head_of_queue():
+    writer, connection = overflow(SlowConsumerPolicy.DROP_OLDEST)
+    assert writer.batches == [[b'b\n', b'c\n']]
+    assert connection.dropped == 1
+    assert not connection.closed
+
+
+def test_disconnect_closes_slow_consumer():
+    writer, connection = overflow(SlowConsumerPolicy.DISCONNECT)
+    assert writer.closed and connection.closed
+    assert writer.batches == []
+    assert connection.dropped == 1
+
+
+def test_coalesce_merges_into_last_frame():
+    writer, connection = overflow(SlowConsumerPolicy.COALESCE)
+    assert writer.batches == [[b'a\n', b'b\nc\n']]
+    assert connection.dropped == 1
+    assert connection.frames_sent == 2
+
+
+def test_queued_frames_written_in_batches_up_to_coalesce_bytes():
+    async def scenario():
+        writer = RecordingStreamWriter()
+        totals = OutboundTotals()
+        connection = Connection(
+            writer, coalesce_bytes=10, coalesce_delay=0, totals=totals
+        )
+        for index in range(5):
+            connection.write_frame(f'fr{index}\n'.encode())
+        await connection.drain()
+        return writer, connection, totals
+
+    writer, connection, totals = asyncio.run(scenario())
+    # Пачка набирается, пока не достигнет coalesce_bytes: 4 + 4 + 4 байта.
+    assert [len(batch) for batch in writer.batches] == [3, 2]
+    assert writer.calls == connection.writes == totals.writes == 2
+    assert connection.frames_sent == totals.frames_sent == 5
+
+
+def test_frames_within_coalesce_delay_written_together():
+    async def scenario():
+        writer = RecordingStreamWriter()
+        connection = Connection(writer, coalesce_delay=0.01)
+        connection.write_frame(b'a\n')
+        await asyncio.sleep(0)
+        # Задача отправки уже ждёт coalesce_delay.
+        connection.write_frame(b'b\n')
+        await connection.drain()
+        return writer.batches, connection.writes
+
+    assert asyncio.run(scenario()) == ([[b'a\n', b'b\n']], 1)
@@ -0,0 +1,30 @@
+import asyncio
+import sys
+import types
+
+import eventloop
+
+
+class FakeUvloopPolicy(asyncio.DefaultEventLoopPolicy):
+    pass
+
+
+async def current_policy():
+    return type(asyncio.get_event_loop_policy())
+
+
+def test_uvloop_policy_restored_before_311(monkeypatch):
+    monkeypatch.setattr(sys, 'version_info', (3, 10, 0))
+    monkeypatch.setattr(
+        eventloop, 'uvloop', types.SimpleNamespace(
+            EventLoopPolicy=FakeUvloopPolicy
+        )
+    )
+    monkeypatch.setitem(
+        eventloop.LOOP_FACTORIES, 'uvloop', asyncio.new_event_loop
+    )
+    before = type(asyncio.get_event_loop_policy())
+
+    assert eventloop.run(current_policy(), 'uvloop') is FakeUvloopPolicy
+    assert eventloop.run(current_policy(), 'asyncio') is before
+    assert type(asyncio.get_event_loop_policy()) is before
@@ -0,0 +1,95 @@
+import asyncio
+
+from benchmark import NullStreamWriter
+from connection import Connection
+from heartbeat import HeartbeatMonitor, TimerWheel
+from messages_templates import heartbeat_ping
+from test_connection import RecordingStreamWriter
+
+IDLE_TIMEOUT = 5.0
+INTERVAL = 2.0
+
+
+class StalledStreamWriter(NullStreamWriter):
+    """StreamWriter клиента, который не читает: drain() не завершается."""
+
+    async def drain(self) -> None:
+        await asyncio.get_running_loop().create_future()
+
+
+def test_busy_connection_not_closed():
+    async def scenario():
+        monitor = HeartbeatMonitor(None, IDLE_TIMEOUT, tick=1.0)
+        connection = Connection(NullStreamWriter())
+        monitor.watch(connection)
+        connection.busy = True
+        monitor.sweep(connection.last_activity + IDLE_TIMEOUT + 1)
+        return connection.closed
+
+    assert not asyncio.run(scenario())
+
+
+def test_command_stuck_in_drain_closed_on_idle_timeout():
+    async def scenario():
+        monitor = HeartbeatMonitor(None, IDLE_TIMEOUT, tick=1.0)
+        connection = Connection(StalledStreamWriter())
+        monitor.watch(connection)
+        connection.busy = True
+        connection.write(b'reply\n')
+        drain = asyncio.create_task(connection.drain())
+        await asyncio.sleep(0)
+        monitor.sweep(connection.last_activity + IDLE_TIMEOUT + 1)
+        await asyncio.wait_for(drain, 1)
+        return connection.closed, connection.busy, monitor.timed_out
+
+    assert asyncio.run(scenario()) == (True, True, 1)
+
+
+def test_timer_wheel_expires_due_items_and_clamps_to_horizon():
+    wheel = TimerWheel(tick=1.0, horizon=3.0)
+    wheel.schedule('first', 10.0)
+    wheel.schedule('moved', 10.5)
+    wheel.schedule('far', 100.0)
+    wheel.schedule('moved', 12.0)
+    assert sorted(wheel.expire(11.0)) == ['first']
+    # Срок дальше horizon переносится на край колеса.
+    assert sorted(wheel.expire(12.0)) == ['moved']
+    assert wheel.expire(14.0) == ['far']
+    assert len(wheel) == 0
+
+
+def silent_connection(pong_at=None):
+    """Пинги и закрытие молчащего соединения по шагам колеса."""
+    async def scenario():
+        monitor = HeartbeatMonitor(INTERVAL, IDLE_TIMEOUT, tick=1.0)
+        writer = RecordingStreamWriter()
+        connection = Connection(writer, coalesce_delay=0)
+        # Сроки на колесе округляются до шага: начинаем ровно на шаге.
+        start = connection.last_activity = 100.0
+        monitor.watch(connection)
+        closed_at = None
+        for second in range(1, 10):
+            if second == pong_at:
+                # Так handle_client отмечает любой кадр, в том числе /pong.
+                connection.last_activity = start + second
+            monitor.sweep(start + second)
+            if connection.closed:
+                closed_at = second
+                break
+            await connection.drain()
+        pings = [batch for batch in writer.batches
+                 if batch == [heartbeat_ping.encode()]]
+        return closed_at, monitor.pings, len(pings), len(monitor.wheel)
+    return asyncio.run(scenario())
+
+
+def test_silent_connection_pinged_then_closed():
+    closed_at, pings, sent, watched = silent_connection()
+    assert (closed_at, pings, sent, watched) == (IDLE_TIMEOUT, 1, 1, 0)
+
+
+def test_pong_postpones_idle_close():
+    closed_at, pings, sent, watched = silent_connection(pong_at=3)
+    assert closed_at == 3 + IDLE_TIMEOUT
+    assert pings == sent == 2
+    assert watched == 0
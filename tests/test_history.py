@@ -0,0 +1,19 @@
+import pytest
+
+from config import Message
+from history import ChatHistory, GeneralChat, PrivateChat
+
+
+def test_chat_history_is_abstract():
+    with pytest.raises(TypeError):
+        ChatHistory(None, None, None)
+
+
+def test_retention_evicts_oldest_keeping_seq():
+    for chat in (GeneralChat(retention=3), PrivateChat(retention=3)):
+        for index in range(5):
+            assert chat.append(Message('a', str(index))) == index
+        assert (chat.first_seq, chat.next_seq) == (2, 5)
+        start, messages = chat.read(0, 5)
+        assert start == 2
+        assert [message.text for message in messages] == ['2', '3', '4']
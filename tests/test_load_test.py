@@ -0,0 +1,22 @@
+import argparse
+import asyncio
+
+from load_test import DEFAULT_MIX, LATENCY_MARKER, LoadGenerator
+
+
+def test_deliveries_after_window_counted_by_send_time():
+    async def scenario():
+        generator = LoadGenerator(
+            argparse.Namespace(connections=1, mix=DEFAULT_MIX)
+        )
+        generator.window_start, generator.window_end = 100, 200
+        reader = asyncio.StreamReader()
+        for sent in (50, 150, 250):
+            reader.feed_data(f'writer: {LATENCY_MARKER}{sent}\n'.encode())
+        reader.feed_eof()
+        # Окно закрыто, а доставки ещё приходят, как во время drain_time.
+        generator.measuring = False
+        await generator.listen(reader)
+        return len(generator.latencies)
+
+    assert asyncio.run(scenario()) == 1
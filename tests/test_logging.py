@@ -0,0 +1,27 @@
+import multiprocessing
+import os
+
+from custom_logger import forward_to
+
+
+def log_from_worker(log_queue, directory):
+    os.chdir(directory)
+    forward_to(log_queue)
+    from custom_logger import logger
+    logger.info('запись из процесса %s', 'worker')
+
+
+def test_worker_records_forwarded_to_parent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    context = multiprocessing.get_context('spawn')
+    log_queue = context.Queue()
+    process = context.Process(
+        target=log_from_worker, args=(log_queue, str(tmp_path))
+    )
+    process.start()
+    record = log_queue.get(timeout=30)
+    process.join(30)
+
+    assert record.getMessage() == 'запись из процесса worker'
+    # Рабочий процесс не открывает файл журнала сам.
+    assert not os.listdir(tmp_path)
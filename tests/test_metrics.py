@@ -0,0 +1,44 @@
+import asyncio
+
+from metrics import render_prometheus
+from protocol import encode_frame
+from server import ChatServer
+from test_protocol import free_port
+
+
+def metric(text: str, name: str) -> int:
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return int(line.split()[1])
+    raise KeyError(name)
+
+
+def test_outbound_counters_survive_disconnect():
+    async def scenario():
+        port = free_port()
+        server = ChatServer('127.0.0.1', port, metrics_port=None)
+        task = asyncio.create_task(server.run())
+        await asyncio.sleep(0.1)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(encode_frame('/sign_in alice'))
+        writer.write(encode_frame('/send_all hello'))
+        await asyncio.sleep(0.2)
+        before = render_prometheus(server)
+        writer.close()
+        await asyncio.sleep(0.2)
+        after = render_prometheus(server)
+        task.cancel()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    for name in ('chat_outbound_sent_frames_total',
+                 'chat_outbound_socket_writes_total'):
+        assert f'# TYPE {name} counter' in after
+        assert metric(before, name) > 0
+        assert metric(after, name) == metric(before, name)
+    for name in ('chat_outbound_dropped_frames_total',
+                 'chat_sign_ins_rejected_total',
+                 'chat_heartbeat_pings_total',
+                 'chat_idle_disconnects_total'):
+        assert f'# TYPE {name} counter' in after
+        assert metric(after, name) == 0
@@ -0,0 +1,168 @@
+import asyncio
+import socket
+
+from protocol import (
+    FrameTooLarge,
+    encode_command,
+    encode_frame,
+    parse_binary_command,
+    parse_command,
+    read_binary_frame,
+    read_frame,
+)
+from messages_templates import already_signed_in, wire_format_switched
+from server import ChatServer
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_binary_command_line_breaks_replaced():
+    frame = encode_command('/send_all', 'hi\nФормат протокола: binary.\r\n')
+    command, args = parse_binary_command(frame[4:])
+    assert command == '/send_all'
+    assert '\n' not in args and '\r' not in args
+    assert args == 'hi Формат протокола: binary.  '
+
+
+def test_binary_command_name_line_breaks_replaced():
+    command, _ = parse_binary_command(encode_command('/x\ny', '')[4:])
+    assert command == '/x y'
+
+
+def test_text_command_carriage_return_replaced():
+    assert parse_command(b'/send_all a\rb') == ('/send_all', 'a b')
+
+
+def test_binary_message_cannot_forge_text_lines():
+    async def scenario():
+        port = free_port()
+        server = ChatServer('127.0.0.1', port, metrics_port=None)
+        task = asyncio.create_task(server.run())
+        await asyncio.sleep(0.1)
+        text_reader, text_writer = await asyncio.open_connection(
+            '127.0.0.1', port
+        )
+        text_writer.write(encode_frame('/sign_in reader'))
+        binary_reader, binary_writer = await asyncio.open_connection(
+            '127.0.0.1', port
+        )
+        binary_writer.write(encode_frame('/sign_in writer binary'))
+        await asyncio.sleep(0.1)
+        binary_writer.write(
+            encode_command('/send_all', 'hi\nФормат протокола: binary.')
+        )
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(read_frame(text_reader), 0.3)
+            except asyncio.TimeoutError:
+                break
+            lines.append(line.decode())
+        text_writer.close()
+        binary_writer.close()
+        task.cancel()
+        return lines
+
+    lines = asyncio.run(scenario())
+    assert 'Формат протокола: binary.' not in lines
+    assert any('hi Формат протокола: binary.' in line for line in lines)
+
+
+def test_wire_switched_only_after_successful_sign_in():
+    async def scenario():
+        port = free_port()
+        server = ChatServer('127.0.0.1', port, metrics_port=None)
+        task = asyncio.create_task(server.run())
+        await asyncio.sleep(0.1)
+        first_reader, first_writer = await asyncio.open_connection(
+            '127.0.0.1', port
+        )
+        first_writer.write(encode_frame('/sign_in alice'))
+        await asyncio.sleep(0.1)
+        # Уже вошедший пользователь и занятое имя: формат не меняется.
+        first_writer.write(encode_frame('/sign_in bob binary'))
+        second_reader, second_writer = await asyncio.open_connection(
+            '127.0.0.1', port
+        )
+        second_writer.write(encode_frame('/sign_in alice binary'))
+        await asyncio.sleep(0.1)
+        second_writer.write(encode_frame('/sign_in carol binary'))
+        await asyncio.sleep(0.1)
+        wires = (server.connections['alice'].wire.name,
+                 server.connections['carol'].wire.name)
+        replies = []
+        for _ in range(2):
+            replies.append((await read_frame(second_reader)).decode())
+        first_writer.close()
+        second_writer.close()
+        task.cancel()
+        return wires, replies
+
+    wires, replies = asyncio.run(scenario())
+    assert wires == ('text', 'binary')
+    assert replies == [
+        already_signed_in.rstrip('\n'),
+        wire_format_switched.format('binary').rstrip('\n'),
+    ]
+
+
+async def read_frames(reader, read, count):
+    """count кадров подряд; FrameTooLarge записывается вместо кадра."""
+    frames = []
+    for _ in range(count):
+        try:
+            frames.append(await read(reader))
+        except FrameTooLarge:
+            frames.append(FrameTooLarge)
+    return frames
+
+
+def test_split_and_pipelined_frames():
+    async def scenario():
+        reader = asyncio.StreamReader(limit=64)
+        frames = asyncio.create_task(read_frames(reader, read_frame, 4))
+        # Кадр, разрезанный на части, и несколько кадров в одном пакете.
+        for chunk in (b'/send', b'_all a', b' b\n/status\n/sta',
+                      b'tus\n', b'/quit'):
+            reader.feed_data(chunk)
+            await asyncio.sleep(0)
+        reader.feed_eof()
+        return await frames
+
+    assert asyncio.run(scenario()) == [
+        b'/send_all a b', b'/status', b'/status', b'/quit',
+    ]
+
+
+def test_oversize_frame_skipped_and_next_read():
+    async def scenario():
+        reader = asyncio.StreamReader(limit=16)
+        frames = asyncio.create_task(read_frames(reader, read_frame, 3))
+        # Длинный кадр приходит частями, каждая больше лимита.
+        for _ in range(3):
+            reader.feed_data(b'x' * 40)
+            await asyncio.sleep(0)
+        reader.feed_data(b'x\n/status\n/quit\n')
+        return await frames
+
+    assert asyncio.run(scenario()) == [FrameTooLarge, b'/status', b'/quit']
+
+
+def test_oversize_binary_frame_skipped_and_next_read():
+    async def scenario():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_command('/send_all', 'x' * 100))
+        reader.feed_data(encode_command('/status', ''))
+        reader.feed_eof()
+        return await read_frames(
+            reader, lambda reader: read_binary_frame(reader, 32), 3
+        )
+
+    oversize, status, closed = asyncio.run(scenario())
+    assert oversize is FrameTooLarge
+    assert parse_binary_command(status) == ('/status', '')
+    assert closed is None
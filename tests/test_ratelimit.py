@@ -0,0 +1,46 @@
+import asyncio
+
+from benchmark import NullStreamWriter
+from config import RATE_LIMITS, ClientAddress
+from connection import Connection
+from ratelimit import RATE_LIMITED, RATE_OK, RateLimiter
+from server import RATE_LIMITED_COMMAND, ChatServer
+
+LIMITS = {'*': (1, 2), '/ack': (1, 3)}
+
+
+def test_separate_command_has_finite_own_bucket():
+    limiter = RateLimiter(LIMITS, frozenset({'/ack'}))
+    results = [limiter.check('alice', '/ack', 0.0) for _ in range(4)]
+    assert results == [RATE_OK, RATE_OK, RATE_OK, RATE_LIMITED]
+    assert limiter.check('alice', '/ack', 1.0) == RATE_OK
+
+
+def test_separate_command_keeps_shared_bucket():
+    limiter = RateLimiter(LIMITS, frozenset({'/ack'}))
+    for _ in range(3):
+        limiter.check('alice', '/ack', 0.0)
+    assert limiter.check('alice', '/status', 0.0) == RATE_OK
+    assert limiter.check('alice', '/status', 0.0) == RATE_OK
+    assert limiter.check('alice', '/status', 0.0) == RATE_LIMITED
+
+
+def test_command_charges_shared_bucket():
+    limiter = RateLimiter(LIMITS, frozenset())
+    assert limiter.check('alice', '/ack', 0.0) == RATE_OK
+    assert limiter.check('alice', '/ack', 0.0) == RATE_OK
+    assert limiter.check('alice', '/ack', 0.0) == RATE_LIMITED
+
+
+def test_pong_limited_before_sign_in():
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        writer = Connection(NullStreamWriter())
+        address = ClientAddress('127.0.0.1', 1)
+        for _ in range(RATE_LIMITS['/pong'][1] + 1):
+            await server.handle_command('/pong', '', writer, None, address)
+        return server.command_metrics.histograms
+
+    histograms = asyncio.run(scenario())
+    assert histograms['/pong'].count == RATE_LIMITS['/pong'][1]
+    assert histograms[RATE_LIMITED_COMMAND].count == 1
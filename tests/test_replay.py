@@ -0,0 +1,87 @@
+import asyncio
+
+from benchmark import NullStreamWriter
+from config import CHAT_CHUNK_SIZE
+from connection import Connection
+from server import ChatServer
+
+TOTAL = CHAT_CHUNK_SIZE * 3 + 7
+
+
+class BrokenStreamWriter(NullStreamWriter):
+    """StreamWriter, соединение которого рвётся после limit записей."""
+
+    def __init__(self, limit: int) -> None:
+        super().__init__()
+        self.limit: int = limit
+
+    def writelines(self, data: list[bytes]) -> None:
+        if self.calls >= self.limit:
+            raise ConnectionResetError
+        super().writelines(data)
+
+
+async def prepare() -> tuple[ChatServer, list[int]]:
+    """Сервер с пользователем reader, пропустившим TOTAL сообщений."""
+    server = ChatServer(metrics_port=None)
+    await server.bus.publish({
+        'type': 'sign_in', 'username': 'reader',
+        'client_addr': ['127.0.0.1', 1],
+    })
+    await server.bus.publish({
+        'type': 'sign_out', 'username': 'reader', 'time': 0.0, 'cursor': 0,
+    })
+    for index in range(TOTAL):
+        await server.bus.publish(
+            {'type': 'general', 'sender': 'writer', 'text': f'm{index}'}
+        )
+
+    # Курсор пользователя после каждого события general_read.
+    cursors = []
+    publish = server.bus.publish
+
+    async def recording_publish(event, writer=None):
+        result = await publish(event, writer)
+        if event['type'] == 'general_read':
+            cursors.append(server.users['reader'].general_chat_cursor)
+        return result
+
+    server.bus.publish = recording_publish
+    return server, cursors
+
+
+def test_cursor_advances_chunk_by_chunk():
+    async def scenario():
+        server, cursors = await prepare()
+        writer = Connection(NullStreamWriter())
+        cursor = await server.auth_handler._stream_general(
+            'reader', writer, 0
+        )
+        return cursor, cursors
+
+    cursor, cursors = asyncio.run(scenario())
+    assert cursor == TOTAL
+    assert cursors == [
+        CHAT_CHUNK_SIZE, CHAT_CHUNK_SIZE * 2, CHAT_CHUNK_SIZE * 3, TOTAL
+    ]
+
+
+def test_interrupted_replay_resumes_from_last_chunk():
+    async def scenario():
+        server, cursors = await prepare()
+        broken = Connection(BrokenStreamWriter(limit=2))
+        result = await server.auth_handler._stream_general(
+            'reader', broken, 0
+        )
+        stored = server.users['reader'].general_chat_cursor
+        writer = Connection(NullStreamWriter())
+        resumed = await server.auth_handler._stream_general(
+            'reader', writer, stored
+        )
+        return result, stored, resumed, writer.frames_sent
+
+    result, stored, resumed, frames = asyncio.run(scenario())
+    assert result is None
+    assert stored == CHAT_CHUNK_SIZE * 2
+    assert resumed == TOTAL
+    assert frames == 2
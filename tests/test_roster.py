@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from connection import Connection
+from messages_templates import online_users, user_statuses
+from server import ChatServer
+from test_connection import RecordingStreamWriter
+
+
+async def sign_in(server, username, writer=None):
+    await server.bus.publish({
+        'type': 'sign_in', 'username': username,
+        'client_addr': ['127.0.0.1', 1],
+    }, Connection(writer or RecordingStreamWriter(), coalesce_delay=0))
+
+
+async def status(server, username, args=''):
+    """Строки ответа на /status пользователю username."""
+    writer = server.users[username].writer
+    writer.writer.batches.clear()
+    await server.message_handler.handle_status(args, username)
+    await writer.drain()
+    data = b''.join(b''.join(batch) for batch in writer.writer.batches)
+    return data.decode().splitlines()
+
+
+def test_roster_and_chat_index_follow_sign_in_and_out():
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        for username in ('alice', 'bob', 'carol'):
+            await sign_in(server, username)
+        for sender, target in (('alice', 'bob'), ('carol', 'alice')):
+            await server.bus.publish({
+                'type': 'private', 'sender': sender, 'target': target,
+                'text': 'hi',
+            })
+        await server.bus.publish({
+            'type': 'sign_out', 'username': 'bob', 'time': time.time(),
+            'cursor': 0,
+        })
+        snapshot = (set(server.online), {
+            username: set(chats)
+            for username, chats in server.user_chats.items()
+        })
+        statuses = await status(server, 'alice')
+        await sign_in(server, 'bob')
+        return snapshot, statuses, set(server.online)
+
+    (online, user_chats), statuses, rejoined = asyncio.run(scenario())
+    assert online == {'alice', 'carol'}
+    assert user_chats == {
+        'alice': {('alice', 'bob'), ('alice', 'carol')},
+        'bob': {('alice', 'bob')},
+        'carol': {('alice', 'carol')},
+    }
+    assert statuses[0] == user_statuses.format(2, 1).rstrip('\n')
+    # Непрочитанное есть только в чате, где alice - получатель.
+    assert 'bob (непрочитанных: 0)' in statuses[1]
+    assert 'carol (непрочитанных: 1)' in statuses[1]
+    assert rejoined == {'alice', 'bob', 'carol'}
+
+
+def test_online_roster_streamed_in_chunks(monkeypatch):
+    monkeypatch.setattr('services.ROSTER_CHUNK_SIZE', 2)
+
+    async def scenario():
+        server = ChatServer(metrics_port=None)
+        usernames = [f'user{index}' for index in range(5)]
+        for username in usernames:
+            await sign_in(server, username)
+        writer = server.users['user0'].writer
+        lines = await status(server, 'user0', 'online')
+        return usernames, lines, writer.frames_sent
+
+    usernames, lines, frames = asyncio.run(scenario())
+    assert lines[0] == online_users.format(5).rstrip('\n')
+    assert sorted(lines[1:]) == usernames
+    # Заголовок и три части по ROSTER_CHUNK_SIZE имён.
+    assert frames == 4
@@ -0,0 +1,92 @@
+import asyncio
+
+from config import Message
+from scheduler import Scheduler
+
+MESSAGE = Message(sender='alice', text='hello')
+
+
+def test_ids_not_reused_after_fire_and_cancel():
+    async def scenario():
+        fired = []
+
+        async def dispatch(batch):
+            fired.extend(entry.message_id for entry in batch)
+
+        scheduler = Scheduler(dispatch)
+        now = asyncio.get_running_loop().time()
+        first = scheduler.schedule_at('alice', 'bob', MESSAGE, now)
+        await asyncio.sleep(0.01)
+        second = scheduler.schedule_at('alice', 'bob', MESSAGE, now + 60)
+        scheduler.cancel('alice', second)
+        third = scheduler.schedule_at('alice', 'bob', MESSAGE, now + 60)
+
+        restored = Scheduler(dispatch)
+        restored.restore(scheduler.snapshot())
+        fourth = restored.schedule_at('alice', 'bob', MESSAGE, now + 60)
+        scheduler.close()
+        restored.close()
+        return fired, [first, second, third, fourth]
+
+    fired, ids = asyncio.run(scenario())
+    assert fired == [0]
+    assert ids == [0, 1, 2, 3]
+
+
+def test_due_messages_fired_in_deadline_order_without_cancelled():
+    async def scenario():
+        batches = []
+
+        async def dispatch(batch):
+            batches.append([entry.message.text for entry in batch])
+
+        scheduler = Scheduler(dispatch)
+        now = asyncio.get_running_loop().time()
+        for text, delay in (('third', -1), ('first', -3), ('later', 60),
+                            ('second', -2)):
+            scheduler.schedule_at(
+                'alice', 'bob', Message(sender='alice', text=text),
+                now + delay
+            )
+        cancelled = scheduler.schedule_at('alice', 'bob', MESSAGE, now - 4)
+        assert scheduler.cancel('alice', cancelled)
+        assert not scheduler.cancel('alice', cancelled)
+        await asyncio.sleep(0.01)
+        pending = len(scheduler), list(scheduler.scheduled_messages['alice'])
+        scheduler.close()
+        return batches, pending
+
+    assert asyncio.run(scenario()) == (
+        [['first', 'second', 'third']], (1, [2])
+    )
+
+
+def test_restored_messages_keep_ids_and_order():
+    async def scenario():
+        fired = []
+
+        async def dispatch(batch):
+            fired.extend(
+                (entry.owner, entry.message_id, entry.message.text)
+                for entry in batch
+            )
+
+        scheduler = Scheduler(dispatch)
+        now = asyncio.get_running_loop().time()
+        for owner, text, delay in (('alice', 'a0', 0.06), ('bob', 'b0', 0.02),
+                                   ('alice', 'a1', 0.04)):
+            scheduler.schedule_at(
+                owner, 'carol', Message(sender=owner, text=text), now + delay
+            )
+        snapshot = scheduler.snapshot()
+        scheduler.close()
+
+        restored = Scheduler(dispatch)
+        restored.restore(snapshot)
+        await asyncio.sleep(0.1)
+        restored.close()
+        return fired, len(restored)
+
+    assert asyncio.run(scenario()) == (
+        [('bob', 0, 'b0'), ('alice', 1, 'a1'), ('alice', 0, 'a0')], 0
+    )
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import os
+import shutil
+import time
+
+from config import BAN_TIME
+from history import PrivateChat
+from server import ChatServer
+from storage import LogStorage, SegmentedLog
+
+
+def test_orphan_segment_removed_on_load(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_size=8)
+    log.commit([b'first', b'second'])
+    # Сбой после fsync нового сегмента, но до записи индекса.
+    with open(tmp_path / '00000001.log', 'wb') as orphan:
+        orphan.write(b'orphan-record\n')
+
+    log = SegmentedLog(str(tmp_path), segment_size=8)
+    assert not os.path.exists(tmp_path / '00000001.log')
+    log.commit([b'third'])
+    log.commit([b'fourth'])
+
+    reloaded = SegmentedLog(str(tmp_path), segment_size=8)
+    assert reloaded.read_all() == [b'first', b'second', b'third', b'fourth']
+    assert reloaded.read_tail(2) == [b'third', b'fourth']
+
+
+def test_new_segment_overwrites_leftover_file(tmp_path):
+    log = SegmentedLog(str(tmp_path), segment_size=8)
+    log.commit([b'first', b'second'])
+    # Файл появился уже после загрузки индекса.
+    with open(tmp_path / '00000001.log', 'wb') as orphan:
+        orphan.write(b'orphan-record\n')
+    log.commit([b'third'])
+
+    reloaded = SegmentedLog(str(tmp_path), segment_size=8)
+    assert reloaded.read_all() == [b'first', b'second', b'third']
+
+
+def test_uncommitted_tail_truncated(tmp_path):
+    log = SegmentedLog(str(tmp_path))
+    log.commit([b'first'])
+    with open(tmp_path / '00000000.log', 'ab') as segment:
+        segment.write(b'partial')
+
+    reloaded = SegmentedLog(str(tmp_path))
+    reloaded.commit([b'second'])
+    assert reloaded.read_all() == [b'first', b'second']
+
+
+def restart(directory, scenario):
+    async def run():
+        server = ChatServer(metrics_port=None)
+        server.storage = LogStorage(str(directory))
+        server.storage.load(server)
+        try:
+            return await scenario(server)
+        finally:
+            await server.storage.close()
+    return asyncio.run(run())
+
+
+def test_private_chats_restored_from_log_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        'server.PrivateChat', lambda: PrivateChat(retention=3)
+    )
+
+    async def write(server):
+        # Чаты пользователей, которых нет в памяти, при старте не читаются.
+        for username in ('alice', 'bob', 'carol'):
+            await server.bus.publish({
+                'type': 'sign_in', 'username': username,
+                'client_addr': ['127.0.0.1', 1],
+            })
+        for index in range(10):
+            await server.bus.publish({
+                'type': 'private', 'sender': 'alice', 'target': 'bob',
+                'text': f'ab{index}',
+            })
+            await server.bus.publish({
+                'type': 'private', 'sender': 'carol', 'target': 'alice',
+                'text': f'ca{index}',
+            })
+            if index == 5:
+                await server.storage.commit(final=True)
+                shutil.copy(tmp_path / 'chats.json', tmp_path / 'stale.json')
+
+    async def read_chats(server):
+        return {
+            chat_id: (chat.first_seq, chat.next_seq,
+                      [message.text
+                       for message in chat.read(0, chat.next_seq)[1]])
+            for chat_id, chat in server.private_chats.items()
+        }
+
+    expected = {
+        ('alice', 'bob'): (7, 10, ['ab7', 'ab8', 'ab9']),
+        ('alice', 'carol'): (7, 10, ['ca7', 'ca8', 'ca9']),
+    }
+    restart(tmp_path, write)
+    assert restart(tmp_path, read_chats) == expected
+    # chats.json отстаёт от журнала, как после сбоя.
+    os.replace(tmp_path / 'stale.json', tmp_path / 'chats.json')
+    assert restart(tmp_path, read_chats) == expected
+    # Каталог без chats.json: журнал читается целиком.
+    os.unlink(tmp_path / 'chats.json')
+    assert restart(tmp_path, read_chats) == expected
+
+
+def test_ban_survives_restart(tmp_path):
+    async def ban(server):
+        await server.bus.publish({
+            'type': 'sign_in', 'username': 'spammer',
+            'client_addr': ['127.0.0.1', 1],
+        })
+        await server.bus.publish({
+            'type': 'report', 'username': 'alice', 'target': 'spammer',
+            'time': time.time(),
+        })
+        await server.bus.publish({
+            'type': 'ban', 'username': 'spammer', 'time': time.time(),
+        })
+
+    async def check(server):
+        reports = server.users['spammer'].reports
+        remaining = reports.end_of_ban - asyncio.get_running_loop().time()
+        return reports.reported_by, round(remaining)
+
+    restart(tmp_path, ban)
+    assert restart(tmp_path, check) == (['alice'], BAN_TIME)
+
+
+def sign_in_and_out(username):
+    async def scenario(server):
+        await server.bus.publish({
+            'type': 'sign_in', 'username': username,
+            'client_addr': ['127.0.0.1', 1],
+        })
+        await server.bus.publish({
+            'type': 'sign_out', 'username': username, 'time': time.time(),
+            'cursor': 0,
+        })
+    return scenario
+
+
+def test_user_changes_appended_to_log(tmp_path):
+    restart(tmp_path, sign_in_and_out('alice'))
+    restart(tmp_path, sign_in_and_out('bob'))
+
+    # Снимок не пишется, пока журнал изменений не набрал интервал.
+    assert not os.path.exists(tmp_path / 'users.json')
+    log = SegmentedLog(str(tmp_path / 'users_log' / '00000000'))
+    assert log.record_count == 2
+
+    async def users(server):
+        return sorted(server.users)
+
+    assert restart(tmp_path, users) == ['alice', 'bob']
+
+
+def test_user_checkpoint_starts_new_log(tmp_path, monkeypatch):
+    monkeypatch.setattr('storage.USERS_CHECKPOINT_INTERVAL', 2)
+    for username in ('alice', 'bob', 'carol'):
+        restart(tmp_path, sign_in_and_out(username))
+
+    assert os.listdir(tmp_path / 'users_log') == ['00000001']
+    with open(tmp_path / 'users.json') as users_file:
+        snapshot = json.load(users_file)
+    assert snapshot['generation'] == 1
+    assert sorted(snapshot['users']) == ['alice', 'bob']
+
+    # Журнал поколения, для которого снимок так и не был записан.
+    os.makedirs(tmp_path / 'users_log' / '00000002')
+
+    async def users(server):
+        return sorted(server.users)
+
+    assert restart(tmp_path, users) == ['alice', 'bob', 'carol']
+    assert os.listdir(tmp_path / 'users_log') == ['00000001']
+
+
+def test_evicted_user_found_without_reading_disk(tmp_path, monkeypatch):
+    async def evict(server):
+        await sign_in_and_out('alice')(server)
+        await server.bus.publish({'type': 'evict', 'username': 'alice'})
+
+    restart(tmp_path, evict)
+
+    async def lookup(server):
+        def no_disk(username):
+            raise AssertionError('диск читается в цикле событий')
+
+        monkeypatch.setattr(server.storage, '_cold_path', no_disk)
+        found = server.is_registered('alice'), server.is_registered('ghost')
+        monkeypatch.undo()
+        loaded = await server.ensure_user_loaded('alice')
+        return found, loaded, 'alice' in server.users
+
+    assert restart(tmp_path, lookup) == ((True, False), True, True)
+
+
+def test_chat_evicted_with_both_participants(tmp_path):
+    async def evict(server):
+        for username in ('alice', 'bob', 'carol'):
+            await sign_in_and_out(username)(server)
+        for index in range(3):
+            await server.bus.publish({
+                'type': 'private', 'sender': 'alice', 'target': 'bob',
+                'text': f'ab{index}',
+            })
+        await server.bus.publish({
+            'type': 'private', 'sender': 'alice', 'target': 'carol',
+            'text': 'ac',
+        })
+        for username in ('alice', 'bob'):
+            await server.bus.publish({'type': 'evict', 'username': username})
+        return (set(server.private_chats), server.user_chats,
+                server.storage.stored_users())
+
+    assert restart(tmp_path, evict) == (
+        {('alice', 'carol')}, {'carol': {('alice', 'carol')}}, 2
+    )
+
+    async def restore(server):
+        cold = set(server.private_chats)
+        await server.ensure_user_loaded('bob')
+        chat = server.private_chats[('alice', 'bob')]
+        await server.bus.publish({
+            'type': 'private', 'sender': 'bob', 'target': 'alice',
+            'text': 'ba',
+        })
+        messages = chat.read(0, chat.next_seq)[1]
+        return cold, server.user_chats['bob'], [
+            message.text for message in messages
+        ]
+
+    assert restart(tmp_path, restore) == (
+        {('alice', 'carol')}, {('alice', 'bob')},
+        ['ab0', 'ab1', 'ab2', 'ba'],
+    )
+
+    async def chats(server):
+        return {chat_id: chat.next_seq
+                for chat_id, chat in server.private_chats.items()}
+
+    assert restart(tmp_path, chats) == {
+        ('alice', 'bob'): 4, ('alice', 'carol'): 1,
+    }
+    assert os.listdir(tmp_path / 'cold_chats') == []
@@ -0,0 +1,106 @@
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.queues
+import os
+from typing import Optional
+
+from bus import BusHub, WorkerBus
+from config import EVENT_LOOP
+from custom_logger import forward_to, listen_workers, logger
+from eventloop import run
+from server import ChatServer
+from messages_templates import worker_started, worker_exited
+
+
+def run_worker(
+        worker_id: int,
+        host: str,
+        port: int,
+        metrics_port: Optional[int],
+        event_loop: str = EVENT_LOOP,
+        log_queue: Optional[multiprocessing.queues.Queue] = None
+) -> None:
+    """
+    Точка входа рабочего процесса.
+
+    Записи журнала передаются через log_queue родительскому процессу,
+    который один пишет файл журнала.
+    """
+    if log_queue is not None:
+        forward_to(log_queue)
+    if metrics_port is not None:
+        # У каждого процесса свои метрики и свой порт для них.
+        metrics_port += worker_id
+    server = ChatServer(host, port, WorkerBus(worker_id), metrics_port)
+    try:
+        run(server.run(), event_loop)
+    except KeyboardInterrupt:
+        pass
+
+
+async def supervise(
+        host: str,
+        port: int,
+        workers: int,
+        metrics_port: Optional[int] = None,
+        event_loop: str = EVENT_LOOP
+) -> None:
+    """
+    Запуск хаба шины и рабочих процессов.
+
+    Если любой из процессов завершается, останавливаются все остальные:
+    состояние процессов согласовано только пока все они подключены
+    к шине.
+    """
+    hub = BusHub(workers)
+    if os.path.exists(hub.path):
+        os.unlink(hub.path)
+    bus_server = await hub.start()
+
+    context = multiprocessing.get_context('spawn')
+    log_queue = context.Queue()
+    log_listener = listen_workers(log_queue)
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(worker_id, host, port, metrics_port, event_loop, log_queue),
+            daemon=True
+        )
+        for worker_id in range(workers)
+    ]
+    try:
+        for worker_id, process in enumerate(processes):
+            process.start()
+            logger.info(worker_started, worker_id, process.pid)
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            multiprocessing.connection.wait,
+            [process.sentinel for process in processes]
+        )
+        for worker_id, process in enumerate(processes):
+            if not process.is_alive():
+                logger.error(worker_exited, worker_id, process.exitcode)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        bus_server.close()
+        if os.path.exists(hub.path):
+            os.unlink(hub.path)
+        log_listener.stop()
+
+
+def run_workers(
+        host: str,
+        port: int,
+        workers: int,
+        metrics_port: Optional[int] = None,
+        event_loop: str = EVENT_LOOP
+) -> None:
+    """Запуск сервера из workers процессов на одном порту."""
+    run(
+        supervise(host, port, workers, metrics_port, event_loop), event_loop
+    )